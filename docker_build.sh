@@ -2,7 +2,7 @@
 set -e
 
 # Update version when changes to Dockerfile are made
-IMAGE_VERSION=0.0.1
+IMAGE_VERSION=0.0.2
 TIMESTAMP=$(date +"%s")
 
 # Environment variables
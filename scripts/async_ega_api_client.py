@@ -0,0 +1,156 @@
+"""
+    An asyncio counterpart to the EGA API request helpers in utils.py, for batch operations over many samples where
+    sequential round trips to the submission API add up. Requests run on the pooled, retrying EgaApiClient in worker
+    threads, and a semaphore bounds how many are in flight at once so a large batch doesn't flood the API.
+"""
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+from scripts.utils import (
+    EgaApiClient,
+    SUBMISSION_PROTOCOL_API_URL,
+    format_request_header,
+    iter_api_list,
+)
+
+DEFAULT_MAX_CONCURRENCY = 8
+
+
+class AsyncEgaApiClient:
+    """
+    Issues requests to the EGA submission API from coroutines, with at most `max_concurrency` of them in flight. The
+    endpoint methods return the decoded JSON and raise if the API returns an error, like the synchronous helpers. The
+    submission's collections can be filtered with a `match` predicate, to look for one object without keeping the
+    rest of the collection.
+    """
+
+    def __init__(
+            self, token: str, max_concurrency: int = DEFAULT_MAX_CONCURRENCY, client: Optional[EgaApiClient] = None
+    ) -> None:
+        self.token = token
+        self.max_concurrency = max_concurrency
+        # Give every concurrent request its own pooled connection
+        self.client = client or EgaApiClient(pool_size=max_concurrency)
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # The semaphore is created on first use so that it belongs to the running event loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("headers", format_request_header(self.token))
+        async with self._get_semaphore():
+            return await asyncio.to_thread(self.client.request, method, url, **kwargs)
+
+    async def _get_json(
+            self,
+            path: str,
+            description: str,
+            params: Optional[Dict] = None,
+            match: Optional[Callable[[Dict], bool]] = None,
+            first_match_only: bool = False,
+    ) -> List[Dict]:
+        """
+        Returns the objects in the list for which `match` is true, or all of them without one. The list is filtered
+        as it streams in, so only the matches are kept, and with `first_match_only` we stop reading at the first one.
+        """
+        def read_list() -> List[Dict]:
+            items = iter_api_list(
+                f"{SUBMISSION_PROTOCOL_API_URL}{path}",
+                format_request_header(self.token),
+                description,
+                client=self.client,
+                params=params,
+            )
+            matches = []
+            try:
+                for item in items:
+                    if match is None or match(item):
+                        matches.append(item)
+                        if first_match_only:
+                            break
+            finally:
+                # Release the response now rather than whenever the generator is garbage collected
+                items.close()
+            return matches
+
+        async with self._get_semaphore():
+            return await asyncio.to_thread(read_list)
+
+    async def get_inbox_files(self, prefix: Optional[str] = None) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/files/get
+        """
+        return await self._get_json("/files", "file metadata", params={"prefix": prefix} if prefix else None)
+
+    async def get_experiments(
+            self,
+            submission_accession_or_provisional_id: str,
+            match: Optional[Callable[[Dict], bool]] = None,
+            first_match_only: bool = False,
+    ) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--experiments/get
+        """
+        return await self._get_json(
+            f"/submissions/{submission_accession_or_provisional_id}/experiments",
+            "existing experiments",
+            match=match,
+            first_match_only=first_match_only,
+        )
+
+    async def get_samples(
+            self,
+            submission_accession_or_provisional_id: str,
+            match: Optional[Callable[[Dict], bool]] = None,
+            first_match_only: bool = False,
+    ) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--samples/get
+        """
+        return await self._get_json(
+            f"/submissions/{submission_accession_or_provisional_id}/samples",
+            "sample accession IDs",
+            match=match,
+            first_match_only=first_match_only,
+        )
+
+    async def get_runs(
+            self,
+            submission_accession_or_provisional_id: str,
+            match: Optional[Callable[[Dict], bool]] = None,
+            first_match_only: bool = False,
+    ) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--runs/get
+        """
+        return await self._get_json(
+            f"/submissions/{submission_accession_or_provisional_id}/runs",
+            "runs",
+            match=match,
+            first_match_only=first_match_only,
+        )
+
+    async def get_datasets(self, submission_accession_or_provisional_id: str) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--datasets/get
+        """
+        return await self._get_json(
+            f"/submissions/{submission_accession_or_provisional_id}/datasets", "existing datasets"
+        )
+
+    async def get_policies(self) -> List[Dict]:
+        """
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/policies/get
+        """
+        return await self._get_json("/policies", "policies")
@@ -0,0 +1,142 @@
+"""
+    Compares the throughput and peak memory of the encryption engines in encrypt_data_file.py.
+    Each engine is run as its own process (exactly as the EncryptDataFiles task runs it) so that the peak resident set
+    size reported by the kernel belongs to that run only. If no input file or key is provided, a random input file and
+    a throwaway recipient public key are generated.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import subprocess
+from base64 import b64encode
+from pathlib import Path
+from typing import Dict, List
+
+from crypt4gh import sodium
+
+sys.path.append("./")
+from scripts.utils import logging_configurator
+from scripts.encrypt_data_file import ENCRYPTION_ENGINES
+
+REPOSITORY_ROOT = Path(__file__).resolve().parent.parent
+ENCRYPT_SCRIPT = REPOSITORY_ROOT / "scripts" / "encrypt_data_file.py"
+
+
+def _write_random_file(path: str, size_mib: int) -> None:
+    logging.info(f"Generating {size_mib} MiB random input file at {path}")
+    with open(path, "wb") as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1024 * 1024))
+
+
+def _write_throwaway_public_key(path: str) -> None:
+    public_key = sodium.derive_pk(os.urandom(32))
+    with open(path, "wb") as f:
+        f.write(b"-----BEGIN CRYPT4GH PUBLIC KEY-----\n")
+        f.write(b64encode(public_key))
+        f.write(b"\n-----END CRYPT4GH PUBLIC KEY-----\n")
+
+
+def _run_engine(engine: str, aggregation_path: str, crypt4gh_encryption_key: str, workers: int) -> Dict:
+    command = [
+        sys.executable, str(ENCRYPT_SCRIPT),
+        "--aggregation_path", aggregation_path,
+        "--crypt4gh_encryption_key", crypt4gh_encryption_key,
+        "--engine", engine,
+        "--workers", str(workers),
+    ]
+    env = dict(os.environ, PYTHONPATH=str(REPOSITORY_ROOT))
+
+    with tempfile.TemporaryDirectory() as output_directory, tempfile.TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=output_directory, env=env, stdout=subprocess.DEVNULL, stderr=stderr)
+        # wait4 returns the resource usage of this child only (ru_maxrss is reported in KiB on Linux)
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"Engine {engine} failed with error: {stderr.read().decode()}")
+
+    size_mib = os.path.getsize(aggregation_path) / (1024 * 1024)
+    return {
+        "engine": engine,
+        "seconds": elapsed,
+        "mib_per_second": size_mib / elapsed,
+        "peak_rss_mib": usage.ru_maxrss / 1024,
+    }
+
+
+def run_benchmark(
+        aggregation_path: str, crypt4gh_encryption_key: str, engines: List[str], workers: int, repeats: int
+) -> List[Dict]:
+    results = []
+    for engine in engines:
+        for repeat in range(repeats):
+            logging.info(f"Running engine {engine} (repeat {repeat + 1} of {repeats})")
+            results.append(_run_engine(engine, aggregation_path, crypt4gh_encryption_key, workers))
+    return results
+
+
+def _log_results(results: List[Dict]) -> None:
+    logging.info(f"{'engine':<12}{'seconds':>10}{'MiB/s':>10}{'peak RSS MiB':>15}")
+    for result in results:
+        logging.info(
+            f"{result['engine']:<12}{result['seconds']:>10.2f}{result['mib_per_second']:>10.1f}"
+            f"{result['peak_rss_mib']:>15.1f}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the throughput and peak RSS of the crypt4gh encryption engines"
+    )
+    parser.add_argument(
+        "--aggregation_path",
+        required=False,
+        help="The file to encrypt. If not provided, a random file of --size_mib is generated."
+    )
+    parser.add_argument(
+        "--crypt4gh_encryption_key",
+        required=False,
+        help="The recipient public key. If not provided, a throwaway key is generated."
+    )
+    parser.add_argument(
+        "--size_mib", required=False, type=int, default=1024, help="The size of the generated input file"
+    )
+    parser.add_argument(
+        "--engines",
+        required=False,
+        default=",".join(ENCRYPTION_ENGINES),
+        help="The engines to benchmark (separated by commas)"
+    )
+    parser.add_argument(
+        "--workers", required=False, type=int, default=2, help="The number of workers for the native engine"
+    )
+    parser.add_argument(
+        "--repeats", required=False, type=int, default=3, help="The number of times each engine is run"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        aggregation_path = args.aggregation_path
+        if not aggregation_path:
+            aggregation_path = os.path.join(scratch_directory, "benchmark_input.cram")
+            _write_random_file(aggregation_path, args.size_mib)
+
+        crypt4gh_encryption_key = args.crypt4gh_encryption_key
+        if not crypt4gh_encryption_key:
+            crypt4gh_encryption_key = os.path.join(scratch_directory, "benchmark.pub")
+            _write_throwaway_public_key(crypt4gh_encryption_key)
+
+        benchmark_results = run_benchmark(
+            aggregation_path=aggregation_path,
+            crypt4gh_encryption_key=crypt4gh_encryption_key,
+            engines=args.engines.split(","),
+            workers=args.workers,
+            repeats=args.repeats,
+        )
+        _log_results(benchmark_results)
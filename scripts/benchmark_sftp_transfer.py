@@ -0,0 +1,294 @@
+"""
+    Benchmarks uploads to a local paramiko SFTP server. There are two modes:
+    - pipeline: compares the single-connection upload throughput of paramiko's `sftp.put` with the pipelined writer
+      in transfer_ega_file.py over a range of write request sizes and pipeline depths. Uploads go through a proxy
+      that adds a fixed round trip time, so the results reflect latency rather than bandwidth, which is what limits
+      transfers from the US to the EGA inbox in Europe. The server advertises a fixed SSH channel window, as the EGA
+      inbox does, so that only the settings we control on the client side vary.
+    - algorithms: compares the SSH cipher, MAC and compression combinations by throughput and by MiB uploaded per
+      CPU second. The server runs in its own process, so only the CPU used by the uploading side is counted.
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from itertools import product
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import paramiko
+
+sys.path.append("./")
+from scripts.utils import logging_configurator
+from scripts.local_sftp_server import LatencyProxy, LocalSftpServer
+from scripts.transfer_ega_file import (
+    PREFERRED_CIPHERS,
+    REMOTE_PATH,
+    WRITE_REQUEST_SIZE,
+    SftpConnectionSettings,
+    open_sftp_client,
+    pipelined_put,
+)
+
+BENCHMARK_INBOX = "benchmark-inbox"
+BENCHMARK_PASSWORD = "benchmark-password"
+# Ciphers that authenticate the data themselves, so that no separate MAC is negotiated with them
+AEAD_CIPHERS = ("aes128-gcm@openssh.com", "aes256-gcm@openssh.com")
+# The SSH channel window OpenSSH's sshd advertises. Uploads can't have more unacknowledged bytes in flight than this.
+SERVER_WINDOW_SIZE = 2 * 1024 * 1024
+
+
+def _write_random_file(path: str, size_mib: int) -> None:
+    logging.info(f"Generating {size_mib} MiB random input file at {path}")
+    with open(path, "wb") as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1024 * 1024))
+
+
+def _run_upload(
+        local_file: str, port: int, write_request_size: int, max_outstanding_writes: Optional[int]
+) -> Dict:
+    """Uploads the file once. A `max_outstanding_writes` of None uses paramiko's own `sftp.put`."""
+    settings = SftpConnectionSettings(hostname="127.0.0.1", port=port, write_request_size=write_request_size)
+    if max_outstanding_writes:
+        settings.max_outstanding_writes = max_outstanding_writes
+    remote_file = os.path.join(REMOTE_PATH, os.path.basename(local_file))
+
+    with open_sftp_client(BENCHMARK_INBOX, BENCHMARK_PASSWORD, settings) as sftp:
+        start = time.perf_counter()
+        if max_outstanding_writes:
+            pipelined_put(sftp, local_file, remote_file, settings)
+        else:
+            sftp.put(local_file, remote_file)
+        elapsed = time.perf_counter() - start
+
+    size_mib = os.path.getsize(local_file) / (1024 * 1024)
+    return {
+        "method": f"pipelined x{max_outstanding_writes}" if max_outstanding_writes else "sftp.put",
+        "write_kib": write_request_size / 1024 if max_outstanding_writes else 32,
+        "seconds": elapsed,
+        "mib_per_second": size_mib / elapsed,
+    }
+
+
+def run_benchmark(
+        local_file: str,
+        round_trip_ms: float,
+        write_request_sizes: List[int],
+        outstanding_writes: List[int],
+        repeats: int,
+        server_window_size: int = SERVER_WINDOW_SIZE,
+) -> List[Dict]:
+    results = []
+    with tempfile.TemporaryDirectory() as server_root:
+        os.makedirs(os.path.join(server_root, REMOTE_PATH.lstrip("/")))
+        # The window the server advertises is what limits uploads, and we can't change it on the EGA inbox, so it's
+        # the same for every run
+        with LocalSftpServer(
+                server_root, BENCHMARK_INBOX, BENCHMARK_PASSWORD, window_size=server_window_size
+        ) as server, LatencyProxy(server.port, round_trip_ms / 2000) as proxy:
+            for repeat in range(repeats):
+                logging.info(f"Uploading with paramiko's sftp.put (repeat {repeat + 1} of {repeats})")
+                results.append(_run_upload(local_file, proxy.port, WRITE_REQUEST_SIZE, None))
+            for write_request_size, max_outstanding_writes, repeat in product(
+                    write_request_sizes, outstanding_writes, range(repeats)
+            ):
+                logging.info(
+                    f"Uploading with {max_outstanding_writes} outstanding writes of {write_request_size} bytes "
+                    f"(repeat {repeat + 1} of {repeats})"
+                )
+                results.append(_run_upload(local_file, proxy.port, write_request_size, max_outstanding_writes))
+    return results
+
+
+def _serve(server_root: str, ports: multiprocessing.Queue, stop: multiprocessing.Event) -> None:
+    with LocalSftpServer(server_root, BENCHMARK_INBOX, BENCHMARK_PASSWORD, compression=True) as server:
+        ports.put(server.port)
+        stop.wait()
+
+
+@contextmanager
+def _server_process(server_root: str) -> Iterator[int]:
+    """Runs a local SFTP server in a child process and yields the port it listens on"""
+    ports = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    process = multiprocessing.Process(target=_serve, args=(server_root, ports, stop), daemon=True)
+    process.start()
+    try:
+        yield ports.get(timeout=60)
+    finally:
+        stop.set()
+        process.join(timeout=10)
+
+
+def _is_aead(cipher: str) -> bool:
+    return cipher in AEAD_CIPHERS
+
+
+def _run_algorithm_upload(local_file: str, port: int, cipher: str, mac: str, compression: bool) -> Dict:
+    settings = SftpConnectionSettings(
+        hostname="127.0.0.1", port=port, ciphers=(cipher,), macs=(mac,), compression=compression
+    )
+    remote_file = os.path.join(REMOTE_PATH, os.path.basename(local_file))
+
+    with open_sftp_client(BENCHMARK_INBOX, BENCHMARK_PASSWORD, settings) as sftp:
+        start, start_cpu = time.perf_counter(), time.process_time()
+        pipelined_put(sftp, local_file, remote_file, settings)
+        elapsed, cpu_seconds = time.perf_counter() - start, time.process_time() - start_cpu
+
+    size_mib = os.path.getsize(local_file) / (1024 * 1024)
+    return {
+        "cipher": cipher,
+        # AEAD ciphers authenticate the data themselves, so no MAC is negotiated
+        "mac": "(aead)" if _is_aead(cipher) else mac,
+        "compression": compression,
+        "seconds": elapsed,
+        "mib_per_second": size_mib / elapsed,
+        "mib_per_cpu_second": size_mib / cpu_seconds if cpu_seconds else 0.0,
+    }
+
+
+def _supported_algorithms(kind: str, requested: Sequence[str], supported: Sequence[str]) -> List[str]:
+    """
+    Drops the algorithms paramiko can't negotiate, so that the results only list algorithms that were actually used
+    """
+    skipped = [algorithm for algorithm in requested if algorithm not in supported]
+    if skipped:
+        logging.warning(f"Skipping {kind} that paramiko does not support: {', '.join(skipped)}")
+    return [algorithm for algorithm in requested if algorithm in supported]
+
+
+def run_algorithm_benchmark(
+        local_file: str, ciphers: List[str], macs: List[str], compression: List[bool], repeats: int
+) -> List[Dict]:
+    ciphers = _supported_algorithms("ciphers", ciphers, paramiko.Transport._preferred_ciphers)
+    macs = _supported_algorithms("MACs", macs, paramiko.Transport._preferred_macs)
+    if not ciphers or not macs:
+        raise ValueError("Expected at least one cipher and one MAC that paramiko supports")
+
+    results = []
+    with tempfile.TemporaryDirectory() as server_root:
+        os.makedirs(os.path.join(server_root, REMOTE_PATH.lstrip("/")))
+        with _server_process(server_root) as port:
+            for cipher, use_compression in product(ciphers, compression):
+                cipher_macs = macs[:1] if _is_aead(cipher) else macs
+                for mac, repeat in product(cipher_macs, range(repeats)):
+                    logging.info(
+                        f"Uploading with {cipher}, {'(aead)' if _is_aead(cipher) else mac} and compression "
+                        f"{'on' if use_compression else 'off'} (repeat {repeat + 1} of {repeats})"
+                    )
+                    results.append(_run_algorithm_upload(local_file, port, cipher, mac, use_compression))
+    return sorted(results, key=lambda result: result["mib_per_cpu_second"], reverse=True)
+
+
+def _log_algorithm_results(results: List[Dict]) -> None:
+    logging.info(f"{'cipher':<26}{'mac':<32}{'compression':<13}{'MiB/s':>10}{'MiB/CPU s':>12}")
+    for result in results:
+        logging.info(
+            f"{result['cipher']:<26}{result['mac']:<32}{str(result['compression']):<13}"
+            f"{result['mib_per_second']:>10.1f}{result['mib_per_cpu_second']:>12.1f}"
+        )
+
+
+def _log_results(results: List[Dict]) -> None:
+    logging.info(f"{'method':<18}{'write KiB':>10}{'seconds':>10}{'MiB/s':>10}")
+    for result in results:
+        logging.info(
+            f"{result['method']:<18}{result['write_kib']:>10.0f}{result['seconds']:>10.2f}"
+            f"{result['mib_per_second']:>10.1f}"
+        )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark SFTP upload throughput against a local server, either over a link with injected "
+                    "latency (pipeline) or per SSH algorithm (algorithms)"
+    )
+    parser.add_argument(
+        "--mode", required=False, default="pipeline", choices=["pipeline", "algorithms"], help="What to benchmark"
+    )
+    parser.add_argument(
+        "--local_file",
+        required=False,
+        help="The file to upload. If not provided, a random file of --size_mib is generated."
+    )
+    parser.add_argument(
+        "--size_mib", required=False, type=int, default=256, help="The size of the generated file"
+    )
+    parser.add_argument(
+        "--round_trip_ms",
+        required=False,
+        type=float,
+        default=80,
+        help="The round trip time added to every connection, in milliseconds"
+    )
+    parser.add_argument(
+        "--server_window_mib",
+        required=False,
+        type=float,
+        default=SERVER_WINDOW_SIZE / (1024 * 1024),
+        help="Pipeline mode only. The SSH channel window the server advertises, in MiB"
+    )
+    parser.add_argument(
+        "--write_request_sizes_kib",
+        required=False,
+        default="32",
+        help="Pipeline mode only. The SFTP write request sizes to try, in KiB (separated by commas)"
+    )
+    parser.add_argument(
+        "--outstanding_writes",
+        required=False,
+        default="16,32,64,128,512",
+        help="Pipeline mode only. The numbers of outstanding SFTP writes to try (separated by commas)"
+    )
+    parser.add_argument(
+        "--ciphers",
+        required=False,
+        default=",".join(PREFERRED_CIPHERS),
+        help="Algorithms mode only. The SSH ciphers to try (separated by commas)"
+    )
+    parser.add_argument(
+        "--macs",
+        required=False,
+        default="hmac-sha2-256-etm@openssh.com,hmac-sha2-512-etm@openssh.com,hmac-sha1",
+        help="Algorithms mode only. The SSH MACs to try with non-AEAD ciphers (separated by commas)"
+    )
+    parser.add_argument(
+        "--compression",
+        required=False,
+        default="off,on",
+        help="Algorithms mode only. Whether to try SSH compression off, on or both (separated by commas)"
+    )
+    parser.add_argument(
+        "--repeats", required=False, type=int, default=1, help="The number of times each configuration is run"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch_directory:
+        local_file = args.local_file
+        if not local_file:
+            local_file = os.path.join(scratch_directory, "benchmark_input.cram.c4gh")
+            _write_random_file(local_file, args.size_mib)
+
+        if args.mode == "algorithms":
+            algorithm_results = run_algorithm_benchmark(
+                local_file=local_file,
+                ciphers=args.ciphers.split(","),
+                macs=args.macs.split(","),
+                compression=[setting == "on" for setting in args.compression.split(",")],
+                repeats=args.repeats,
+            )
+            _log_algorithm_results(algorithm_results)
+        else:
+            benchmark_results = run_benchmark(
+                local_file=local_file,
+                round_trip_ms=args.round_trip_ms,
+                write_request_sizes=[int(float(size) * 1024) for size in args.write_request_sizes_kib.split(",")],
+                outstanding_writes=[int(writes) for writes in args.outstanding_writes.split(",")],
+                repeats=args.repeats,
+                server_window_size=int(args.server_window_mib * 1024 * 1024),
+            )
+            _log_results(benchmark_results)
@@ -2,16 +2,20 @@ import sys
 import argparse
 import logging
 from pathlib import Path
-from csv import DictWriter
-from typing import Dict, List
+from csv import DictReader, DictWriter
+from typing import Dict, List, Optional, Tuple
 
 sys.path.append("./")
 from scripts.utils import (
     LoginAndGetToken,
+    InboxFileIndex,
     SecretManager,
+    files_for_sample,
     format_request_header,
     normalize_sample_alias,
     get_file_metadata_for_one_sample_in_inbox,
+    checksum_matches,
+    read_checksum_manifest,
     logging_configurator,
 )
 
@@ -19,30 +23,31 @@ from scripts.utils import (
 class GetValidationStatus:
     VALID_STATUS_CODES = [200, 201]
 
-    def __init__(self, token: str, sample_alias: str) -> None:
+    def __init__(
+            self,
+            token: str,
+            sample_alias: str,
+            checksum_manifest: Optional[Dict] = None,
+            inbox_index: Optional[InboxFileIndex] = None,
+    ) -> None:
         self.token = token
         self.sample_alias = sample_alias
+        self.checksum_manifest = checksum_manifest
+        # When checking many samples, list the inbox once and share the index instead of querying it per sample
+        self.inbox_index = inbox_index
 
     def _headers(self):
         return format_request_header(self.token)
 
     def _get_file_info_for_sample(self, file_metadata) -> List[Dict]:
         logging.info(f"Attempting to find all files associated with sample alias {self.sample_alias}")
-        files_for_sample = []
-        normalized_alias = normalize_sample_alias(self.sample_alias)
+        files_metadata_for_sample = files_for_sample(file_metadata, self.sample_alias)
 
-        for file in file_metadata:
-            relative_file_path = file["relative_path"]
-            file_name = Path(relative_file_path).name
-            sample_alias_from_path = Path(file_name).stem
-            if sample_alias_from_path == normalized_alias:
-                files_for_sample.append(file)
-
-        if not files_for_sample:
+        if not files_metadata_for_sample:
             raise Exception(
                 f"Expected to find at least 1 file associated with sample {self.sample_alias}, instead found none"
             )
-        return files_for_sample
+        return files_metadata_for_sample
 
     def _determine_validation_status_for_files(self, files_metadata_for_sample: List[Dict]) -> bool:
         logging.info("Attempting to determine file validation status now.")
@@ -60,21 +65,99 @@ class GetValidationStatus:
         logging.info(f"File(s) associated wtih {self.sample_alias} have not yet been validated.")
         return False
 
+    def _checksums_match_manifest(self, files_metadata_for_sample: List[Dict]) -> Optional[bool]:
+        """
+        Compares the checksums EGA computed for the uploaded file with the ones recorded in the checksum manifest
+        while the file was being encrypted, so the file never has to be read again to confirm its integrity. Returns
+        None if EGA hasn't reported both checksums yet, which is normal while the file is still being validated.
+        """
+        manifest_file_name = self.checksum_manifest["file_name"]
+        logging.info(f"Comparing checksums reported by EGA with the checksum manifest for {manifest_file_name}")
+
+        for file in files_metadata_for_sample:
+            file_name = Path(file["relative_path"]).name
+            if file_name != manifest_file_name:
+                continue
+
+            if not file["unencrypted_checksum"] or not file["encrypted_checksum"]:
+                logging.info(f"EGA has not yet reported the checksums for {file_name}")
+                return None
+            unencrypted_match = checksum_matches(file["unencrypted_checksum"], self.checksum_manifest["unencrypted"])
+            encrypted_match = checksum_matches(file["encrypted_checksum"], self.checksum_manifest["encrypted"])
+            if unencrypted_match and encrypted_match:
+                logging.info(f"Checksums reported by EGA for {file_name} match the checksum manifest")
+                return True
+            logging.error(
+                f"Checksums reported by EGA for {file_name} do not match the checksum manifest. "
+                f"Unencrypted checksum matches: {unencrypted_match}. Encrypted checksum matches: {encrypted_match}"
+            )
+            return False
+
+        logging.error(f"Could not find {manifest_file_name} in the inbox file metadata for {self.sample_alias}")
+        return False
+
     def get_file_validation_status(self) -> bool:
         # Get the metadata for ALL files in the submission
         logging.info("Attempting to collect metadata for sample in submission")
-        normalized_alias = normalize_sample_alias(self.sample_alias)
-        file_metadata = get_file_metadata_for_one_sample_in_inbox(
-            normalized_alias, self._headers()
-        )
-        # Filter down to only the file metadata for the sample of interest
-        if file_metadata:
-            files_metadata_for_sample = self._get_file_info_for_sample(file_metadata=file_metadata)
+        if self.inbox_index:
+            file_metadata = self.inbox_index.files_for_sample(self.sample_alias)
+        else:
+            normalized_alias = normalize_sample_alias(self.sample_alias)
+            file_metadata = get_file_metadata_for_one_sample_in_inbox(
+                normalized_alias, self._headers()
+            )
+        # Filter down to only the file metadata for the sample of interest. Raises if there are none.
+        files_metadata_for_sample = self._get_file_info_for_sample(file_metadata=file_metadata)
+
+        # Find the OVERALL validation status of the file(s) associated with the sample
+        all_files_valid = self._determine_validation_status_for_files(files_metadata_for_sample)
+
+        # If we recorded checksums while encrypting, make sure they match what EGA received
+        if all_files_valid and self.checksum_manifest:
+            checksums_match = self._checksums_match_manifest(files_metadata_for_sample)
+            if checksums_match is None:
+                logging.info(f"File(s) associated with {self.sample_alias} have not yet been validated.")
+                return False
+            if not checksums_match:
+                raise Exception(
+                    f"Checksums of the file(s) in the inbox for {self.sample_alias} do not match the checksums "
+                    f"recorded during encryption"
+                )
+        return all_files_valid
+
 
-            # If we find file(s) associated with the sample, find the OVERALL validation status
-            if files_metadata_for_sample:
-                all_files_valid = self._determine_validation_status_for_files(files_metadata_for_sample)
-                return all_files_valid
+def read_samples_tsv(samples_tsv: str) -> Dict[str, str]:
+    """
+    Reads the sample_alias and sample_id columns of a TSV with one row per sample, such as the samples TSV of
+    register_experiments_and_runs_in_batch.py, and returns the sample aliases keyed by sample ID
+    """
+    with open(samples_tsv) as tsv_file:
+        reader = DictReader(tsv_file, delimiter="\t")
+        if reader.fieldnames and not {"sample_alias", "sample_id"} <= set(reader.fieldnames):
+            raise ValueError("The samples TSV must have sample_alias and sample_id columns")
+        return {sample["sample_id"]: sample["sample_alias"] for sample in reader}
+
+
+def get_file_validation_statuses(
+        token: str, sample_aliases_by_id: Dict[str, str]
+) -> Tuple[Dict[str, bool], Dict[str, str]]:
+    """
+    Gets the validation status of the files of many samples, keyed by sample ID. The inbox is listed once and indexed,
+    instead of being queried once per sample. A sample that fails doesn't stop the others; the statuses of the samples
+    that succeeded are returned along with the errors of those that didn't, keyed by sample alias.
+    """
+    inbox_index = InboxFileIndex.from_inbox(format_request_header(token))
+    validation_statuses = {}
+    failed_samples = {}
+    for sample_id, sample_alias in sample_aliases_by_id.items():
+        try:
+            validation_statuses[sample_id] = GetValidationStatus(
+                token=token, sample_alias=sample_alias, inbox_index=inbox_index
+            ).get_file_validation_status()
+        except Exception as e:
+            logging.error(f"Could not determine the validation status of sample {sample_alias}: {e}")
+            failed_samples[sample_alias] = str(e)
+    return validation_statuses, failed_samples
 
 
 class WriteOutputTsvFiles:
@@ -101,6 +184,21 @@ class WriteOutputTsvFiles:
         self._write_validation_status_for_terra_data_tables()
 
 
+def write_validation_statuses_tsv(validation_statuses: Dict[str, bool], output_tsv: str) -> None:
+    """Writes the validation status of many samples to one tsv that can be loaded into the Terra data tables"""
+    logging.info(f"Writing validation statuses for {len(validation_statuses)} samples to {output_tsv}")
+    with open(output_tsv, "w") as validation_file:
+        writer = DictWriter(validation_file, fieldnames=["entity:sample_id", "file_validation_status"], delimiter='\t')
+        writer.writeheader()
+        for sample_id, validation_status in validation_statuses.items():
+            writer.writerow(
+                {
+                    "entity:sample_id": sample_id,
+                    "file_validation_status": "validated" if validation_status else "incomplete",
+                }
+            )
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="This script will check the validation status of a file associated with the provided sample. "
@@ -114,25 +212,60 @@ if __name__ == '__main__':
     )
     parser.add_argument(
         "-sample_alias",
-        required=True,
+        required=False,
         type=str,
-        help="The sample alias to register metadata for",
+        help="The sample alias to register metadata for. Required unless -samples_tsv is provided.",
     )
     parser.add_argument(
         "-sample_id",
-        required=True,
-        help="The sample_id identifier from the terra data table"
+        required=False,
+        help="The sample_id identifier from the terra data table. Required unless -samples_tsv is provided."
+    )
+    parser.add_argument(
+        "-samples_tsv",
+        required=False,
+        default=None,
+        help="A TSV with sample_alias and sample_id columns, to check many samples at once instead of -sample_alias "
+             "and -sample_id. The inbox is only listed once for all of them."
+    )
+    parser.add_argument(
+        "-output_tsv",
+        required=False,
+        default="sample_id_validation_status.tsv",
+        help="With -samples_tsv, the TSV to write the validation status of every sample to"
+    )
+    parser.add_argument(
+        "-checksum_manifest",
+        required=False,
+        default=None,
+        help="The checksum manifest written during encryption. If provided, the checksums reported by EGA must match it"
     )
     args = parser.parse_args()
 
+    if args.samples_tsv and (args.sample_alias or args.sample_id or args.checksum_manifest):
+        parser.error("-samples_tsv can't be combined with -sample_alias, -sample_id or -checksum_manifest")
+    if not args.samples_tsv and not (args.sample_alias and args.sample_id):
+        parser.error("Either -samples_tsv or both -sample_alias and -sample_id are required")
+
     password = SecretManager(ega_inbox=args.user_name).get_ega_password_secret()
     access_token = LoginAndGetToken(username=args.user_name, password=password).login_and_get_token()
 
-    if access_token:
+    if access_token and args.samples_tsv:
+        logging.info("Successfully generated access token")
+        sample_aliases_by_id = read_samples_tsv(args.samples_tsv)
+        validation_statuses, failed_samples = get_file_validation_statuses(access_token, sample_aliases_by_id)
+        write_validation_statuses_tsv(validation_statuses, args.output_tsv)
+        if failed_samples:
+            raise Exception(
+                f"Failed to determine the validation status of {len(failed_samples)} of {len(sample_aliases_by_id)} "
+                f"samples: {', '.join(failed_samples)}"
+            )
+    elif access_token:
         logging.info("Successfully generated access token")
         validation_status = GetValidationStatus(
             token=access_token,
-            sample_alias=args.sample_alias
+            sample_alias=args.sample_alias,
+            checksum_manifest=read_checksum_manifest(args.checksum_manifest) if args.checksum_manifest else None,
         ).get_file_validation_status()
 
         WriteOutputTsvFiles(
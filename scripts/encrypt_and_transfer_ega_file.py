@@ -0,0 +1,169 @@
+"""
+    Encrypts a data file with crypt4gh and streams the ciphertext straight into the EGA inbox over SFTP.
+    The plaintext is read once and the encrypted copy never touches the local disk. Encrypted chunks are passed from
+    the encryption thread to the upload through a bounded queue, so memory use stays constant regardless of the size
+    of the input file.
+"""
+import os
+import sys
+import queue
+import argparse
+import logging
+import threading
+import multiprocessing
+from typing import Optional
+
+sys.path.append("./")
+from scripts.utils import (
+    SecretManager,
+    logging_configurator,
+)
+from scripts.encrypt_data_file import Crypt4ghEncryptor
+from scripts.source_readers import open_source
+from scripts.transfer_ega_file import (
+    REMOTE_PATH,
+    PipelinedSftpWriter,
+    SftpConnectionSettings,
+    open_sftp_client,
+)
+
+# Maximum number of encrypted chunks (~4 MiB each) waiting to be uploaded
+MAX_QUEUED_CHUNKS = 8
+_END_OF_STREAM = object()
+
+
+class _EncryptedChunkProducer(threading.Thread):
+    """Encrypts the input file on a background thread and puts the encrypted chunks on a bounded queue"""
+
+    def __init__(self, encryptor: Crypt4ghEncryptor, aggregation_path: str, max_queued_chunks: int) -> None:
+        super().__init__(daemon=True)
+        self.encryptor = encryptor
+        self.aggregation_path = aggregation_path
+        self.chunks = queue.Queue(maxsize=max_queued_chunks)
+        self.stopped = threading.Event()
+
+    def _put(self, item) -> bool:
+        # Keep checking whether the consumer has gone away so that we never block forever on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(self) -> None:
+        try:
+            with open_source(self.aggregation_path) as infile:
+                for chunk in self.encryptor.encrypted_chunks(infile):
+                    if not self._put(chunk):
+                        return
+            self._put(_END_OF_STREAM)
+        except Exception as e:
+            self._put(e)
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def encrypt_and_transfer_file(
+        aggregation_path: str,
+        crypt4gh_encryption_key: str,
+        ega_inbox: str,
+        password: str,
+        workers: Optional[int] = None,
+        max_queued_chunks: int = MAX_QUEUED_CHUNKS,
+        checksum_manifest: Optional[str] = None,
+        settings: Optional[SftpConnectionSettings] = None,
+) -> None:
+    """
+    Encrypts the data file and uploads the ciphertext to the EGA inbox in a single pass. If `checksum_manifest` is
+    provided, the checksums of the plaintext and the uploaded ciphertext are written to it once the upload succeeds.
+    """
+    # The workers are started by the producer thread while the SSH transport's thread is running, so they're
+    # spawned rather than forked
+    encryptor = Crypt4ghEncryptor(
+        crypt4gh_encryption_key,
+        workers=workers,
+        compute_checksums=checksum_manifest is not None,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+    producer = _EncryptedChunkProducer(encryptor, aggregation_path, max_queued_chunks)
+    remote_file = os.path.join(REMOTE_PATH, os.path.basename(aggregation_path))
+
+    try:
+        with open_sftp_client(ega_inbox, password, settings) as sftp:
+            # Keep many writes in flight rather than waiting for the server to acknowledge each one
+            with PipelinedSftpWriter(sftp, remote_file, settings) as remote:
+                producer.start()
+                bytes_transferred = 0
+                while True:
+                    chunk = producer.chunks.get()
+                    if chunk is _END_OF_STREAM:
+                        break
+                    if isinstance(chunk, Exception):
+                        raise RuntimeError(f"Error encrypting file: {str(chunk)}") from chunk
+                    remote.write(chunk)
+                    bytes_transferred += len(chunk)
+
+        logging.info(
+            f"Successfully encrypted and transferred {aggregation_path} ({bytes_transferred} bytes) to EGA inbox "
+            f"{ega_inbox}"
+        )
+    except Exception as e:
+        raise Exception(f"Error encrypting and transferring file: {str(e)}")
+    finally:
+        producer.stop()
+        if producer.is_alive():
+            producer.join()
+
+    if checksum_manifest:
+        encryptor.write_checksum_manifest(checksum_manifest, os.path.basename(aggregation_path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Encrypt the given data file using crypt4gh and stream it to the EGA inbox without writing the "
+                    "encrypted file to disk"
+    )
+    parser.add_argument(
+        "--aggregation_path",
+        required=True,
+        help="The file to encrypt. A gs:// path is streamed without localizing it first."
+    )
+    parser.add_argument(
+        "--crypt4gh_encryption_key", required=True, help="The key supplied by EGA"
+    )
+    parser.add_argument(
+        "--ega_inbox",
+        required=True,
+        help="Inbox assigned to the current PM"
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=None,
+        help="The number of encryption worker processes. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--checksum_manifest",
+        required=False,
+        default=None,
+        help="If provided, write the checksums of the unencrypted and encrypted file to this path"
+    )
+    args = parser.parse_args()
+
+    password = SecretManager(ega_inbox=args.ega_inbox).get_ega_password_secret()
+
+    logging.info("Starting script to encrypt and transfer file to EGA")
+    encrypt_and_transfer_file(
+        aggregation_path=args.aggregation_path,
+        crypt4gh_encryption_key=args.crypt4gh_encryption_key,
+        ega_inbox=args.ega_inbox,
+        password=password,
+        workers=args.workers,
+        checksum_manifest=args.checksum_manifest,
+    )
+
+    logging.info("Script finished")
@@ -1,21 +1,266 @@
 import os
+import json
+import time
+import shutil
 import subprocess
 import argparse
 import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from csv import DictWriter
+from multiprocessing.context import BaseContext
+from typing import BinaryIO, Dict, Iterator, List, Optional
 
-from scripts.utils import logging_configurator
+# The native engine builds the crypt4gh format from these internals rather than a public API, so crypt4gh is pinned in
+# requirements.txt, and an upgrade needs a file encrypted by it decrypted with `crypt4gh decrypt` before it's bumped
+from crypt4gh import SEGMENT_SIZE, CIPHER_DIFF, CIPHER_SEGMENT_SIZE, header, sodium
+from crypt4gh.keys import get_public_key
 
+from scripts.utils import (
+    StreamChecksums,
+    build_checksum_manifest,
+    write_checksum_manifest,
+    logging_configurator,
+)
+from scripts.encrypted_output_cache import EncryptedOutputCache, input_checksum
+from scripts.source_readers import is_gcs_path, open_source, source_fingerprint, source_size
 
-def encrypt_file(aggregation_path, crypt4gh_encryption_key):
+ENCRYPTION_ENGINES = ["native", "subprocess"]
+# crypt4gh encryption method 0 is chacha20_ietf_poly1305, the only one supported by the spec
+ENCRYPTION_METHOD = 0
+# Number of 64 KiB crypt4gh segments that are handed to a worker process at a time (4 MiB of plaintext)
+SEGMENTS_PER_BATCH = 64
+# Size of a crypt4gh header with a single recipient and no edit list
+SINGLE_RECIPIENT_HEADER_SIZE = 124
+# Record progress every 16384 segments (1 GiB of plaintext)
+CHECKPOINT_INTERVAL_SEGMENTS = 16384
+BATCH_RESULTS_FIELDNAMES = ["aggregation_path", "encrypted_data_file", "status", "bytes", "seconds", "error"]
+
+
+def expected_encrypted_size(plaintext_size: int) -> int:
+    """Returns the size of the crypt4gh file that a plaintext of the given size encrypts to"""
+    segments = -(-plaintext_size // SEGMENT_SIZE)
+    return SINGLE_RECIPIENT_HEADER_SIZE + plaintext_size + segments * CIPHER_DIFF
+
+
+class EncryptionCheckpoint:
+    """
+    Sidecar that records how many segments of an encryption have been durably written, along with the session key and
+    header needed to carry on with the same encryption after an interruption. The session key is secret, so the sidecar
+    is only readable by its owner and is removed as soon as the encryption completes. A checkpoint is ignored if the
+    input file or the recipient key changed since it was written.
     """
-    Encrypts the given data file using crypt4gh.
 
-    Parameters:
-    - aggregation_path (str): The file to encrypt.
-    - crypt4gh_encryption_key (str): The key supplied by EGA.
+    def __init__(self, checkpoint_path: str, aggregation_path: str, recipient_public_key: bytes) -> None:
+        self.checkpoint_path = checkpoint_path
+        self.fingerprint = {
+            **source_fingerprint(aggregation_path),
+            "recipient_public_key": recipient_public_key.hex(),
+        }
+
+    def load(self) -> Optional[Dict]:
+        if not os.path.exists(self.checkpoint_path):
+            return None
+        with open(self.checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint["fingerprint"] != self.fingerprint:
+            logging.warning(f"Ignoring checkpoint {self.checkpoint_path} since the input or key has changed")
+            return None
+        return checkpoint
+
+    def save(self, session_key: bytes, header_bytes: bytes, segments_written: int) -> None:
+        # Write to a temporary file and rename it so that a crash never leaves a half written checkpoint behind
+        temporary_path = f"{self.checkpoint_path}.tmp"
+        file_descriptor = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(file_descriptor, "w") as checkpoint_file:
+            json.dump(
+                {
+                    "fingerprint": self.fingerprint,
+                    "session_key": session_key.hex(),
+                    "header": header_bytes.hex(),
+                    "segments_written": segments_written,
+                },
+                checkpoint_file,
+            )
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def remove(self) -> None:
+        if os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+
+def _encrypt_segment_batch(session_key: bytes, plaintext: bytes) -> bytes:
     """
-    output_file = os.path.basename(aggregation_path)
+    Encrypts a batch of consecutive plaintext segments. Every segment is encrypted independently with its own random
+    nonce, so batches can be encrypted in any order and on any worker. Runs inside a worker process.
+    """
+    ciphersegment = bytearray(CIPHER_SEGMENT_SIZE)
+    ciphertext = bytearray()
+    plaintext_view = memoryview(plaintext)
+    for start in range(0, len(plaintext), SEGMENT_SIZE):
+        cipher_length = sodium.chacha20poly1305_encrypt(
+            ciphersegment, plaintext_view[start:start + SEGMENT_SIZE], session_key
+        )
+        ciphertext += ciphersegment[:cipher_length]
+    return bytes(ciphertext)
+
+
+class Crypt4ghEncryptor:
+    """
+    Encrypts a stream into the crypt4gh format without shelling out to the crypt4gh CLI. The plaintext is read in
+    batches of whole segments, the batches are encrypted on a pool of worker processes and the ciphertext is handed
+    back in the original order. At most `max_pending_batches` batches are in flight at once, so memory use does not
+    depend on the size of the input. If `compute_checksums` is set, the checksums of the plaintext and the ciphertext
+    are computed in the same pass. The worker processes are started with `mp_context`, or the platform's default; a
+    caller that encrypts while other threads are running should pass a "spawn" context, since forking a process with
+    threads can copy a lock one of them holds into the worker.
+    """
+
+    def __init__(
+            self,
+            crypt4gh_encryption_key: str,
+            workers: Optional[int] = None,
+            segments_per_batch: int = SEGMENTS_PER_BATCH,
+            compute_checksums: bool = False,
+            mp_context: Optional[BaseContext] = None,
+    ) -> None:
+        self.recipient_public_key = get_public_key(crypt4gh_encryption_key)
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = SEGMENT_SIZE * segments_per_batch
+        self.max_pending_batches = self.workers * 2
+        # One session key is used for all segments of the file, just like `crypt4gh encrypt`
+        self.session_key = os.urandom(32)
+        self.header_bytes = None
+        self.compute_checksums = compute_checksums
+        self.mp_context = mp_context
+        self.unencrypted_checksums = StreamChecksums()
+        self.encrypted_checksums = StreamChecksums()
+
+    def _header(self) -> bytes:
+        if self.header_bytes is None:
+            # The CLI generates a throwaway sender key when none is provided, so we do the same
+            keys = [(0, os.urandom(32), self.recipient_public_key)]
+            header_content = header.make_packet_data_enc(ENCRYPTION_METHOD, self.session_key)
+            self.header_bytes = header.serialize(header.encrypt(header_content, keys))
+        return self.header_bytes
+
+    def resume_from(self, session_key: bytes, header_bytes: bytes) -> None:
+        """Continues an earlier encryption, so that new segments can be appended to the ones it already wrote"""
+        self.session_key = session_key
+        self.header_bytes = header_bytes
+
+    def _read_batches(self, infile: BinaryIO) -> Iterator[bytes]:
+        while True:
+            batch = infile.read(self.batch_size)
+            if not batch:
+                break
+            if self.compute_checksums:
+                self.unencrypted_checksums.update(batch)
+            yield batch
+
+    def encrypted_chunks(self, infile: BinaryIO, include_header: bool = True) -> Iterator[bytes]:
+        """Yields the crypt4gh header followed by the encrypted data segments, in order"""
+        for chunk in self._encrypt_stream(infile, include_header):
+            if self.compute_checksums:
+                self.encrypted_checksums.update(chunk)
+            yield chunk
 
+    def _encrypt_stream(self, infile: BinaryIO, include_header: bool) -> Iterator[bytes]:
+        if include_header:
+            yield self._header()
+
+        # With a single worker there is nothing to parallelize, so skip the cost of shipping batches to a pool
+        if self.workers == 1:
+            for batch in self._read_batches(infile):
+                yield _encrypt_segment_batch(self.session_key, batch)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=self.mp_context) as executor:
+            pending = deque()
+            for batch in self._read_batches(infile):
+                pending.append(executor.submit(_encrypt_segment_batch, self.session_key, batch))
+                if len(pending) >= self.max_pending_batches:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def encrypt(self, infile: BinaryIO, outfile: BinaryIO) -> None:
+        for chunk in self.encrypted_chunks(infile):
+            outfile.write(chunk)
+
+    def encrypt_resumably(
+            self,
+            aggregation_path: str,
+            output_file: str,
+            checkpoint: EncryptionCheckpoint,
+            checkpoint_interval_segments: int = CHECKPOINT_INTERVAL_SEGMENTS,
+    ) -> None:
+        """
+        Encrypts the file while periodically checkpointing the number of segments that have been durably written. If
+        a checkpoint from an interrupted run exists, the encryption picks up from the last checkpointed segment with
+        the same session key instead of starting over from byte 0.
+        """
+        state = checkpoint.load()
+        segments_written = 0
+        if state and os.path.exists(output_file):
+            checkpointed_size = len(bytes.fromhex(state["header"])) + state["segments_written"] * CIPHER_SEGMENT_SIZE
+            # Truncating a shorter file would pad it with zeros, so the output must hold everything checkpointed
+            if os.path.getsize(output_file) < checkpointed_size:
+                logging.warning(
+                    f"{output_file} is shorter than its checkpoint of {checkpointed_size} bytes, so encryption of "
+                    f"{aggregation_path} will start over"
+                )
+            else:
+                self.resume_from(bytes.fromhex(state["session_key"]), bytes.fromhex(state["header"]))
+                segments_written = state["segments_written"]
+                logging.info(f"Resuming encryption of {aggregation_path} from segment {segments_written}")
+
+        with open_source(aggregation_path) as infile, open(output_file, "r+b" if segments_written else "wb") as outfile:
+            if segments_written:
+                input_offset = segments_written * SEGMENT_SIZE
+                output_offset = len(self._header()) + segments_written * CIPHER_SEGMENT_SIZE
+                # Digests can't be checkpointed, so they are rebuilt from what was already read and written
+                if self.compute_checksums:
+                    self._update_checksums_from_prefix(infile, input_offset, self.unencrypted_checksums)
+                    self._update_checksums_from_prefix(outfile, output_offset, self.encrypted_checksums)
+                # Anything written after the last checkpoint may be incomplete, so it is encrypted again
+                outfile.truncate(output_offset)
+                outfile.seek(output_offset)
+                infile.seek(input_offset)
+
+            next_checkpoint = segments_written + checkpoint_interval_segments
+            for chunk in self.encrypted_chunks(infile, include_header=not segments_written):
+                outfile.write(chunk)
+                segments_written = (outfile.tell() - len(self._header())) // CIPHER_SEGMENT_SIZE
+                if segments_written >= next_checkpoint:
+                    outfile.flush()
+                    os.fsync(outfile.fileno())
+                    checkpoint.save(self.session_key, self._header(), segments_written)
+                    next_checkpoint = segments_written + checkpoint_interval_segments
+
+        checkpoint.remove()
+
+    def _update_checksums_from_prefix(self, stream: BinaryIO, length: int, checksums: StreamChecksums) -> None:
+        stream.seek(0)
+        while length > 0:
+            data = stream.read(min(self.batch_size, length))
+            if not data:
+                break
+            checksums.update(data)
+            length -= len(data)
+
+    def checksum_manifest(self, file_name: str) -> Dict:
+        if not self.compute_checksums:
+            raise ValueError("Checksums were not computed during encryption")
+        return build_checksum_manifest(file_name, self.unencrypted_checksums, self.encrypted_checksums)
+
+    def write_checksum_manifest(self, manifest_path: str, file_name: str) -> None:
+        write_checksum_manifest(manifest_path, self.checksum_manifest(file_name))
+
+
+def _encrypt_file_with_subprocess(aggregation_path: str, crypt4gh_encryption_key: str, output_file: str) -> None:
     command = f'crypt4gh encrypt --recipient_pk {crypt4gh_encryption_key} < {aggregation_path} > {output_file}'
 
     try:
@@ -24,20 +269,334 @@ def encrypt_file(aggregation_path, crypt4gh_encryption_key):
         raise RuntimeError(f"Error encrypting file: {e.stderr.decode()}") from e
 
 
+def _encrypt_file_natively(
+        aggregation_path: str,
+        crypt4gh_encryption_key: str,
+        output_file: str,
+        workers: Optional[int],
+        checksum_manifest: Optional[str],
+        resumable: bool,
+        cache_path: Optional[str],
+) -> None:
+    # Checksums are always computed when caching, since they're stored alongside the cached ciphertext
+    encryptor = Crypt4ghEncryptor(
+        crypt4gh_encryption_key, workers=workers, compute_checksums=bool(checksum_manifest or cache_path)
+    )
+
+    cache = None
+    if cache_path:
+        # Like a cache miss, not being able to key the cache (e.g. reading the input's checksum) never fails encryption
+        try:
+            cache = EncryptedOutputCache(cache_path)
+            cache_key = cache.cache_key(input_checksum(aggregation_path), encryptor.recipient_public_key)
+        except Exception as e:
+            logging.warning(f"Unable to look up {aggregation_path} in the cache, encrypting it without the cache: {e}")
+            cache = None
+        if cache and (cached_manifest := cache.fetch(cache_key, output_file)):
+            if checksum_manifest:
+                write_checksum_manifest(checksum_manifest, cached_manifest)
+            return
+
+    try:
+        if resumable:
+            checkpoint = EncryptionCheckpoint(
+                f"{output_file}.checkpoint.json", aggregation_path, encryptor.recipient_public_key
+            )
+            encryptor.encrypt_resumably(aggregation_path, output_file, checkpoint)
+        else:
+            with open_source(aggregation_path) as infile, open(output_file, "wb") as outfile:
+                encryptor.encrypt(infile, outfile)
+    except Exception as e:
+        raise RuntimeError(f"Error encrypting file: {str(e)}") from e
+
+    if checksum_manifest:
+        encryptor.write_checksum_manifest(checksum_manifest, output_file)
+    if cache:
+        cache.store_output(cache_key, output_file, encryptor.checksum_manifest(output_file))
+
+
+def encrypt_file(
+        aggregation_path,
+        crypt4gh_encryption_key,
+        engine="subprocess",
+        workers=None,
+        checksum_manifest=None,
+        resumable=False,
+        cache_path=None,
+):
+    """
+    Encrypts the given data file using crypt4gh.
+
+    Parameters:
+    - aggregation_path (str): The file to encrypt. A gs:// path is read in place without copying it to local disk
+      first. Only supported by the native engine.
+    - crypt4gh_encryption_key (str): The key supplied by EGA.
+    - engine (str): "subprocess" to use the crypt4gh CLI (the default), or "native" to encrypt in-process on a pool of
+      workers.
+    - workers (int): The number of worker processes used by the native engine. Defaults to the number of CPUs.
+    - checksum_manifest (str): If provided, the MD5 and SHA-256 of the plaintext and ciphertext are computed while
+      encrypting and written to this path. Only supported by the native engine.
+    - resumable (bool): Checkpoint progress to <output file>.checkpoint.json and resume from the last checkpoint if
+      an earlier run was interrupted. Only supported by the native engine.
+    - cache_path (str): A local directory or gs:// path holding previously encrypted outputs. If the same input was
+      already encrypted for the same recipient, the cached ciphertext is reused. Only supported by the native engine.
+    """
+    output_file = os.path.basename(aggregation_path)
+
+    if engine == "native":
+        _encrypt_file_natively(
+            aggregation_path, crypt4gh_encryption_key, output_file, workers, checksum_manifest, resumable, cache_path
+        )
+    elif engine == "subprocess":
+        if checksum_manifest or resumable or cache_path or is_gcs_path(aggregation_path):
+            raise ValueError(
+                "Checksum manifests, resumable encryption, caching and gs:// inputs are only supported by the native "
+                "engine"
+            )
+        _encrypt_file_with_subprocess(aggregation_path, crypt4gh_encryption_key, output_file)
+    else:
+        raise ValueError(f"Expected engine to be one of {ENCRYPTION_ENGINES}, instead received {engine}")
+
+
+def _encrypt_file_in_batch(
+        aggregation_path: str,
+        crypt4gh_encryption_key: str,
+        write_checksum_manifest: bool,
+        engine: str,
+        resumable: bool,
+        cache_path: Optional[str],
+) -> Dict:
+    """Encrypts one file of a batch and reports how it went. Runs inside a worker process."""
+    output_file = os.path.basename(aggregation_path)
+    checksum_manifest = f"{output_file}.checksums.json" if write_checksum_manifest else None
+    start = time.perf_counter()
+    input_size = 0
+    try:
+        input_size = source_size(aggregation_path)
+        # Files are encrypted in parallel with each other, so each file only gets a single worker
+        encrypt_file(
+            aggregation_path,
+            crypt4gh_encryption_key,
+            engine=engine,
+            workers=1,
+            checksum_manifest=checksum_manifest,
+            resumable=resumable,
+            cache_path=cache_path,
+        )
+        status, error = "succeeded", ""
+    except Exception as e:
+        status, error = "failed", str(e)
+    return {
+        "aggregation_path": aggregation_path,
+        "encrypted_data_file": output_file,
+        "status": status,
+        "bytes": input_size,
+        "seconds": round(time.perf_counter() - start, 3),
+        "error": error,
+    }
+
+
+def encrypt_files_in_batch(
+        aggregation_paths: List[str],
+        crypt4gh_encryption_key: str,
+        max_concurrent_files: Optional[int] = None,
+        results_tsv: str = "encryption_results.tsv",
+        write_checksum_manifests: bool = False,
+        engine: str = "subprocess",
+        resumable: bool = False,
+        cache_path: Optional[str] = None,
+) -> List[Dict]:
+    """
+    Encrypts many data files concurrently on a pool of worker processes, one file per worker. Each worker only holds a
+    couple of batches in memory, so memory use is bounded by the number of concurrent files. Before a file is started,
+    the size of its encrypted output is reserved against the free disk space; if the disk can't hold it once the files
+    already in flight are done, the file is reported as failed instead of running out of disk halfway through.
+    Per-file status and timing are written to `results_tsv`. Each file is encrypted with `encrypt_file`, using the
+    given `engine`, `resumable` and `cache_path`.
+    """
+    if engine not in ENCRYPTION_ENGINES:
+        raise ValueError(f"Expected engine to be one of {ENCRYPTION_ENGINES}, instead received {engine}")
+    if engine == "subprocess" and (write_checksum_manifests or resumable or cache_path):
+        raise ValueError("Checksum manifests, resumable encryption and caching are only supported by the native engine")
+
+    output_files = [os.path.basename(path) for path in aggregation_paths]
+    if len(set(output_files)) != len(output_files):
+        raise ValueError("Expected all files in the batch to have unique file names")
+
+    max_concurrent_files = max_concurrent_files or os.cpu_count() or 1
+    logging.info(f"Encrypting {len(aggregation_paths)} files with up to {max_concurrent_files} files at a time")
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_concurrent_files) as executor:
+        reserved_bytes = {}
+
+        def collect(futures) -> None:
+            for future in futures:
+                result = future.result()
+                results[result["aggregation_path"]] = result
+                reserved_bytes.pop(future)
+                logging.info(f"Encrypting {result['aggregation_path']} {result['status']} in {result['seconds']}s")
+
+        for aggregation_path in aggregation_paths:
+            try:
+                required_bytes = expected_encrypted_size(source_size(aggregation_path))
+            except Exception as e:
+                results[aggregation_path] = _batch_failure(aggregation_path, str(e))
+                continue
+
+            # Wait for files in flight to finish until there is room on disk for this one
+            while reserved_bytes and shutil.disk_usage(".").free - sum(reserved_bytes.values()) < required_bytes:
+                done, _ = wait(reserved_bytes, return_when=FIRST_COMPLETED)
+                collect(done)
+            if shutil.disk_usage(".").free - sum(reserved_bytes.values()) < required_bytes:
+                results[aggregation_path] = _batch_failure(
+                    aggregation_path, f"Not enough disk space for the {required_bytes} byte encrypted file"
+                )
+                continue
+
+            future = executor.submit(
+                _encrypt_file_in_batch,
+                aggregation_path,
+                crypt4gh_encryption_key,
+                write_checksum_manifests,
+                engine,
+                resumable,
+                cache_path,
+            )
+            reserved_bytes[future] = required_bytes
+
+        collect(list(reserved_bytes))
+
+    ordered_results = [results[path] for path in aggregation_paths]
+    _write_batch_results(ordered_results, results_tsv)
+
+    failed = [result["aggregation_path"] for result in ordered_results if result["status"] != "succeeded"]
+    if failed:
+        logging.error(f"Failed to encrypt {len(failed)} of {len(ordered_results)} files: {', '.join(failed)}")
+    return ordered_results
+
+
+def _batch_failure(aggregation_path: str, error: str) -> Dict:
+    logging.error(f"Not encrypting {aggregation_path}: {error}")
+    return {
+        "aggregation_path": aggregation_path,
+        "encrypted_data_file": os.path.basename(aggregation_path),
+        "status": "failed",
+        "bytes": 0,
+        "seconds": 0,
+        "error": error,
+    }
+
+
+def _write_batch_results(results: List[Dict], results_tsv: str) -> None:
+    logging.info(f"Writing per-file encryption status and timing to {results_tsv}")
+    with open(results_tsv, "w") as tsv_file:
+        writer = DictWriter(tsv_file, fieldnames=BATCH_RESULTS_FIELDNAMES, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def read_aggregation_paths(aggregation_paths_file: str) -> List[str]:
+    """Reads a manifest with one path to encrypt per line"""
+    with open(aggregation_paths_file) as manifest:
+        return [line.strip() for line in manifest if line.strip()]
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Encrypt the given data file using crypt4gh"
     )
-    parser.add_argument(
-        "--aggregation_path", required=True, help="The file to encrypt"
+    input_files = parser.add_mutually_exclusive_group(required=True)
+    input_files.add_argument(
+        "--aggregation_path", help="The file to encrypt. A gs:// path is streamed without localizing it first."
+    )
+    input_files.add_argument(
+        "--aggregation_paths_file",
+        help="A manifest with one path per line. All files are encrypted concurrently in batch mode."
     )
     parser.add_argument(
         "--crypt4gh_encryption_key", required=True, help="The key supplied by EGA"
     )
+    parser.add_argument(
+        "--engine",
+        required=False,
+        default="subprocess",
+        choices=ENCRYPTION_ENGINES,
+        help="Shell out to the crypt4gh CLI (subprocess), or encrypt in-process on a pool of workers (native). The "
+             "checksum manifest, resumable and cache options need the native engine."
+    )
+    parser.add_argument(
+        "--workers",
+        required=False,
+        type=int,
+        default=None,
+        help="The number of worker processes used by the native engine. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--checksum_manifest",
+        required=False,
+        default=None,
+        help="If provided, write the checksums of the unencrypted and encrypted file to this path"
+    )
+    parser.add_argument(
+        "--resumable",
+        action="store_true",
+        help="Checkpoint progress so that an interrupted encryption picks up where it left off when re-run"
+    )
+    parser.add_argument(
+        "--encrypted_output_cache",
+        required=False,
+        default=None,
+        help="A local directory or gs:// path used to cache encrypted outputs, so that identical inputs for the same "
+             "recipient key are not encrypted again"
+    )
+    parser.add_argument(
+        "--max_concurrent_files",
+        required=False,
+        type=int,
+        default=None,
+        help="Batch mode only. The number of files encrypted at the same time. Defaults to the number of CPUs."
+    )
+    parser.add_argument(
+        "--results_tsv",
+        required=False,
+        default="encryption_results.tsv",
+        help="Batch mode only. Where to write the status and timing of each file."
+    )
+    parser.add_argument(
+        "--write_checksum_manifests",
+        action="store_true",
+        help="Batch mode only. Write a <file name>.checksums.json manifest next to each encrypted file."
+    )
     args = parser.parse_args()
+    if args.aggregation_paths_file and (args.workers or args.checksum_manifest):
+        parser.error(
+            "--workers and --checksum_manifest only apply to a single file. In batch mode each file is encrypted by "
+            "a single worker, and --write_checksum_manifests writes a manifest per file."
+        )
 
     logging.info("Starting script to encrypt data file")
 
-    encrypt_file(args.aggregation_path, args.crypt4gh_encryption_key)
+    if args.aggregation_paths_file:
+        encrypt_files_in_batch(
+            aggregation_paths=read_aggregation_paths(args.aggregation_paths_file),
+            crypt4gh_encryption_key=args.crypt4gh_encryption_key,
+            max_concurrent_files=args.max_concurrent_files,
+            results_tsv=args.results_tsv,
+            write_checksum_manifests=args.write_checksum_manifests,
+            engine=args.engine,
+            resumable=args.resumable,
+            cache_path=args.encrypted_output_cache,
+        )
+    else:
+        encrypt_file(
+            args.aggregation_path,
+            args.crypt4gh_encryption_key,
+            engine=args.engine,
+            workers=args.workers,
+            checksum_manifest=args.checksum_manifest,
+            resumable=args.resumable,
+            cache_path=args.encrypted_output_cache,
+        )
 
     logging.info("Script finished")
@@ -0,0 +1,152 @@
+"""
+    Content-addressed cache of crypt4gh encrypted outputs. Entries are keyed by the checksum of the unencrypted input
+    and a fingerprint of the recipient public key, so re-running an encryption of the same data for the same recipient
+    (e.g. after a failed upload) can reuse the ciphertext and its checksums instead of encrypting again.
+    The cache can live in a local directory or under a gs:// path.
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import Dict, Optional
+
+from google.cloud import storage
+
+from scripts.utils import StreamChecksums
+from scripts.source_readers import get_storage_client, open_source, source_content_id
+
+CHECKSUM_READ_SIZE = 4 * 1024 * 1024
+
+
+def _stream_checksums(path: str) -> StreamChecksums:
+    checksums = StreamChecksums()
+    with open_source(path) as infile:
+        while data := infile.read(CHECKSUM_READ_SIZE):
+            checksums.update(data)
+    return checksums
+
+
+def input_checksum(aggregation_path: str) -> str:
+    """
+    Returns a checksum of the file to encrypt, to key the cache with. A gs:// input is identified by the checksums GCS
+    keeps for the object, without reading it. Anything else is read and hashed, rather than trusting an .md5 file next
+    to it, which nothing ties to the file's current content.
+    """
+    if content_id := source_content_id(aggregation_path):
+        return content_id
+    return _stream_checksums(aggregation_path).md5.hexdigest()
+
+
+class _LocalCacheStore:
+    def __init__(self, cache_path: str) -> None:
+        self.cache_path = cache_path
+        os.makedirs(cache_path, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.cache_path, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def download(self, name: str, destination: str) -> None:
+        shutil.copyfile(self._path(name), destination)
+
+    def upload(self, source: str, name: str) -> None:
+        # Copy to a temporary name first so that a partially copied entry is never visible
+        temporary_path = self._path(f"{name}.tmp")
+        shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, self._path(name))
+
+    def read_text(self, name: str) -> str:
+        with open(self._path(name)) as f:
+            return f.read()
+
+    def write_text(self, text: str, name: str) -> None:
+        temporary_path = self._path(f"{name}.tmp")
+        with open(temporary_path, "w") as f:
+            f.write(text)
+        os.replace(temporary_path, self._path(name))
+
+
+class _GcsCacheStore:
+    def __init__(self, cache_path: str) -> None:
+        bucket_name, _, prefix = cache_path.removeprefix("gs://").partition("/")
+        self.bucket = get_storage_client().bucket(bucket_name)
+        self.prefix = prefix.strip("/")
+
+    def _blob(self, name: str) -> storage.Blob:
+        return self.bucket.blob(f"{self.prefix}/{name}" if self.prefix else name)
+
+    def exists(self, name: str) -> bool:
+        return self._blob(name).exists()
+
+    def download(self, name: str, destination: str) -> None:
+        self._blob(name).download_to_filename(destination)
+
+    def upload(self, source: str, name: str) -> None:
+        # GCS uploads are atomic, the object only becomes visible once it's complete
+        self._blob(name).upload_from_filename(source)
+
+    def read_text(self, name: str) -> str:
+        return self._blob(name).download_as_text()
+
+    def write_text(self, text: str, name: str) -> None:
+        self._blob(name).upload_from_string(text)
+
+
+class EncryptedOutputCache:
+    """
+    Stores an encrypted file as <key>.c4gh next to its checksum manifest <key>.checksums.json. The manifest is written
+    last, so an entry only counts as a hit once both are complete.
+    """
+
+    def __init__(self, cache_path: str) -> None:
+        self.cache_path = cache_path
+        self.store = _GcsCacheStore(cache_path) if cache_path.startswith("gs://") else _LocalCacheStore(cache_path)
+
+    @staticmethod
+    def cache_key(input_checksum: str, recipient_public_key: bytes) -> str:
+        recipient_fingerprint = hashlib.sha256(recipient_public_key).hexdigest()
+        return f"{input_checksum}-{recipient_fingerprint}"
+
+    def fetch(self, cache_key: str, output_file: str) -> Optional[Dict]:
+        """
+        Copies the cached ciphertext to `output_file` and returns its checksum manifest, or None on a miss or if the
+        ciphertext doesn't match the manifest
+        """
+        manifest_name = f"{cache_key}.checksums.json"
+        try:
+            if not self.store.exists(manifest_name):
+                logging.info(f"No encrypted output cached under {cache_key} in {self.cache_path}")
+                return None
+
+            manifest = json.loads(self.store.read_text(manifest_name))
+            self.store.download(f"{cache_key}.c4gh", output_file)
+            # The manifest's checksums are handed on as if they were computed while encrypting, so make sure the
+            # cached ciphertext still matches them
+            checksums = _stream_checksums(output_file)
+            if (
+                    checksums.size != manifest["encrypted"]["size"]
+                    or checksums.md5.hexdigest() != manifest["encrypted"]["md5"]
+            ):
+                logging.warning(
+                    f"Cached encrypted output {cache_key} doesn't match its checksum manifest. Ignoring it."
+                )
+                return None
+        except Exception as e:
+            logging.warning(f"Unable to read encrypted output {cache_key} from the cache: {str(e)}")
+            return None
+
+        logging.info(f"Reusing cached encrypted output {cache_key} from {self.cache_path}")
+        manifest["file_name"] = os.path.basename(output_file)
+        return manifest
+
+    def store_output(self, cache_key: str, output_file: str, manifest: Dict) -> None:
+        """Adds the encrypted file to the cache. Failing to do so never fails the encryption itself."""
+        try:
+            self.store.upload(output_file, f"{cache_key}.c4gh")
+            self.store.write_text(json.dumps(manifest, indent=2), f"{cache_key}.checksums.json")
+            logging.info(f"Stored encrypted output {cache_key} in {self.cache_path}")
+        except Exception as e:
+            logging.warning(f"Unable to store encrypted output {cache_key} in the cache: {str(e)}")
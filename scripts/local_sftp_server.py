@@ -0,0 +1,268 @@
+"""
+    A local, password authenticated paramiko SFTP server for benchmarking the inbox transfer code without touching the
+    EGA inbox. Files are served from a local directory. An optional proxy delays traffic in both directions to mimic
+    the round trip time of a transatlantic link without limiting its bandwidth.
+"""
+import os
+import time
+import heapq
+import socket
+import logging
+import threading
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+from paramiko.common import DEFAULT_MAX_PACKET_SIZE, DEFAULT_WINDOW_SIZE
+
+
+class _LocalSftpHandle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _LocalSftpServerInterface(SFTPServerInterface):
+    def __init__(self, server, root: str, *args, **kwargs) -> None:
+        super().__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _local_path(self, path: str) -> str:
+        return self.root + self.canonicalize(path)
+
+    def list_folder(self, path):
+        local_path = self._local_path(path)
+        try:
+            attributes = []
+            for file_name in os.listdir(local_path):
+                attribute = SFTPAttributes.from_stat(os.stat(os.path.join(local_path, file_name)))
+                attribute.filename = file_name
+                attributes.append(attribute)
+            return attributes
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._local_path(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        local_path = self._local_path(path)
+        try:
+            file_descriptor = os.open(local_path, flags, getattr(attr, "st_mode", None) or 0o666)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _LocalSftpHandle(flags)
+        handle.filename = local_path
+        handle.readfile = handle.writefile = os.fdopen(file_descriptor, mode)
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local_path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.replace(self._local_path(oldpath), self._local_path(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self._local_path(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+class _PasswordServerInterface(paramiko.ServerInterface):
+    def __init__(self, username: str, password: str) -> None:
+        self.username = username
+        self.password = password
+
+    def check_auth_password(self, username, password):
+        if username == self.username and password == self.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class LocalSftpServer:
+    """
+    Serves `root` over SFTP on 127.0.0.1 in background threads. Use it as a context manager; the port it listens on
+    is available as `port` once it has started. `window_size` is the SSH channel window the server advertises, which
+    is what limits how much a client can upload before waiting for the window to be adjusted. With `compression`, the
+    server agrees to compress traffic if the client asks for it.
+    """
+
+    def __init__(
+            self,
+            root: str,
+            username: str,
+            password: str,
+            port: int = 0,
+            window_size: int = DEFAULT_WINDOW_SIZE,
+            max_packet_size: int = DEFAULT_MAX_PACKET_SIZE,
+            compression: bool = False,
+    ) -> None:
+        self.root = os.path.abspath(root)
+        self.window_size = window_size
+        self.max_packet_size = max_packet_size
+        self.compression = compression
+        self.username = username
+        self.password = password
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.port = self.listener.getsockname()[1]
+        self.transports = []
+        self.stopped = threading.Event()
+
+    def _accept_connections(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(
+                client, default_window_size=self.window_size, default_max_packet_size=self.max_packet_size
+            )
+            transport.add_server_key(self.host_key)
+            transport.use_compression(self.compression)
+            transport.set_subsystem_handler("sftp", SFTPServer, _LocalSftpServerInterface, root=self.root)
+            transport.start_server(server=_PasswordServerInterface(self.username, self.password))
+            self.transports.append(transport)
+
+    def __enter__(self) -> "LocalSftpServer":
+        self.listener.listen(64)
+        threading.Thread(target=self._accept_connections, daemon=True).start()
+        logging.info(f"Serving {self.root} over SFTP on 127.0.0.1:{self.port}")
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.listener.close()
+        for transport in self.transports:
+            transport.close()
+
+
+class LatencyProxy:
+    """
+    Forwards TCP connections from a local port to `target_port`, delaying every chunk of data in each direction by
+    `one_way_delay_seconds`. Data is delayed rather than throttled, so many requests can still be in flight at once,
+    just like on a long, fat network link.
+    """
+
+    def __init__(self, target_port: int, one_way_delay_seconds: float, port: int = 0) -> None:
+        self.target_port = target_port
+        self.one_way_delay_seconds = one_way_delay_seconds
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(("127.0.0.1", port))
+        self.port = self.listener.getsockname()[1]
+        self.stopped = threading.Event()
+
+    def _forward(self, source: socket.socket, destination: socket.socket) -> None:
+        # Chunks are released in arrival order once their delay has elapsed
+        delayed_chunks = []
+        condition = threading.Condition()
+        sequence = 0
+
+        def release() -> None:
+            while True:
+                with condition:
+                    while not delayed_chunks:
+                        condition.wait()
+                    release_time, _, data = delayed_chunks[0]
+                    wait_time = release_time - time.monotonic()
+                    if wait_time > 0:
+                        condition.wait(wait_time)
+                        continue
+                    heapq.heappop(delayed_chunks)
+                try:
+                    if data is None:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=release, daemon=True).start()
+        while True:
+            try:
+                data = source.recv(256 * 1024)
+            except OSError:
+                data = b""
+            with condition:
+                heapq.heappush(
+                    delayed_chunks, (time.monotonic() + self.one_way_delay_seconds, sequence, data or None)
+                )
+                sequence += 1
+                condition.notify()
+            if not data:
+                return
+
+    def _accept_connections(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            threading.Thread(target=self._forward, args=(client, upstream), daemon=True).start()
+            threading.Thread(target=self._forward, args=(upstream, client), daemon=True).start()
+
+    def __enter__(self) -> "LatencyProxy":
+        self.listener.listen(64)
+        threading.Thread(target=self._accept_connections, daemon=True).start()
+        logging.info(
+            f"Forwarding 127.0.0.1:{self.port} to port {self.target_port} with a "
+            f"{self.one_way_delay_seconds * 1000:.0f} ms one-way delay"
+        )
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stopped.set()
+        self.listener.close()
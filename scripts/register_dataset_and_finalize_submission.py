@@ -16,21 +16,26 @@
         https://submission.ega-archive.org/api/spec/#/
 """
 import sys
+import asyncio
 import argparse
-import requests
 import logging
 from datetime import datetime, timedelta, timezone
-from typing import Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 
 sys.path.append("./")
 from scripts.utils import (
+    EgaApiClient,
     LoginAndGetToken,
     SecretManager,
     SUBMISSION_PROTOCOL_API_URL,
     format_request_header,
+    get_ega_api_client,
     VALID_STATUS_CODES,
+    iter_api_list,
     logging_configurator,
 )
+from scripts.async_ega_api_client import AsyncEgaApiClient, DEFAULT_MAX_CONCURRENCY
+from scripts.submission_snapshot import SubmissionSnapshot
 
 
 class RegisterEgaDatasetAndFinalizeSubmission:
@@ -44,9 +49,13 @@ class RegisterEgaDatasetAndFinalizeSubmission:
             run_provisional_ids: list[int],
             expected_release_date: str,
             dataset_title: Optional[str],
-            dataset_description: Optional[str]
+            dataset_description: Optional[str],
+            client: Optional[EgaApiClient] = None,
+            snapshot: Optional[SubmissionSnapshot] = None,
     ):
         self.token = token
+        self.client = client or get_ega_api_client()
+        self.snapshot = snapshot
         self.submission_accession_id = submission_accession_id
         self.policy_title = policy_title
         self.library_strategy = library_strategy
@@ -58,66 +67,74 @@ class RegisterEgaDatasetAndFinalizeSubmission:
     def _headers(self) -> dict:
         return format_request_header(self.token)
 
-    def _get_policy_accession_id(self) -> Optional[str]:
+    def _iter_policies(self) -> Iterator[Dict]:
         """
         Collects all policy metadata
         Endpoint documentation located here:
         https://submission.ega-archive.org/api/spec/#/paths/policies/get
         """
-
-        response = requests.get(
+        return iter_api_list(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/policies",
             headers=self._headers(),
+            description="policies",
+            client=self.client,
         )
-        if response.status_code in VALID_STATUS_CODES:
-            policy_accession_id = [a["accession_id"] for a in response.json() if a["title"] == self.policy_title]
-            if not policy_accession_id:
-                raise ValueError(
-                    f"Expected to find one DAC, but found zero for policy {self.policy_title}"
-                )
-            if len(policy_accession_id) > 1:
-                raise ValueError(
-                    f"Expected to find one DAC, but found {len(policy_accession_id)} for policy {self.policy_title}"
-                )
-            logging.info("Successfully retrieved policy DAC")
-            return policy_accession_id[0]
-        else:
-            error_message = f"""Received status code {response.status_code} with error: {response.text} 
-            while attempting to get policy accession ID"""
-            logging.error(error_message)
-            raise Exception(error_message)
 
-    def _dataset_exists(self, policy_accession_id: str, dataset_title: str) -> Optional[str]:
+    def _get_policy_accession_id(self, policies: Optional[Iterable[Dict]] = None) -> Optional[str]:
+        """Finds the policy by its title in `policies`, or in all policies if they weren't already fetched"""
+        if policies is None:
+            policies = self._iter_policies()
+
+        policy_accession_id = [a["accession_id"] for a in policies if a["title"] == self.policy_title]
+        if not policy_accession_id:
+            raise ValueError(
+                f"Expected to find one DAC, but found zero for policy {self.policy_title}"
+            )
+        if len(policy_accession_id) > 1:
+            raise ValueError(
+                f"Expected to find one DAC, but found {len(policy_accession_id)} for policy {self.policy_title}"
+            )
+        logging.info("Successfully retrieved policy DAC")
+        return policy_accession_id[0]
+
+    def _iter_datasets(self) -> Iterator[Dict]:
         """
         Gets existing datasets in the submission
         Endpoint documentation located here:
         https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--datasets/get
         """
-        response = requests.get(
+        if self.snapshot:
+            return iter(self.snapshot.objects("datasets"))
+        return iter_api_list(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_id}/datasets",
             headers=self._headers(),
+            description="existing datasets",
+            client=self.client,
         )
-        if response.status_code in VALID_STATUS_CODES:
-            all_datasets = response.json()
-            for dataset in all_datasets:
-                if dataset["policy_accession_id"] == policy_accession_id and dataset["title"] == dataset_title:
-                    logging.info(
-                        f"Dataset with title {dataset_title} associated with policy {policy_accession_id} already "
-                        f"exists. Will not attempt to re-create it."
-                    )
-                    return dataset["provisional_id"]
-            logging.info(
-                f"Dataset with title {dataset_title} associated with policy {policy_accession_id} does not exist. "
-                f"Will attempt to create it now."
-            )
-            return None
-        else:
-            error_message = f"""Received status code {response.status_code} with error: {response.text} while 
-            attempting to query existing datasets"""
-            logging.error(error_message)
-            raise Exception(error_message)
 
-    def _conditionally_create_dataset(self, policy_accession_id: str) -> Optional[str]:
+    def _dataset_exists(
+            self, policy_accession_id: str, dataset_title: str, all_datasets: Optional[Iterable[Dict]] = None
+    ) -> Optional[str]:
+        """Looks for the dataset in `all_datasets`, or in the submission if they weren't already fetched"""
+        if all_datasets is None:
+            all_datasets = self._iter_datasets()
+
+        for dataset in all_datasets:
+            if dataset["policy_accession_id"] == policy_accession_id and dataset["title"] == dataset_title:
+                logging.info(
+                    f"Dataset with title {dataset_title} associated with policy {policy_accession_id} already "
+                    f"exists. Will not attempt to re-create it."
+                )
+                return dataset["provisional_id"]
+        logging.info(
+            f"Dataset with title {dataset_title} associated with policy {policy_accession_id} does not exist. "
+            f"Will attempt to create it now."
+        )
+        return None
+
+    def _conditionally_create_dataset(
+            self, policy_accession_id: str, all_datasets: Optional[Iterable[Dict]] = None
+    ) -> Optional[str]:
         """
         Registers the dataset of runs
         Endpoint documentation located here:
@@ -136,11 +153,17 @@ class RegisterEgaDatasetAndFinalizeSubmission:
         else:
             raise Exception(f"Expected library strategy to be one of 'WGS' or 'WXS', instead received {strategy}")
 
-        if dataset_provisional_id := self._dataset_exists(policy_accession_id, self.dataset_title):
+        if dataset_provisional_id := self._dataset_exists(policy_accession_id, self.dataset_title, all_datasets):
+            return dataset_provisional_id
+
+        # The snapshot may be a few minutes old, so make sure the dataset wasn't just created
+        if self.snapshot and (dataset_provisional_id := self._dataset_exists(
+                policy_accession_id, self.dataset_title, self.snapshot.objects("datasets", force_refresh=True)
+        )):
             return dataset_provisional_id
 
         logging.info("Attempting to create dataset.")
-        response = requests.post(
+        response = self.client.post(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_id}/datasets",
             headers=self._headers(),
             json={
@@ -154,6 +177,8 @@ class RegisterEgaDatasetAndFinalizeSubmission:
         
         if response.status_code in VALID_STATUS_CODES:
             dataset_provisional_id = [r["provisional_id"] for r in response.json()][0]
+            if self.snapshot:
+                self.snapshot.invalidate("datasets")
             logging.info("Successfully registered dataset!")
             return dataset_provisional_id
         else:
@@ -183,7 +208,7 @@ class RegisterEgaDatasetAndFinalizeSubmission:
             release_date = expected_release_date.strftime("%Y-%m-%d")
 
         logging.info("Attempting to finalize submission")
-        response = requests.post(
+        response = self.client.post(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_id}/finalise",
             headers=self._headers(),
             json={
@@ -200,13 +225,26 @@ class RegisterEgaDatasetAndFinalizeSubmission:
             logging.error(error_message)
             raise Exception(error_message)
 
+    async def fetch_existing_metadata(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> Dict[str, List[Dict]]:
+        """Fetches the policies and the submission's datasets (from the snapshot if there is one) concurrently"""
+        async_client = AsyncEgaApiClient(self.token, max_concurrency=max_concurrency, client=self.client)
+        policies, datasets = await asyncio.gather(
+            async_client.get_policies(),
+            asyncio.to_thread(self.snapshot.objects, "datasets") if self.snapshot
+            else async_client.get_datasets(self.submission_accession_id),
+        )
+        return {"policies": policies, "datasets": datasets}
+
     def register_metadata(self):
+        existing_metadata = asyncio.run(self.fetch_existing_metadata())
         # Get the policy accession ID using the policy title provided bu the user
-        policy_accession_id = self._get_policy_accession_id()
+        policy_accession_id = self._get_policy_accession_id(policies=existing_metadata["policies"])
         # If the policy accession is successfully collected, conditionally register the dataset if it doesn't already
         # exist
         if policy_accession_id:
-            dataset_provisional_id = self._conditionally_create_dataset(policy_accession_id)
+            dataset_provisional_id = self._conditionally_create_dataset(
+                policy_accession_id, all_datasets=existing_metadata["datasets"]
+            )
             # If the dataset gets successfully created, finalize the submission
             if dataset_provisional_id:
                 # self._finalize_submission()
@@ -262,6 +300,13 @@ if __name__ == '__main__':
         required=True,
         help="The expected date of release of the submission."
     )
+    parser.add_argument(
+        "-snapshot_path",
+        required=False,
+        default=None,
+        help="A SQLite file to cache the submission's metadata in, such as the one a batch registration of "
+             "experiments and runs used on the same machine. If not provided, the metadata is fetched from the EGA."
+    )
 
     args = parser.parse_args()
     library_strategies_list = args.library_strategy.split(",")
@@ -272,6 +317,11 @@ if __name__ == '__main__':
     access_token = LoginAndGetToken(username=args.user_name, password=password).login_and_get_token()
     if access_token:
         logging.info("Successfully generated access token. Will continue with dataset registration now.")
+        submission_snapshot = SubmissionSnapshot(
+            path=args.snapshot_path,
+            submission_accession_or_provisional_id=args.submission_accession_id,
+            token=access_token,
+        ) if args.snapshot_path else None
         RegisterEgaDatasetAndFinalizeSubmission(
             token=access_token,
             submission_accession_id=args.submission_accession_id,
@@ -281,4 +331,5 @@ if __name__ == '__main__':
             dataset_title=args.dataset_title,
             dataset_description=args.dataset_description,
             expected_release_date=args.expected_release_date,
+            snapshot=submission_snapshot,
         ).register_metadata()
@@ -16,24 +16,32 @@
         https://submission.ega-archive.org/api/spec/#/
 """
 import sys
+import time
+import asyncio
 import argparse
-import requests
 import logging
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
 from csv import DictWriter
 
 sys.path.append("./")
 from scripts.utils import (
+    EgaApiClient,
+    InboxFileIndex,
     LoginAndGetToken,
     SecretManager,
     SUBMISSION_PROTOCOL_API_URL,
     format_request_header,
+    get_ega_api_client,
     normalize_sample_alias,
     VALID_STATUS_CODES,
+    files_for_sample,
     get_file_metadata_for_one_sample_in_inbox,
+    iter_api_list,
     logging_configurator,
 )
+from scripts.async_ega_api_client import AsyncEgaApiClient, DEFAULT_MAX_CONCURRENCY
+from scripts.submission_snapshot import SubmissionSnapshot
 from scripts import (
     LIBRARY_LAYOUT,
     LIBRARY_STRATEGY,
@@ -43,6 +51,8 @@ from scripts import (
     INSTRUMENT_MODEL_MAPPING,
 )
 
+T = TypeVar("T")
+
 
 class RegisterEgaExperimentsAndRuns:
 
@@ -66,8 +76,16 @@ class RegisterEgaExperimentsAndRuns:
             library_construction_protocol: str,
             sample_id: str,
             technology: Optional[str],
+            client: Optional[EgaApiClient] = None,
+            inbox_index: Optional[InboxFileIndex] = None,
+            snapshot: Optional[SubmissionSnapshot] = None,
     ):
         self.token = token
+        self.client = client or get_ega_api_client()
+        # When registering many samples, list the inbox once and share the index instead of querying it per sample
+        self.inbox_index = inbox_index
+        # Answer the existence checks from a local snapshot of the submission instead of listing it every time
+        self.snapshot = snapshot
         self.submission_accession_or_provisional_id = submission_accession_or_provisional_id
         self.study_accession_id = study_accession_id
         self.study_provisional_id = study_provisional_id
@@ -89,71 +107,100 @@ class RegisterEgaExperimentsAndRuns:
     def _headers(self) -> dict:
         return format_request_header(self.token)
 
-    def _experiment_exists(self, design_description: str) -> Optional[str]:
+    def _iter_experiments(self) -> Iterator[Dict]:
         """
         Gets existing experiments in the submission
         Endpoint documentation located here:
         https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--datasets/get
         """
-
-        response = requests.get(
+        if self.snapshot:
+            return iter(self.snapshot.objects("experiments"))
+        return iter_api_list(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/experiments",
             headers=self._headers(),
+            description="existing experiments",
+            client=self.client,
         )
-        if response.status_code in VALID_STATUS_CODES:
-            all_experiments = response.json()
-            for experiment in all_experiments:
-                if ((self.study_accession_id == experiment["study_accession_id"]
-                            or self.study_provisional_id == experiment["study_provisional_id"])
-                        and design_description == experiment["design_description"]):
-                    logging.info(f"Found experiment with description {design_description} already. Won't re-create it!")
-                    return experiment["provisional_id"]
-            return None
-        else:
-            error_message = f"""Received status code {response.status_code} with error: {response.text} while 
-                        attempting to query existing experiments"""
-            logging.error(error_message)
-            raise Exception(error_message)
 
-    def _conditionally_create_experiment(self) -> Optional[str]:
-        """
-        Registers the "experiment"
-        Endpoint documentation located here:
-        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--experiments/post
-        """
+    def _is_experiment(self, experiment: Dict, design_description: str) -> bool:
+        return ((self.study_accession_id == experiment["study_accession_id"]
+                 or self.study_provisional_id == experiment["study_provisional_id"])
+                and design_description == experiment["design_description"])
+
+    def _experiment_exists(
+            self, design_description: str, all_experiments: Optional[Iterable[Dict]] = None
+    ) -> Optional[str]:
+        """Looks for the experiment in `all_experiments`, or in the submission if they weren't already fetched"""
+        if all_experiments is None:
+            all_experiments = self._iter_experiments()
+
+        for experiment in all_experiments:
+            if self._is_experiment(experiment, design_description):
+                logging.info(f"Found experiment with description {design_description} already. Won't re-create it!")
+                return experiment["provisional_id"]
+        return None
+
+    def design_description(self) -> str:
         paired_end_string = "paired-end" if self.library_layout == "PAIRED" else ""
-        design_description = (f"{self.technology} {self.library_strategy} sequencing of {self.sample_material_type} "
-                              f"{paired_end_string} library via {self.library_selection} containing sample "
-                              f"{self.sample_alias}")
+        return (f"{self.technology} {self.library_strategy} sequencing of {self.sample_material_type} "
+                f"{paired_end_string} library via {self.library_selection} containing sample "
+                f"{self.sample_alias}")
 
+    def experiment_payload(self, design_description: str) -> dict:
         nominal_length = int(self.insert_size) if 0 < self.insert_size < 1000 else 0
+        return {
+            "design_description": design_description,
+            "library_name": self.library_name,
+            "library_construction_protocol": self.library_construction_protocol,
+            "paired_nominal_length": nominal_length,
+            "paired_nominal_sdev": self.standard_deviation,
+            "instrument_model_id": self.instrument_model_id,
+            "library_layout": self.library_layout,
+            "library_strategy": self.library_strategy,
+            "library_source": self.library_source,
+            "library_selection": self.library_selection,
+            "study_accession_id": self.study_accession_id,
+            "study_provisional_id": self.study_provisional_id,
+        }
+
+    def _conditionally_create_experiment(self, all_experiments: Optional[Iterable[Dict]] = None) -> Optional[str]:
+        """
+        Registers the "experiment" if it doesn't already exist
+        """
+        design_description = self.design_description()
 
         # Query for existing experiments. If the one we're trying to register already exists, skip re-creating it
         logging.info(f"Checking to see if experiment {design_description} already exists...")
-        if provisional_id := self._experiment_exists(design_description=design_description):
+        if provisional_id := self._experiment_exists(
+                design_description=design_description, all_experiments=all_experiments
+        ):
+            return provisional_id
+
+        # The snapshot may be a few minutes old, so make sure another run hasn't just created the experiment
+        if self.snapshot and (provisional_id := self._experiment_exists(
+                design_description=design_description,
+                all_experiments=self.snapshot.objects("experiments", force_refresh=True),
+        )):
             return provisional_id
 
         logging.info("Experiment did not already exist. Attempting to create it now!")
-        response = requests.post(
+        return self._create_experiment(design_description)
+
+    def _create_experiment(self, design_description: str) -> str:
+        """
+        Registers the "experiment"
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--experiments/post
+        """
+        response = self.client.post(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/experiments",
             headers=self._headers(),
-            json={
-                "design_description": design_description,
-                "library_name": self.library_name,
-                "library_construction_protocol": self.library_construction_protocol,
-                "paired_nominal_length": nominal_length,
-                "paired_nominal_sdev": self.standard_deviation,
-                "instrument_model_id": self.instrument_model_id,
-                "library_layout": self.library_layout,
-                "library_strategy": self.library_strategy,
-                "library_source": self.library_source,
-                "library_selection": self.library_selection,
-                "study_accession_id": self.study_accession_id,
-                "study_provisional_id": self.study_provisional_id,
-            }
+            json=self.experiment_payload(design_description),
         )
         if response.status_code in VALID_STATUS_CODES:
             logging.info(f"Response from creating the experiment {response.json()}")
+            if self.snapshot:
+                self.snapshot.invalidate("experiments")
             provisional_id = [
                 experiment["provisional_id"] for experiment in response.json()
                 if experiment["design_description"] == design_description
@@ -166,7 +213,7 @@ class RegisterEgaExperimentsAndRuns:
             logging.error(error_message)
             raise Exception(error_message)
 
-    def _get_metadata_for_registered_sample(self) -> Optional[dict]:
+    def _iter_registered_samples(self) -> Iterator[Dict]:
         """
         Gets all samples associated with the submission
         Endpoint documentation located here:
@@ -177,33 +224,38 @@ class RegisterEgaExperimentsAndRuns:
             f"id {self.submission_accession_or_provisional_id}"
         )
 
-        response = requests.get(
+        if self.snapshot:
+            return iter(self.snapshot.objects("samples"))
+        return iter_api_list(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/samples",
             headers=self._headers(),
+            description="sample accession IDs",
+            client=self.client,
         )
-        if response.status_code in VALID_STATUS_CODES:
-            registered_samples = response.json()
-
-            for a in registered_samples:
-                if a["alias"] == self.sample_alias:
-                    logging.info(f"Found sample {self.sample_alias} in registered samples metadata! Continuing.")
-                    return {
-                            "sample_alias": a["alias"],
-                            "sample_provisional_id": a["provisional_id"]
-                        }
-            logging.error(
-                f"Could not find {self.sample_alias} in registered sample metadata. It could be that the sample "
-                f"wasn't registered ahead of time, or it was registered with a different alias. We won't be able to "
-                f"register a run for sample {self.sample_alias}"
-            )
-            raise Exception("Expected to find 1 sample registered. Instead found none.")
 
-        else:
-            error_message = f"""Received status code {response.status_code} with error: {response.text} while
-                         attempting to query sample accession IDs"""
-            raise Exception(error_message)
+    def _is_registered_sample(self, registered_sample: Dict) -> bool:
+        return registered_sample["alias"] == self.sample_alias
+
+    def _get_metadata_for_registered_sample(self, registered_samples: Optional[Iterable[Dict]] = None) -> Optional[dict]:
+        """Finds the sample in `registered_samples`, or in the submission if they weren't already fetched"""
+        if registered_samples is None:
+            registered_samples = self._iter_registered_samples()
+
+        for a in registered_samples:
+            if self._is_registered_sample(a):
+                logging.info(f"Found sample {self.sample_alias} in registered samples metadata! Continuing.")
+                return {
+                        "sample_alias": a["alias"],
+                        "sample_provisional_id": a["provisional_id"]
+                    }
+        logging.error(
+            f"Could not find {self.sample_alias} in registered sample metadata. It could be that the sample "
+            f"wasn't registered ahead of time, or it was registered with a different alias. We won't be able to "
+            f"register a run for sample {self.sample_alias}"
+        )
+        raise Exception("Expected to find 1 sample registered. Instead found none.")
 
-    def _run_exists(self, experiment_provisional_id: str, sample_metadata: dict) -> Optional[int]:
+    def _iter_registered_runs(self) -> Iterator[Dict]:
         """
         Collects information on all runs in submission
         Endpoint documentation located here:
@@ -211,37 +263,44 @@ class RegisterEgaExperimentsAndRuns:
         """
         logging.info("Collecting information about existing runs in submission...")
 
-        response = requests.get(
+        if self.snapshot:
+            return iter(self.snapshot.objects("runs"))
+        return iter_api_list(
             url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/runs",
             headers=self._headers(),
+            description="runs",
+            client=self.client,
         )
-        if response.status_code in VALID_STATUS_CODES:
-            registered_runs = response.json()
-
-            sample_alias = sample_metadata["sample_alias"]
-            sample_provisional_id = sample_metadata["sample_provisional_id"]
-
-            for run in registered_runs:
-                run_experiment_provisional_id = run["experiment"]["provisional_id"]
-                run_sample_provisional_id = run["sample"]["provisional_id"]
-                run_sample_alias = run["sample"]["alias"]
-                run_provisional_id = run["provisional_id"]
-
-                if (run_experiment_provisional_id == experiment_provisional_id
-                        and run_sample_provisional_id == sample_provisional_id
-                        and run_sample_alias == sample_alias):
-                    logging.info(
-                        f"Found a registered run with accession ID {run_provisional_id} for {self.sample_alias}. "
-                        f"The run will not be re-created!"
-                    )
-                    return run_provisional_id
-            logging.error(f"Did not find an existing registered run for sample {self.sample_alias}")
-            return None
 
-        else:
-            error_message = f"""Received status code {response.status_code} with error: {response.text} while
-                         attempting to query runs"""
-            raise Exception(error_message)
+    def _is_run_of_sample(self, run: Dict) -> bool:
+        return run["sample"]["alias"] == self.sample_alias
+
+    def _run_exists(
+            self, experiment_provisional_id: str, sample_metadata: dict, registered_runs: Optional[Iterable[Dict]] = None
+    ) -> Optional[int]:
+        """Looks for the run in `registered_runs`, or in the submission if they weren't already fetched"""
+        if registered_runs is None:
+            registered_runs = self._iter_registered_runs()
+
+        sample_alias = sample_metadata["sample_alias"]
+        sample_provisional_id = sample_metadata["sample_provisional_id"]
+
+        for run in registered_runs:
+            run_experiment_provisional_id = run["experiment"]["provisional_id"]
+            run_sample_provisional_id = run["sample"]["provisional_id"]
+            run_sample_alias = run["sample"]["alias"]
+            run_provisional_id = run["provisional_id"]
+
+            if (run_experiment_provisional_id == experiment_provisional_id
+                    and run_sample_provisional_id == sample_provisional_id
+                    and run_sample_alias == sample_alias):
+                logging.info(
+                    f"Found a registered run with accession ID {run_provisional_id} for {self.sample_alias}. "
+                    f"The run will not be re-created!"
+                )
+                return run_provisional_id
+        logging.error(f"Did not find an existing registered run for sample {self.sample_alias}")
+        return None
 
     def _link_files_to_samples(self, file_metadata: List[Dict], sample_metadata: dict) -> dict:
         logging.info(f"Found file metadata. Now attempting to link all files associated with {self.sample_alias}")
@@ -249,21 +308,17 @@ class RegisterEgaExperimentsAndRuns:
         file_provisional_ids = []
         file_names = []
 
-        for file_path in file_metadata:
-            relative_file_path = file_path["relative_path"]
-            file = Path(relative_file_path).name
-            sample_alias_from_path = Path(file).stem
-            normalized_alias = normalize_sample_alias(self.sample_alias)
+        for file_path in files_for_sample(file_metadata, self.sample_alias):
+            file = Path(file_path["relative_path"]).name
 
             # "rename" all files that end with .c4gh since it's not an extension we're using anymore
             file_name = file.strip(".c4gh") if file.endswith(".c4gh") else file
-            if sample_alias_from_path == normalized_alias:
-                # Only add the file's provisional ID to the list of provisional IDs if that exact file hasn't already
-                # been added (also check that the file is in the inbox and there are no errors)
-                if file_path["status"] == "inbox" and file_path["user_error_message"] is None:
-                    if file_name not in file_names:
-                        file_names.append(file_name)
-                        file_provisional_ids.append(file_path["provisional_id"])
+            # Only add the file's provisional ID to the list of provisional IDs if that exact file hasn't already
+            # been added (also check that the file is in the inbox and there are no errors)
+            if file_path["status"] == "inbox" and file_path["user_error_message"] is None:
+                if file_name not in file_names:
+                    file_names.append(file_name)
+                    file_provisional_ids.append(file_path["provisional_id"])
 
         if file_provisional_ids:
             logging.info(f"Found {len(file_provisional_ids)} associated with sample {self.sample_alias}!")
@@ -274,48 +329,80 @@ class RegisterEgaExperimentsAndRuns:
                 f"Expected to find at least 1 file associated with sample {self.sample_alias}. Instead found none."
             )
 
-    def _conditionally_register_run(self, experiment_provisional_id: str, sample_metadata: dict) -> Optional[int]:
+    def _conditionally_register_run(
+            self,
+            experiment_provisional_id: str,
+            sample_metadata: dict,
+            registered_runs: Optional[Iterable[Dict]] = None,
+            file_metadata: Optional[List[Dict]] = None,
+    ) -> Optional[int]:
         """
-        Registers the run for the sample
-        Endpoint documentation located here:
-        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--runs/post
+        Registers the run for the sample if it doesn't already exist
         """
         if run_provisional_id := self._run_exists(
-                experiment_provisional_id=experiment_provisional_id, sample_metadata=sample_metadata
+                experiment_provisional_id=experiment_provisional_id,
+                sample_metadata=sample_metadata,
+                registered_runs=registered_runs,
         ):
             return run_provisional_id
 
+        if self.snapshot and (run_provisional_id := self._run_exists(
+                experiment_provisional_id=experiment_provisional_id,
+                sample_metadata=sample_metadata,
+                registered_runs=self.snapshot.objects("runs", force_refresh=True),
+        )):
+            return run_provisional_id
+
         # If the run for the sample doesn't already exist, gather the metadata for all files in the submission and
         # link the files to the sample of interest in order to register the run
         logging.info(
             f"Attempting to collect metadata for all files registered under submissions {self.submission_accession_or_provisional_id}"
         )
-        normalized_alias = normalize_sample_alias(self.sample_alias)
-        file_metadata = get_file_metadata_for_one_sample_in_inbox(
-            normalized_alias, headers=self._headers()
-        )
-        if file_metadata:
-            sample_and_file_metadata = self._link_files_to_samples(file_metadata, sample_metadata)
-
-            logging.info(f"Attempting to register run for sample {self.sample_alias} now...")
-            response = requests.post(
-                url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/runs",
-                headers=self._headers(),
-                json={
-                    "run_file_type": self.run_file_type,
-                    "files": sample_and_file_metadata["files"],
-                    "experiment_provisional_id": experiment_provisional_id,
-                    "sample_provisional_id": sample_and_file_metadata["sample_provisional_id"],
-                }
+        if file_metadata is None and self.inbox_index:
+            file_metadata = self.inbox_index.files_for_sample(self.sample_alias)
+        elif file_metadata is None:
+            normalized_alias = normalize_sample_alias(self.sample_alias)
+            file_metadata = get_file_metadata_for_one_sample_in_inbox(
+                normalized_alias, headers=self._headers(), client=self.client
             )
-            if response.status_code in VALID_STATUS_CODES:
-                run_provisional_id = [a["provisional_id"] for a in response.json()][0]
-                logging.info(f"Successfully registered run for sample {self.sample_alias}")
-                return run_provisional_id
-            else:
-                error_message = f"Received status code {response.status_code} with error: {response.text} while attempting to register run"
-                logging.error(error_message)
-                raise Exception(error_message)
+        # The files are only needed to register a run, so a sample whose run exists can be re-run after they're gone
+        if not file_metadata:
+            raise Exception("Expected to find at least 1 file in the inbox. Instead found none.")
+        return self._register_run(experiment_provisional_id, sample_metadata, file_metadata)
+
+    def run_payload(self, experiment_provisional_id: str, sample_metadata: dict, file_metadata: List[Dict]) -> dict:
+        sample_and_file_metadata = self._link_files_to_samples(file_metadata, dict(sample_metadata))
+        return {
+            "run_file_type": self.run_file_type,
+            "files": sample_and_file_metadata["files"],
+            "experiment_provisional_id": experiment_provisional_id,
+            "sample_provisional_id": sample_and_file_metadata["sample_provisional_id"],
+        }
+
+    def _register_run(self, experiment_provisional_id: str, sample_metadata: dict, file_metadata: List[Dict]) -> int:
+        """
+        Registers the run for the sample
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--runs/post
+        """
+        run_payload = self.run_payload(experiment_provisional_id, sample_metadata, file_metadata)
+
+        logging.info(f"Attempting to register run for sample {self.sample_alias} now...")
+        response = self.client.post(
+            url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/runs",
+            headers=self._headers(),
+            json=run_payload,
+        )
+        if response.status_code in VALID_STATUS_CODES:
+            run_provisional_id = [a["provisional_id"] for a in response.json()][0]
+            if self.snapshot:
+                self.snapshot.invalidate("runs")
+            logging.info(f"Successfully registered run for sample {self.sample_alias}")
+            return run_provisional_id
+        else:
+            error_message = f"Received status code {response.status_code} with error: {response.text} while attempting to register run"
+            logging.error(error_message)
+            raise Exception(error_message)
 
     def _write_tsv(self, run_provisional_id: int) -> None:
         logging.info("Writing sample metadata and run provisional id to output file")
@@ -324,28 +411,109 @@ class RegisterEgaExperimentsAndRuns:
             writer.writeheader()
             writer.writerow({"entity:sample_id": self.sample_id, "ega_run_provisional_id": run_provisional_id})
 
-    def register_metadata(self):
+    async def _list_submission_objects(
+            self,
+            async_client: AsyncEgaApiClient,
+            kind: str,
+            match: Callable[[Dict], bool],
+            first_match_only: bool = False,
+    ) -> List[Dict]:
         """
-        Registers experiment and run metadata. Logic is built into the following methods so that any metadata that
-        already exists is not attempted to be re-registered, and this script can be run multiple times in case there
-        are any transient failures.
+        Lists the submission's experiments, samples or runs for which `match` is true, from the snapshot if there is
+        one. Without a snapshot, only the matches are kept as the collection streams in, and with `first_match_only`
+        the rest of the collection isn't read.
         """
+        if self.snapshot:
+            registered_objects = await asyncio.to_thread(self.snapshot.objects, kind)
+            matches = [registered_object for registered_object in registered_objects if match(registered_object)]
+            return matches[:1] if first_match_only else matches
+        return await getattr(async_client, f"get_{kind}")(
+            self.submission_accession_or_provisional_id, match=match, first_match_only=first_match_only
+        )
 
-        # Register the experiment if it doesn't already exist
-        experiment_provisional_id = self._conditionally_create_experiment()
+    async def _timed_stage(self, stage: str, awaitable: Awaitable[T]) -> T:
+        start = time.perf_counter()
+        result = await awaitable
+        logging.info(f"Stage '{stage}' for sample {self.sample_alias} took {time.perf_counter() - start:.2f} seconds")
+        return result
+
+    async def _register_experiment_stage(self, async_client: AsyncEgaApiClient) -> Optional[str]:
+        design_description = self.design_description()
+        all_experiments = await self._list_submission_objects(
+            async_client,
+            "experiments",
+            match=lambda experiment: self._is_experiment(experiment, design_description),
+            first_match_only=True,
+        )
+        return await asyncio.to_thread(self._conditionally_create_experiment, all_experiments)
+
+    async def _sample_lookup_stage(self, async_client: AsyncEgaApiClient) -> Optional[dict]:
+        registered_samples = await self._list_submission_objects(
+            async_client, "samples", match=self._is_registered_sample, first_match_only=True
+        )
+        return self._get_metadata_for_registered_sample(registered_samples=registered_samples)
+
+    async def _runs_and_inbox_files_stage(
+            self, async_client: AsyncEgaApiClient
+    ) -> Tuple[List[Dict], Optional[List[Dict]]]:
+        """
+        Lists the sample's runs (a sample can have a run for each experiment, so all of them are kept). The sample's
+        files are only needed to register a run, so the inbox is only queried here, still overlapping the experiment
+        stage, if the sample has no run at all. Otherwise they're left as None and fetched when the run is registered,
+        if it turns out not to exist for this experiment.
+        """
+        registered_runs = await self._timed_stage(
+            "runs listing", self._list_submission_objects(async_client, "runs", match=self._is_run_of_sample)
+        )
+        if registered_runs or self.inbox_index:
+            return registered_runs, None
+        file_metadata = await self._timed_stage(
+            "inbox files",
+            async_client.get_inbox_files(prefix=f"/{normalize_sample_alias(self.sample_alias)}.cram"),
+        )
+        return registered_runs, file_metadata
 
-        # Gather the sample accession ID that corresponds to the sample we're trying to register a run for
-        sample_metadata = self._get_metadata_for_registered_sample()
+    async def register_metadata_concurrently(self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> Optional[int]:
+        """
+        Registers the experiment and run, running the steps that don't depend on each other concurrently. Only the
+        run depends on the others: it needs the experiment (registered if it doesn't already exist), the sample, the
+        existing runs and, if the run doesn't exist yet, the sample's files in the inbox. These run side by side and
+        are joined before the run is registered.
+        """
+        start = time.perf_counter()
+        async_client = AsyncEgaApiClient(self.token, max_concurrency=max_concurrency, client=self.client)
+        experiment_provisional_id, sample_metadata, (registered_runs, file_metadata) = await asyncio.gather(
+            self._timed_stage("experiment", self._register_experiment_stage(async_client)),
+            self._timed_stage("sample lookup", self._sample_lookup_stage(async_client)),
+            self._runs_and_inbox_files_stage(async_client),
+        )
 
+        run_provisional_id = None
         if experiment_provisional_id and sample_metadata:
             # Register the run if it doesn't already exist
-            run_provisional_id = self._conditionally_register_run(
-                experiment_provisional_id=experiment_provisional_id, sample_metadata=sample_metadata
-            )
+            run_provisional_id = await self._timed_stage("run", asyncio.to_thread(
+                self._conditionally_register_run,
+                experiment_provisional_id=experiment_provisional_id,
+                sample_metadata=sample_metadata,
+                registered_runs=registered_runs,
+                file_metadata=file_metadata,
+            ))
+        logging.info(
+            f"Registered metadata for sample {self.sample_alias} in {time.perf_counter() - start:.2f} seconds"
+        )
+        return run_provisional_id
+
+    def register_metadata(self):
+        """
+        Registers experiment and run metadata. Logic is built into the following methods so that any metadata that
+        already exists is not attempted to be re-registered, and this script can be run multiple times in case there
+        are any transient failures.
+        """
+        run_provisional_id = asyncio.run(self.register_metadata_concurrently())
 
-            # Write info to a tsv so that it can be written to the Terra data tables
-            if run_provisional_id:
-                self._write_tsv(run_provisional_id=run_provisional_id)
+        # Write info to a tsv so that it can be written to the Terra data tables
+        if run_provisional_id:
+            self._write_tsv(run_provisional_id=run_provisional_id)
 
 
 if __name__ == "__main__":
@@ -457,6 +625,14 @@ if __name__ == "__main__":
         required=True,
         help="The library construction protocol",
     )
+    parser.add_argument(
+        "-snapshot_path",
+        required=False,
+        default=None,
+        help="A SQLite file to cache the submission's metadata in. It only saves requests when the same file is "
+             "reused by later runs on the same machine. If not provided, the metadata is fetched from the EGA every "
+             "time."
+    )
 
     args = parser.parse_args()
 
@@ -468,6 +644,11 @@ if __name__ == "__main__":
 
     if access_token:
         logging.info("Successfully generated access token. Will continue with metadata registration now.")
+        submission_snapshot = SubmissionSnapshot(
+            path=args.snapshot_path,
+            submission_accession_or_provisional_id=args.submission_accession_or_provisional_id,
+            token=access_token,
+        ) if args.snapshot_path else None
         RegisterEgaExperimentsAndRuns(
             token=access_token,
             submission_accession_or_provisional_id=args.submission_accession_or_provisional_id,
@@ -487,4 +668,5 @@ if __name__ == "__main__":
             sample_material_type=args.sample_material_type,
             library_construction_protocol=args.construction_protocol,
             sample_id=args.sample_id,
+            snapshot=submission_snapshot,
         ).register_metadata()
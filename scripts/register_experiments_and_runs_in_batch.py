@@ -0,0 +1,477 @@
+"""
+    Registers the EXPERIMENT and RUN for MANY samples in one submission, as an alternative to running
+    register_experiment_and_run_metadata.py once per sample.
+    It will:
+    1) Log in and retrieve access token for the EGA
+    2) Fetch the submission's experiments, samples and runs and the inbox files once, and index them
+    3) Register the EXPERIMENTs and RUNs missing for the samples in the samples TSV, many per request
+    4) Write the run provisional IDs of all samples to one TSV that can be loaded into the Terra data tables
+
+    The samples TSV has one row per sample, with a column for each per-sample argument of
+    register_experiment_and_run_metadata.py: sample_alias, sample_id, instrument_model, library_layout,
+    library_strategy, library_source, library_selection, run_file_type, library_name, mean_insert_size,
+    standard_deviation, sample_material_type, construction_protocol and, optionally, technology.
+"""
+import sys
+import asyncio
+import argparse
+import logging
+from csv import DictReader, DictWriter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+sys.path.append("./")
+from scripts.utils import (
+    EgaApiClient,
+    InboxFileIndex,
+    LoginAndGetToken,
+    SecretManager,
+    SUBMISSION_PROTOCOL_API_URL,
+    VALID_STATUS_CODES,
+    format_request_header,
+    get_ega_api_client,
+    iter_api_list,
+    logging_configurator,
+)
+from scripts.async_ega_api_client import AsyncEgaApiClient, DEFAULT_MAX_CONCURRENCY
+from scripts.register_experiment_and_run_metadata import RegisterEgaExperimentsAndRuns
+from scripts.submission_snapshot import SubmissionSnapshot
+from scripts import (
+    LIBRARY_LAYOUT,
+    LIBRARY_STRATEGY,
+    LIBRARY_SOURCE,
+    LIBRARY_SELECTION,
+    RUN_FILE_TYPE,
+    INSTRUMENT_MODEL_MAPPING,
+)
+
+SAMPLE_COLUMNS = [
+    "sample_alias",
+    "sample_id",
+    "instrument_model",
+    "library_layout",
+    "library_strategy",
+    "library_source",
+    "library_selection",
+    "run_file_type",
+    "library_name",
+    "mean_insert_size",
+    "standard_deviation",
+    "sample_material_type",
+    "construction_protocol",
+]
+
+# The values allowed in each column that's a choice in register_experiment_and_run_metadata.py
+SAMPLE_COLUMN_CHOICES = {
+    "instrument_model": list(INSTRUMENT_MODEL_MAPPING.keys()),
+    "library_layout": LIBRARY_LAYOUT,
+    "library_strategy": LIBRARY_STRATEGY,
+    "library_source": LIBRARY_SOURCE,
+    "library_selection": LIBRARY_SELECTION,
+    "run_file_type": RUN_FILE_TYPE,
+}
+
+# The number of experiments or runs registered per request
+BULK_REQUEST_SIZE = 50
+
+
+def read_samples_tsv(samples_tsv: str) -> List[Dict[str, str]]:
+    """
+    Reads the samples TSV, and checks up front that every row only uses values the EGA accepts, like the choices
+    of the single sample script's arguments, so that a typo fails the whole batch before anything is registered
+    """
+    samples = []
+    invalid_values = []
+    with open(samples_tsv) as tsv_file:
+        reader = DictReader(tsv_file, delimiter="\t")
+        if reader.fieldnames and (
+                missing_columns := [column for column in SAMPLE_COLUMNS if column not in reader.fieldnames]
+        ):
+            raise ValueError(f"The samples TSV is missing the columns: {', '.join(missing_columns)}")
+        for sample in reader:
+            samples.append(sample)
+            for column, choices in SAMPLE_COLUMN_CHOICES.items():
+                if sample[column] not in choices:
+                    invalid_values.append(f"line {reader.line_num}: {column} '{sample[column]}'")
+
+    if invalid_values:
+        raise ValueError(
+            f"The samples TSV has {len(invalid_values)} invalid values: {'; '.join(invalid_values)}. The allowed "
+            f"values are listed in scripts/__init__.py."
+        )
+    return samples
+
+
+def _payload_key(kind: str, payload: dict) -> Tuple:
+    """What identifies an experiment or run we're registering, so that it can be found in the response"""
+    if kind == "experiments":
+        return (payload["design_description"],)
+    return payload["experiment_provisional_id"], payload["sample_provisional_id"]
+
+
+def _object_key(kind: str, registered_object: dict) -> Tuple:
+    """The `_payload_key` of a registered experiment or run. Runs may list the experiment and sample flat or nested."""
+    if kind == "experiments":
+        return (registered_object["design_description"],)
+    return (
+        registered_object.get("experiment_provisional_id") or registered_object["experiment"]["provisional_id"],
+        registered_object.get("sample_provisional_id") or registered_object["sample"]["provisional_id"],
+    )
+
+
+def _objects_by_key(kind: str, registered_objects: Iterable[dict]) -> Dict[Tuple, Dict]:
+    return {_object_key(kind, registered_object): registered_object for registered_object in registered_objects}
+
+
+class SubmissionMetadataIndex:
+    """
+    The experiments, samples and runs of a submission, indexed by what each sample's registration looks them up by:
+    experiments by (study ID, design description), samples by alias and runs by (experiment, sample)
+    """
+
+    def __init__(self, experiments: List[Dict], samples: List[Dict], runs: List[Dict]) -> None:
+        self.experiment_ids: Dict[Tuple[str, str], str] = {}
+        for experiment in experiments:
+            self.add_experiment(experiment)
+        self.samples: Dict[str, Dict] = {
+            sample["alias"]: {"sample_alias": sample["alias"], "sample_provisional_id": sample["provisional_id"]}
+            for sample in samples
+        }
+        self.run_ids: Dict[Tuple[str, int, str], int] = {}
+        for run in runs:
+            self.add_run(
+                run["experiment"]["provisional_id"],
+                {"sample_alias": run["sample"]["alias"], "sample_provisional_id": run["sample"]["provisional_id"]},
+                run["provisional_id"],
+            )
+
+    def add_experiment(self, experiment: Dict) -> None:
+        for study_id in (experiment.get("study_accession_id"), experiment.get("study_provisional_id")):
+            if study_id:
+                self.experiment_ids[(study_id, experiment["design_description"])] = experiment["provisional_id"]
+
+    def find_experiment(
+            self, study_accession_id: Optional[str], study_provisional_id: Optional[str], design_description: str
+    ) -> Optional[str]:
+        for study_id in (study_accession_id, study_provisional_id):
+            if study_id and (study_id, design_description) in self.experiment_ids:
+                return self.experiment_ids[(study_id, design_description)]
+        return None
+
+    def add_run(self, experiment_provisional_id: str, sample_metadata: dict, run_provisional_id: int) -> None:
+        key = (experiment_provisional_id, sample_metadata["sample_provisional_id"], sample_metadata["sample_alias"])
+        self.run_ids[key] = run_provisional_id
+
+    def find_run(self, experiment_provisional_id: str, sample_metadata: dict) -> Optional[int]:
+        return self.run_ids.get(
+            (experiment_provisional_id, sample_metadata["sample_provisional_id"], sample_metadata["sample_alias"])
+        )
+
+
+class RegisterEgaExperimentsAndRunsInBatch:
+    def __init__(
+            self,
+            token: str,
+            submission_accession_or_provisional_id: str,
+            study_accession_id: Optional[str],
+            study_provisional_id: Optional[str],
+            samples: List[Dict[str, str]],
+            output_tsv: str,
+            bulk_request_size: int = BULK_REQUEST_SIZE,
+            client: Optional[EgaApiClient] = None,
+            snapshot: Optional[SubmissionSnapshot] = None,
+    ):
+        self.token = token
+        self.submission_accession_or_provisional_id = submission_accession_or_provisional_id
+        self.study_accession_id = study_accession_id
+        self.study_provisional_id = study_provisional_id
+        self.samples = samples
+        self.output_tsv = output_tsv
+        self.bulk_request_size = bulk_request_size
+        self.client = client or get_ega_api_client()
+        self.snapshot = snapshot
+
+    def _registration_for_sample(
+            self, sample: Dict[str, str], inbox_index: InboxFileIndex
+    ) -> RegisterEgaExperimentsAndRuns:
+        return RegisterEgaExperimentsAndRuns(
+            token=self.token,
+            submission_accession_or_provisional_id=self.submission_accession_or_provisional_id,
+            study_accession_id=self.study_accession_id,
+            study_provisional_id=self.study_provisional_id,
+            instrument_model_id=INSTRUMENT_MODEL_MAPPING[sample["instrument_model"]],
+            library_layout=sample["library_layout"],
+            library_strategy=sample["library_strategy"],
+            library_source=sample["library_source"],
+            library_selection=sample["library_selection"],
+            run_file_type=sample["run_file_type"],
+            technology=sample.get("technology"),
+            sample_alias=sample["sample_alias"],
+            library_name=sample["library_name"],
+            insert_size=sample["mean_insert_size"],
+            standard_deviation=sample["standard_deviation"],
+            sample_material_type=sample["sample_material_type"],
+            library_construction_protocol=sample["construction_protocol"],
+            sample_id=sample["sample_id"],
+            client=self.client,
+            inbox_index=inbox_index,
+        )
+
+    async def _fetch_submission_metadata(
+            self, max_concurrency: int = DEFAULT_MAX_CONCURRENCY
+    ) -> Tuple[SubmissionMetadataIndex, InboxFileIndex]:
+        """Fetches every collection the registrations look things up in once, concurrently"""
+        async_client = AsyncEgaApiClient(self.token, max_concurrency=max_concurrency, client=self.client)
+        submission_id = self.submission_accession_or_provisional_id
+        if self.snapshot:
+            # Everything is registered right after this, so the snapshot is refreshed rather than trusted
+            collections = [
+                asyncio.to_thread(self.snapshot.objects, kind, force_refresh=True)
+                for kind in ["experiments", "samples", "runs"]
+            ]
+        else:
+            collections = [
+                async_client.get_experiments(submission_id),
+                async_client.get_samples(submission_id),
+                async_client.get_runs(submission_id),
+            ]
+        experiments, samples, runs, files = await asyncio.gather(*collections, async_client.get_inbox_files())
+        logging.info(
+            f"Found {len(experiments)} experiments, {len(samples)} samples and {len(runs)} runs in submission "
+            f"{submission_id} and {len(files)} files in the inbox"
+        )
+        return SubmissionMetadataIndex(experiments, samples, runs), InboxFileIndex(files)
+
+    def _post_chunk(self, kind: str, payloads: List[dict]) -> Optional[List[Dict]]:
+        """
+        POSTs a list of experiments or runs in one request
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--experiments/post
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--runs/post
+        """
+        response = self.client.post(
+            url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/{kind}",
+            headers=format_request_header(self.token),
+            json=payloads if len(payloads) > 1 else payloads[0],
+        )
+        if response.status_code in VALID_STATUS_CODES:
+            registered_objects = response.json()
+            if self.snapshot:
+                self.snapshot.invalidate(kind)
+            return registered_objects
+        logging.error(
+            f"Received status code {response.status_code} with error: {response.text} while attempting to register "
+            f"{len(payloads)} {kind}"
+        )
+        return None
+
+    def _existing_objects(self, kind: str) -> Dict[Tuple, Dict]:
+        if self.snapshot:
+            return _objects_by_key(kind, self.snapshot.objects(kind, force_refresh=True))
+        return _objects_by_key(kind, iter_api_list(
+            url=f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_accession_or_provisional_id}/{kind}",
+            headers=format_request_header(self.token),
+            description=f"existing {kind}",
+            client=self.client,
+        ))
+
+    def _post_in_chunks(self, kind: str, payloads: List[dict]) -> Dict[Tuple, Dict]:
+        """
+        Registers experiments or runs `bulk_request_size` at a time and returns the registered objects keyed by
+        `_object_key`, so that each one can be matched back to the sample it was registered for. If a request fails,
+        we can't tell which of its objects were registered, so we look them up and register the rest one at a time,
+        which isolates the objects the API rejects from the others.
+        """
+        registered_objects = {}
+        for chunk_start in range(0, len(payloads), self.bulk_request_size):
+            chunk = payloads[chunk_start:chunk_start + self.bulk_request_size]
+            logging.info(
+                f"Registering {kind} {chunk_start + 1} to {chunk_start + len(chunk)} of {len(payloads)} in one request"
+            )
+            response_objects = self._post_chunk(kind, chunk)
+            if response_objects is not None:
+                registered_objects.update(_objects_by_key(kind, response_objects))
+                continue
+
+            if len(chunk) > 1:
+                logging.info(f"Registering the {len(chunk)} {kind} from the failed request one at a time")
+                existing_objects = self._existing_objects(kind)
+                for payload in chunk:
+                    key = _payload_key(kind, payload)
+                    if key in existing_objects:
+                        registered_objects[key] = existing_objects[key]
+                    elif (response_objects := self._post_chunk(kind, [payload])) is not None:
+                        registered_objects.update(_objects_by_key(kind, response_objects))
+        return registered_objects
+
+    def _write_tsv(self, run_provisional_ids: Dict[str, int]) -> None:
+        logging.info(f"Writing run provisional ids for {len(run_provisional_ids)} samples to {self.output_tsv}")
+        with open(self.output_tsv, "w") as tsv_file:
+            writer = DictWriter(tsv_file, fieldnames=["entity:sample_id", "ega_run_provisional_id"], delimiter='\t')
+            writer.writeheader()
+            for sample_id, run_provisional_id in run_provisional_ids.items():
+                writer.writerow({"entity:sample_id": sample_id, "ega_run_provisional_id": run_provisional_id})
+
+    def register_metadata(self) -> Dict[str, int]:
+        """
+        Registers the experiments and runs that don't already exist, in bulk requests. A sample that fails doesn't
+        stop the others; the output TSV is written for the samples that succeeded before failing with the list of
+        those that didn't.
+        """
+        submission_index, inbox_index = asyncio.run(self._fetch_submission_metadata())
+        failed_samples = {}
+
+        # Register all missing experiments
+        registrations = []
+        experiments_to_register = {}
+        for sample in self.samples:
+            try:
+                registration = self._registration_for_sample(sample, inbox_index)
+                # Check for the sample first so that we don't create an experiment for a sample we can't register a
+                # run for
+                sample_metadata = submission_index.samples.get(registration.sample_alias)
+                if not sample_metadata:
+                    raise Exception(
+                        f"Could not find {registration.sample_alias} in registered sample metadata. It could be that "
+                        f"the sample wasn't registered ahead of time, or it was registered with a different alias."
+                    )
+                design_description = registration.design_description()
+                if not submission_index.find_experiment(
+                        self.study_accession_id, self.study_provisional_id, design_description
+                ):
+                    experiments_to_register[design_description] = registration.experiment_payload(design_description)
+                registrations.append((registration, sample_metadata, design_description))
+            except Exception as e:
+                failed_samples[sample["sample_alias"]] = str(e)
+
+        logging.info(
+            f"{len(registrations) - len(experiments_to_register)} of {len(registrations)} experiments already exist. "
+            f"Registering the other {len(experiments_to_register)}."
+        )
+        for experiment in self._post_in_chunks("experiments", list(experiments_to_register.values())).values():
+            submission_index.add_experiment(experiment)
+
+        # Register all missing runs
+        run_provisional_ids = {}
+        runs_to_register = {}
+        for registration, sample_metadata, design_description in registrations:
+            try:
+                experiment_provisional_id = submission_index.find_experiment(
+                    self.study_accession_id, self.study_provisional_id, design_description
+                )
+                if not experiment_provisional_id:
+                    raise Exception(f"The experiment {design_description} could not be registered")
+                if run_provisional_id := submission_index.find_run(experiment_provisional_id, sample_metadata):
+                    run_provisional_ids[registration.sample_id] = run_provisional_id
+                    continue
+                run_payload = registration.run_payload(
+                    experiment_provisional_id,
+                    sample_metadata,
+                    inbox_index.files_for_sample(registration.sample_alias),
+                )
+                runs_to_register[_payload_key("runs", run_payload)] = (registration, sample_metadata, run_payload)
+            except Exception as e:
+                failed_samples[registration.sample_alias] = str(e)
+
+        logging.info(
+            f"{len(run_provisional_ids)} runs already exist. Registering the other {len(runs_to_register)}."
+        )
+        registered_runs = self._post_in_chunks("runs", [run_payload for _, _, run_payload in runs_to_register.values()])
+        for key, (registration, sample_metadata, run_payload) in runs_to_register.items():
+            if key in registered_runs:
+                run_provisional_id = registered_runs[key]["provisional_id"]
+                run_provisional_ids[registration.sample_id] = run_provisional_id
+                submission_index.add_run(run_payload["experiment_provisional_id"], sample_metadata, run_provisional_id)
+            else:
+                failed_samples[registration.sample_alias] = "The run could not be registered"
+
+        self._write_tsv(run_provisional_ids)
+        if failed_samples:
+            for sample_alias, error in failed_samples.items():
+                logging.error(f"Could not register the experiment and run for sample {sample_alias}: {error}")
+            raise Exception(
+                f"Failed to register the experiment and run for {len(failed_samples)} of {len(self.samples)} samples: "
+                f"{', '.join(failed_samples)}"
+            )
+        return run_provisional_ids
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="This script will upload experiment and run metadata to the EGA for a batch of samples after "
+                    "their crams have been uploaded and validated."
+    )
+    parser.add_argument(
+        "-submission_accession_or_provisional_id",
+        required=True,
+        help="The submission accession or provisional ID"
+    )
+    parser.add_argument(
+        "-study_accession_id",
+        required=False,
+        default=None,
+        help="The study accession ID"
+    )
+    parser.add_argument(
+        "-study_provisional_id",
+        required=False,
+        default=None,
+        help="The study provisional ID"
+    )
+    parser.add_argument(
+        "-user_name",
+        required=True,
+        help="The EGA username"
+    )
+    parser.add_argument(
+        "-samples_tsv",
+        required=True,
+        help="A TSV with one row per sample and a column for each per-sample argument of "
+             "register_experiment_and_run_metadata.py",
+    )
+    parser.add_argument(
+        "-output_tsv",
+        required=False,
+        default="sample_id_and_run_provisional_id.tsv",
+        help="The TSV to write the run provisional ID of every sample to",
+    )
+    parser.add_argument(
+        "-bulk_request_size",
+        required=False,
+        type=int,
+        default=BULK_REQUEST_SIZE,
+        help="The number of experiments or runs to register per request",
+    )
+    parser.add_argument(
+        "-snapshot_path",
+        required=False,
+        default=None,
+        help="A SQLite file to cache the submission's metadata in, so that batches run one after the other on the "
+             "same machine only download it in full once. If not provided, the metadata is fetched from the EGA every "
+             "time."
+    )
+
+    args = parser.parse_args()
+
+    if not (args.study_accession_id or args.study_provisional_id):
+        raise RuntimeError("You must provide either study accession ID or study provisional ID")
+
+    password = SecretManager(ega_inbox=args.user_name).get_ega_password_secret()
+    access_token = LoginAndGetToken(username=args.user_name, password=password).login_and_get_token()
+
+    if access_token:
+        logging.info("Successfully generated access token. Will continue with metadata registration now.")
+        submission_snapshot = SubmissionSnapshot(
+            path=args.snapshot_path,
+            submission_accession_or_provisional_id=args.submission_accession_or_provisional_id,
+            token=access_token,
+        ) if args.snapshot_path else None
+        RegisterEgaExperimentsAndRunsInBatch(
+            token=access_token,
+            submission_accession_or_provisional_id=args.submission_accession_or_provisional_id,
+            study_accession_id=args.study_accession_id,
+            study_provisional_id=args.study_provisional_id,
+            samples=read_samples_tsv(args.samples_tsv),
+            output_tsv=args.output_tsv,
+            bulk_request_size=args.bulk_request_size,
+            snapshot=submission_snapshot,
+        ).register_metadata()
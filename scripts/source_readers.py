@@ -0,0 +1,180 @@
+"""
+    Readers for the files we encrypt, which can either be local paths or gs:// objects. A gs:// object is read in place
+    through concurrent ranged GETs instead of first being copied to local disk, so encryption can start as soon as the
+    first range arrives. Setting STORAGE_EMULATOR_HOST points the storage client at a fake GCS server.
+"""
+import io
+import os
+import base64
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import BinaryIO, Dict, Optional
+
+from google.cloud import storage
+
+# Each ranged GET fetches RANGE_SIZE bytes, and up to READ_AHEAD_RANGES of them are fetched ahead of the reader
+RANGE_SIZE = 16 * 1024 * 1024
+READ_AHEAD_RANGES = 8
+
+
+def is_gcs_path(path: str) -> bool:
+    return path.startswith("gs://")
+
+
+@lru_cache(maxsize=None)
+def get_storage_client() -> storage.Client:
+    """Returns a storage client shared by everything in this process, so that credentials and connections are reused"""
+    return storage.Client()
+
+
+def _get_blob(gcs_path: str, client: Optional[storage.Client] = None) -> storage.Blob:
+    bucket_name, _, blob_name = gcs_path.removeprefix("gs://").partition("/")
+    blob = (client or get_storage_client()).bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(f"No such object: {gcs_path}")
+    return blob
+
+
+class GcsRangedReader(io.RawIOBase):
+    """
+    A seekable, read-only file over a gs:// object. The object is fetched in ranges of `range_size` bytes on a pool
+    of threads, keeping up to `read_ahead` ranges ahead of the current position in flight, so the reader rarely
+    waits on the network when it's consumed sequentially. Every range is read from the generation of the object that
+    was current when the reader was opened, so an object overwritten mid-read fails instead of mixing two versions.
+    """
+
+    def __init__(
+            self,
+            gcs_path: str,
+            range_size: int = RANGE_SIZE,
+            read_ahead: int = READ_AHEAD_RANGES,
+            client: Optional[storage.Client] = None,
+    ) -> None:
+        super().__init__()
+        self.gcs_path = gcs_path
+        self.blob = _get_blob(gcs_path, client)
+        self.size = self.blob.size
+        self.range_size = range_size
+        self.read_ahead = read_ahead
+        self._executor = ThreadPoolExecutor(max_workers=read_ahead)
+        self._ranges: Dict[int, Future] = {}
+        self._position = 0
+        self._current_range_start = None
+        self._current_range = b""
+
+    def _fetch_range(self, start: int) -> bytes:
+        end = min(start + self.range_size, self.size) - 1
+        # Checksums can't be validated for partial reads; the crypt4gh manifest covers the whole plaintext instead
+        data = self.blob.download_as_bytes(
+            start=start, end=end, if_generation_match=self.blob.generation, checksum=None
+        )
+        # A short range would leave the reader stuck at the same position forever
+        if len(data) != end + 1 - start:
+            raise IOError(
+                f"Expected {end + 1 - start} bytes at offset {start} of {self.gcs_path}, instead received {len(data)}"
+            )
+        return data
+
+    def _schedule_read_ahead(self, start: int) -> None:
+        window = range(start, min(start + self.read_ahead * self.range_size, self.size), self.range_size)
+        # Drop ranges that fell out of the window, e.g. after a seek
+        for range_start in list(self._ranges):
+            if range_start not in window:
+                self._ranges.pop(range_start).cancel()
+        for range_start in window:
+            if range_start not in self._ranges:
+                self._ranges[range_start] = self._executor.submit(self._fetch_range, range_start)
+
+    def _range(self, start: int) -> bytes:
+        if start != self._current_range_start:
+            self._schedule_read_ahead(start)
+            self._current_range = self._ranges.pop(start).result()
+            self._current_range_start = start
+            # Keep the window full now that this range has been taken out of it
+            self._schedule_read_ahead(start + self.range_size)
+        return self._current_range
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self.size - self._position
+        chunks = []
+        while size > 0 and self._position < self.size:
+            range_start = self._position - self._position % self.range_size
+            offset = self._position - range_start
+            chunk = self._range(range_start)[offset:offset + size]
+            chunks.append(chunk)
+            self._position += len(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self) -> None:
+        if not self.closed:
+            for future in self._ranges.values():
+                future.cancel()
+            self._executor.shutdown(wait=False)
+        super().close()
+
+
+def open_source(path: str, range_size: int = RANGE_SIZE, read_ahead: int = READ_AHEAD_RANGES) -> BinaryIO:
+    """Opens a local file or a gs:// object for reading"""
+    if is_gcs_path(path):
+        return GcsRangedReader(path, range_size=range_size, read_ahead=read_ahead)
+    return open(path, "rb")
+
+
+def source_size(path: str) -> int:
+    if is_gcs_path(path):
+        return _get_blob(path).size
+    return os.path.getsize(path)
+
+
+def source_fingerprint(path: str) -> Dict:
+    """Identifies a particular version of a file, so that we can tell whether it changed"""
+    if is_gcs_path(path):
+        blob = _get_blob(path)
+        return {"size": blob.size, "generation": blob.generation}
+    input_stat = os.stat(path)
+    return {"size": input_stat.st_size, "mtime_ns": input_stat.st_mtime_ns}
+
+
+def source_content_id(path: str) -> Optional[str]:
+    """
+    Returns an identifier of a gs:// object's content from the checksums GCS stores for it, without reading it. That's
+    the MD5 if the object has one. Composite objects only have a CRC32C, which is too weak to identify the content on
+    its own, so it's combined with the object's generation, which changes whenever the object is rewritten. Local
+    files have neither, so this returns None for them.
+    """
+    if not is_gcs_path(path):
+        return None
+    blob = _get_blob(path)
+    if blob.md5_hash:
+        return base64.b64decode(blob.md5_hash).hex()
+    if blob.crc32c:
+        return f"crc32c-{base64.b64decode(blob.crc32c).hex()}-{blob.generation}"
+    return None
+
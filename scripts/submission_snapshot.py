@@ -0,0 +1,193 @@
+"""
+    A local SQLite copy of the experiments, samples, runs and datasets registered in a submission, so that a process
+    registering metadata for many samples, like register_experiments_and_runs_in_batch.py, doesn't download every
+    collection again for each lookup. The file can be reused by later runs on the same machine. Cromwell tasks don't
+    share a filesystem, so the per-sample workflows don't pass a snapshot: each of their tasks would start with an
+    empty file and download every collection anyway.
+
+    A collection is refreshed when it's older than `max_age_seconds`, when something was registered in it since, or
+    when the caller forces a refresh right before registering something, so that nothing is registered twice because
+    of a stale snapshot. A refresh asks the API for the collection only if it changed since the last one (with the
+    ETag or Last-Modified the API returned), and otherwise applies the difference by provisional id. Only the API's
+    list responses are stored, so every object has the same shape as in a GET of the collection.
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from scripts.utils import (
+    EgaApiClient,
+    SUBMISSION_PROTOCOL_API_URL,
+    VALID_STATUS_CODES,
+    format_request_header,
+    get_ega_api_client,
+    iter_json_array,
+)
+
+SNAPSHOT_KINDS = ["experiments", "samples", "runs", "datasets"]
+SNAPSHOT_MAX_AGE_SECONDS = 5 * 60
+
+
+class SubmissionSnapshot:
+    def __init__(
+            self,
+            path: str,
+            submission_accession_or_provisional_id: str,
+            token: str,
+            max_age_seconds: float = SNAPSHOT_MAX_AGE_SECONDS,
+            client: Optional[EgaApiClient] = None,
+    ) -> None:
+        self.path = path
+        self.submission_id = submission_accession_or_provisional_id
+        self.token = token
+        self.max_age_seconds = max_age_seconds
+        self.client = client or get_ega_api_client()
+        # Transactions are managed explicitly, and the lock lets threads share the connection
+        self.connection = sqlite3.connect(path, timeout=120, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS objects (
+                submission_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                provisional_id TEXT NOT NULL,
+                body TEXT NOT NULL,
+                PRIMARY KEY (submission_id, kind, provisional_id)
+            );
+            CREATE TABLE IF NOT EXISTS collections (
+                submission_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                refreshed_at REAL NOT NULL,
+                invalidated_at REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (submission_id, kind)
+            );
+            """
+        )
+
+    def _fetch(
+            self, kind: str, etag: Optional[str], last_modified: Optional[str]
+    ) -> Tuple[Optional[List[Dict]], Optional[str], Optional[str]]:
+        """
+        Gets the collection, or None if it hasn't changed since the response with `etag` and `last_modified`
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/submissions-accession_id--experiments/get
+        """
+        url = f"{SUBMISSION_PROTOCOL_API_URL}/submissions/{self.submission_id}/{kind}"
+        headers = format_request_header(self.token)
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        with self.client.get(url=url, headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                return None, etag, last_modified
+            if response.status_code not in VALID_STATUS_CODES:
+                error_message = f"""Received status code {response.status_code} with error: {response.text} while
+                 attempting to query {kind}"""
+                logging.error(error_message)
+                raise Exception(error_message)
+            return (
+                list(iter_json_array(response)),
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+            )
+
+    def _apply(self, kind: str, registered_objects: List[Dict]) -> None:
+        """Replaces the stored collection with `registered_objects`, only writing the objects that changed"""
+        stored_bodies = dict(self.connection.execute(
+            "SELECT provisional_id, body FROM objects WHERE submission_id = ? AND kind = ?",
+            (self.submission_id, kind),
+        ))
+        new_bodies = {
+            str(registered_object["provisional_id"]): json.dumps(registered_object, sort_keys=True)
+            for registered_object in registered_objects
+        }
+        changed = [
+            (self.submission_id, kind, provisional_id, body)
+            for provisional_id, body in new_bodies.items() if stored_bodies.get(provisional_id) != body
+        ]
+        removed = [
+            (self.submission_id, kind, provisional_id)
+            for provisional_id in stored_bodies if provisional_id not in new_bodies
+        ]
+        self.connection.executemany("INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)", changed)
+        self.connection.executemany(
+            "DELETE FROM objects WHERE submission_id = ? AND kind = ? AND provisional_id = ?", removed
+        )
+        logging.info(
+            f"Refreshed {kind} of submission {self.submission_id}: {len(new_bodies)} in total, "
+            f"{len(changed)} new or changed and {len(removed)} removed"
+        )
+
+    def _collection_state(self, kind: str) -> Tuple[Optional[str], Optional[str], float, float]:
+        with self._lock:
+            collection = self.connection.execute(
+                "SELECT etag, last_modified, refreshed_at, invalidated_at FROM collections "
+                "WHERE submission_id = ? AND kind = ?",
+                (self.submission_id, kind),
+            ).fetchone()
+        return collection or (None, None, 0.0, 0.0)
+
+    def refresh(self, kind: str, force: bool = False) -> None:
+        etag, last_modified, refreshed_at, invalidated_at = self._collection_state(kind)
+        if not force and refreshed_at > invalidated_at and time.time() - refreshed_at < self.max_age_seconds:
+            return
+
+        # The collection is fetched without holding any lock, so that reads of the snapshot (in this process and in
+        # the other tasks sharing it) don't wait on the API. The write transaction only covers applying the result.
+        fetched_at = time.time()
+        registered_objects, etag, last_modified = self._fetch(kind, etag, last_modified)
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                collection = self.connection.execute(
+                    "SELECT refreshed_at, invalidated_at FROM collections WHERE submission_id = ? AND kind = ?",
+                    (self.submission_id, kind),
+                ).fetchone()
+                stored_refreshed_at, invalidated_at = collection or (0.0, 0.0)
+                if stored_refreshed_at >= fetched_at:
+                    # Another refresh fetched the collection after we did, so what we have is older than what's stored
+                    logging.info(f"The {kind} of submission {self.submission_id} were refreshed by another task")
+                else:
+                    if registered_objects is None:
+                        logging.info(f"The {kind} of submission {self.submission_id} haven't changed")
+                    else:
+                        self._apply(kind, registered_objects)
+                    self.connection.execute(
+                        "INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?, ?, ?)",
+                        (self.submission_id, kind, etag, last_modified, fetched_at, invalidated_at),
+                    )
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def objects(self, kind: str, force_refresh: bool = False) -> List[Dict]:
+        """Returns the registered objects of one kind, refreshing them first if they're stale or `force_refresh`"""
+        self.refresh(kind, force=force_refresh)
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT body FROM objects WHERE submission_id = ? AND kind = ? ORDER BY rowid",
+                (self.submission_id, kind),
+            ).fetchall()
+        return [json.loads(body) for body, in rows]
+
+    def invalidate(self, kind: str) -> None:
+        """
+        Marks a collection as stale after we registered something in it, so that the next read fetches it again. A
+        refresh that was already in flight when the collection was invalidated doesn't make it fresh again.
+        """
+        with self._lock:
+            self.connection.execute(
+                "UPDATE collections SET etag = NULL, last_modified = NULL, invalidated_at = ? "
+                "WHERE submission_id = ? AND kind = ?",
+                (time.time(), self.submission_id, kind),
+            )
+
+    def close(self) -> None:
+        self.connection.close()
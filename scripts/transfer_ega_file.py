@@ -1,21 +1,89 @@
 import os
 import sys
+import time
+import json
+import errno
+import socket
+import hashlib
+import queue
 import argparse
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import paramiko
+from paramiko.sftp import CMD_WRITE, int64
 import subprocess
 sys.path.append("./")
 from scripts.utils import (
-    LoginAndGetToken,
     SecretManager,
     logging_configurator
 )
+from scripts.transfer_metrics import TransferMonitor
 
 
 REMOTE_PATH = "/encrypted"
 SFTP_HOSTNAME = "inbox.ega-archive.org"
 SFTP_PORT = 22
+DEFAULT_CONNECTIONS = 4
+# Up to MAX_OUTSTANDING_WRITES * WRITE_REQUEST_SIZE bytes of SFTP writes are in flight at once. An upload can't have
+# more bytes in flight than the SSH channel window the server advertises (2 MiB for OpenSSH), and we can't change that
+# window, so there's no point in more writes than fit in it (see scripts/benchmark_sftp_transfer.py).
+WRITE_REQUEST_SIZE = 32 * 1024
+MAX_OUTSTANDING_WRITES = 64
+# Large files uploaded over several streams are split into ranges of this size. A range that fails is uploaded again
+# in full, so smaller ranges waste less work on a retry.
+RANGE_SIZE = 1024 * 1024 * 1024
+MAX_RANGE_ATTEMPTS = 3
+# The ranges of a file that have been uploaded are recorded next to it, in a file with this suffix, until the whole
+# file is uploaded. A later run on the same machine continues from the record instead of uploading every range again.
+# In a Cromwell task the record is next to the localized input, so it's lost when the task is retried or preempted.
+RANGE_RECORD_SUFFIX = ".uploaded_ranges.json"
+# When resuming, this much of the start and the end of the already uploaded part is read back and compared with the
+# local file. A crypt4gh file encrypted again has a different header, so this catches a stale partial upload.
+VERIFY_PREFIX_BYTES = 64 * 1024 * 1024
+# An upload that makes no progress for this long is treated as hung: the connection is dropped and the upload resumes
+# over a new one, up to MAX_RECONNECTS times
+STALL_TIMEOUT_SECONDS = 300
+MAX_RECONNECTS = 3
+# Batch transfers with read-ahead read files in blocks of READ_BLOCK_SIZE and keep at most READ_AHEAD_BYTES of them
+# buffered ahead of the upload
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+READ_AHEAD_BYTES = 256 * 1024 * 1024
+# Preferred SSH algorithms, in order. AES-GCM authenticates as part of the cipher and runs on AES-NI, so it costs the
+# least CPU per byte; AES-CTR with an encrypt-then-MAC SHA-2 MAC is the fallback. The files we upload are already
+# encrypted and don't compress, so compression only burns CPU. See scripts/benchmark_sftp_transfer.py --mode algorithms.
+PREFERRED_CIPHERS = ("aes128-gcm@openssh.com", "aes256-gcm@openssh.com", "aes128-ctr", "aes256-ctr")
+PREFERRED_MACS = ("hmac-sha2-256-etm@openssh.com", "hmac-sha2-256", "hmac-sha2-512-etm@openssh.com", "hmac-sha2-512")
+
+
+class SftpConnectionSettings:
+    """
+    Where and how SFTP connections to the inbox are made. `write_request_size` is the payload of each SFTP write
+    request and `max_outstanding_writes` is how many of them may be waiting for an acknowledgement at once. `ciphers`
+    and `macs` are offered to the server in order of preference, and `compression` turns on zlib compression.
+    """
+
+    def __init__(
+            self,
+            hostname: str = SFTP_HOSTNAME,
+            port: int = SFTP_PORT,
+            write_request_size: int = WRITE_REQUEST_SIZE,
+            max_outstanding_writes: int = MAX_OUTSTANDING_WRITES,
+            ciphers: Tuple[str, ...] = PREFERRED_CIPHERS,
+            macs: Tuple[str, ...] = PREFERRED_MACS,
+            compression: bool = False,
+    ) -> None:
+        self.hostname = hostname
+        self.port = port
+        self.write_request_size = write_request_size
+        self.max_outstanding_writes = max_outstanding_writes
+        self.ciphers = tuple(ciphers)
+        self.macs = tuple(macs)
+        self.compression = compression
 
 
 def get_active_account() -> str:
@@ -31,44 +99,929 @@ def get_active_account() -> str:
         raise Exception(f"Exception: {str(e)}")
 
 
-def transfer_file(encrypted_data_file: str, ega_inbox: str, password: str) -> None:
-    """Transfer encrypted data file to EGA inbox via SFTP."""
+def connect_transport(
+        ega_inbox: str, password: str, settings: Optional[SftpConnectionSettings] = None
+) -> paramiko.Transport:
+    """Opens an SSH transport to the EGA inbox and authenticates it"""
+    settings = settings or SftpConnectionSettings()
+    transport = paramiko.Transport((settings.hostname, settings.port))
+    try:
+        # Only offer algorithms this transport supports (its defaults), so a preference paramiko doesn't know about
+        # doesn't break the connection
+        security_options = transport.get_security_options()
+        default_ciphers, default_macs = security_options.ciphers, security_options.digests
+        supported_ciphers = [cipher for cipher in settings.ciphers if cipher in default_ciphers]
+        supported_macs = [mac for mac in settings.macs if mac in default_macs]
+        if not supported_ciphers or not supported_macs:
+            raise ValueError(
+                f"None of the ciphers {settings.ciphers} or MACs {settings.macs} are supported. Expected ciphers from "
+                f"{list(default_ciphers)} and MACs from {list(default_macs)}"
+            )
+        security_options.ciphers = supported_ciphers
+        security_options.digests = supported_macs
+        transport.use_compression(settings.compression)
+
+        transport.connect(username=ega_inbox, password=password)
+        logging.debug(
+            f"Negotiated cipher {transport.local_cipher} and MAC {transport.local_mac} with {settings.hostname}"
+        )
+    except Exception:
+        transport.close()
+        raise
+    return transport
+
+
+@contextmanager
+def open_sftp_client(
+        ega_inbox: str, password: str, settings: Optional[SftpConnectionSettings] = None
+) -> Iterator[paramiko.SFTPClient]:
+    """Opens an authenticated SFTP session to the EGA inbox. The connection is closed on exit."""
+    with connect_transport(ega_inbox, password, settings) as transport:
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        yield sftp
+
+
+class PipelinedSftpWriter:
+    """
+    Writes a remote file with up to `max_outstanding_writes` SFTP write requests in flight. Unlike paramiko's own
+    pipelining, which stops sending and drains every outstanding request every ~100 writes, this keeps the pipe full
+    by only waiting for the oldest request once the limit is reached. Over a link with a long round trip time this is
+    what decides the throughput of a single connection. It sends requests and reads responses with SFTPClient's
+    private `_async_request`, `_read_response` and `_expecting`, so paramiko is pinned in requirements.txt, and a
+    paramiko upgrade needs this re-checked with scripts/benchmark_sftp_transfer.py.
+    """
+
+    def __init__(
+            self,
+            sftp: paramiko.SFTPClient,
+            remote_file: str,
+            settings: Optional[SftpConnectionSettings] = None,
+            callback: Optional[Callable[[int, int], None]] = None,
+            total_size: int = 0,
+            offset: int = 0,
+            truncate: bool = True,
+    ) -> None:
+        self.sftp = sftp
+        self.settings = settings or SftpConnectionSettings()
+        self.callback = callback
+        self.total_size = total_size
+        self.offset = offset
+        # Ranges of a file written in parallel must not truncate what the others have written
+        self.remote = sftp.open(remote_file, "wb" if truncate else "r+b")
+        self.bytes_written = 0
+        self._outstanding = deque()
+
+    def __enter__(self) -> "PipelinedSftpWriter":
+        return self
+
+    def __exit__(self, exc_type, *exc_info) -> None:
+        if exc_type is None:
+            self.close()
+            return
+        try:
+            self.remote.close()
+        except Exception:
+            pass
+
+    def _read_response(self) -> None:
+        # Responses are handed to the remote file, which keeps any error to be raised by _check_exception
+        self.sftp._read_response()
+        self.remote._check_exception()
+        while self._outstanding and self._outstanding[0] not in self.sftp._expecting:
+            self._outstanding.popleft()
+
+    def write(self, data: bytes) -> None:
+        view = memoryview(data)
+        for start in range(0, len(view), self.settings.write_request_size):
+            chunk = view[start:start + self.settings.write_request_size]
+            # Collect acknowledgements that have already arrived, and only block once the pipeline is full
+            while self.sftp.sock.recv_ready() or len(self._outstanding) >= self.settings.max_outstanding_writes:
+                self._read_response()
+            request = self.sftp._async_request(
+                self.remote, CMD_WRITE, self.remote.handle, int64(self.offset + self.bytes_written), bytes(chunk)
+            )
+            self._outstanding.append(request)
+            self.bytes_written += len(chunk)
+            if self.callback:
+                self.callback(self.offset + self.bytes_written, self.total_size)
+
+    def close(self) -> None:
+        while self._outstanding:
+            self._read_response()
+        self.remote.close()
+
+
+def pipelined_put(
+        sftp: paramiko.SFTPClient,
+        local_file: str,
+        remote_file: str,
+        settings: Optional[SftpConnectionSettings] = None,
+        callback: Optional[Callable[[int, int], None]] = None,
+        offset: int = 0,
+) -> int:
+    """
+    A drop-in replacement for `sftp.put` built on PipelinedSftpWriter. If `offset` is given, the remote file is
+    expected to already hold the first `offset` bytes, and only the rest is written. Returns the number of bytes
+    written.
+    """
+    settings = settings or SftpConnectionSettings()
+    file_size = os.path.getsize(local_file)
+    with open(local_file, "rb") as infile:
+        infile.seek(offset)
+        with PipelinedSftpWriter(
+                sftp, remote_file, settings, callback, file_size, offset=offset, truncate=offset == 0
+        ) as writer:
+            while data := infile.read(settings.write_request_size):
+                writer.write(data)
+
+    remote_size = sftp.stat(remote_file).st_size
+    if remote_size != file_size:
+        raise IOError(f"Size mismatch in put! {remote_size} != {file_size}")
+    return file_size - offset
+
+
+def _ranges_match(
+        sftp: paramiko.SFTPClient, local_file: str, remote_file: str, ranges: List[Tuple[int, int]]
+) -> bool:
+    local_hash = hashlib.md5()
+    with open(local_file, "rb") as infile:
+        for offset, length in ranges:
+            infile.seek(offset)
+            local_hash.update(infile.read(length))
+
+    remote_hash = hashlib.md5()
+    with sftp.open(remote_file, "rb") as remote:
+        # readv pipelines the reads instead of waiting for each block in turn
+        for data in remote.readv(ranges):
+            remote_hash.update(data)
+    return local_hash.digest() == remote_hash.digest()
+
+
+def range_record_path(encrypted_data_file: str) -> str:
+    return encrypted_data_file + RANGE_RECORD_SUFFIX
+
+
+def recorded_contiguous_bytes(encrypted_data_file: str) -> Optional[int]:
+    """
+    Returns how much of the start of the file an unfinished upload in ranges is known to have uploaded, or None if
+    there's no unfinished upload in ranges
+    """
+    try:
+        with open(range_record_path(encrypted_data_file)) as record:
+            range_size = json.load(record).get("range_size") or RANGE_SIZE
+    except FileNotFoundError:
+        return None
+    return UploadRanges.for_file(encrypted_data_file, range_size).contiguous_bytes
+
+
+def resume_offset(
+        sftp: paramiko.SFTPClient,
+        local_file: str,
+        remote_file: str,
+        verify_prefix_bytes: int = VERIFY_PREFIX_BYTES,
+) -> int:
+    """
+    Returns how many bytes of `local_file` are already in `remote_file`, i.e. where an upload can pick up from.
+    That's 0 if the remote file doesn't exist, is larger than the local file, or (if `verify_prefix_bytes` is not 0)
+    the start or the end of what was uploaded doesn't match the local file. An upload in ranges that didn't finish
+    can leave holes anywhere in the remote file, even one of full size, so if its record is there, only the ranges it
+    completed at the start of the file are counted.
+    """
+    try:
+        remote_size = sftp.stat(remote_file).st_size
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return 0
+        raise
+
+    local_size = os.path.getsize(local_file)
+    if remote_size > local_size:
+        logging.warning(f"{remote_file} is larger than {local_file}, uploading it again from the start")
+        return 0
+
+    contiguous_bytes = recorded_contiguous_bytes(local_file)
+    if contiguous_bytes is not None and remote_size > contiguous_bytes:
+        logging.warning(
+            f"{remote_file} was partly uploaded in ranges, only its first {contiguous_bytes} bytes are known to be "
+            f"complete"
+        )
+        remote_size = contiguous_bytes
+
+    if verify_prefix_bytes and remote_size:
+        ranges = [(0, min(verify_prefix_bytes, remote_size))]
+        if remote_size > verify_prefix_bytes:
+            tail_start = max(remote_size - verify_prefix_bytes, verify_prefix_bytes)
+            ranges.append((tail_start, remote_size - tail_start))
+        if not _ranges_match(sftp, local_file, remote_file, ranges):
+            logging.warning(f"{remote_file} doesn't match {local_file}, uploading it again from the start")
+            return 0
+    return remote_size
+
+
+class PooledSftpConnection:
+    """An authenticated SFTP session that belongs to a pool, along with how much it has transferred"""
+
+    def __init__(self, connection_id: int, ega_inbox: str, password: str, settings: SftpConnectionSettings) -> None:
+        self.connection_id = connection_id
+        self.ega_inbox = ega_inbox
+        self.password = password
+        self.settings = settings
+        self.files_transferred = 0
+        self.bytes_transferred = 0
+        self.busy_seconds = 0.0
+        self._connect()
+
+    def _connect(self) -> None:
+        self.transport = connect_transport(self.ega_inbox, self.password, self.settings)
+        self.sftp = paramiko.SFTPClient.from_transport(self.transport)
+
+    def reconnect(self) -> None:
+        self.close()
+        self._connect()
+
+    def record_transfer(self, bytes_transferred: int, seconds: float, files: int = 1) -> None:
+        self.files_transferred += files
+        self.bytes_transferred += bytes_transferred
+        self.busy_seconds += seconds
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class SftpConnectionPool:
+    """
+    Keeps `size` authenticated SFTP sessions to the EGA inbox open, so that the SSH handshake and authentication only
+    happen once per connection instead of once per file. Connections are checked out with `connection()`. A connection
+    that fails while checked out is replaced with a fresh one before it goes back into the pool.
+    """
+
+    def __init__(
+            self,
+            ega_inbox: str,
+            password: str,
+            size: int = DEFAULT_CONNECTIONS,
+            settings: Optional[SftpConnectionSettings] = None,
+    ) -> None:
+        self.ega_inbox = ega_inbox
+        self.password = password
+        self.size = size
+        self.settings = settings or SftpConnectionSettings()
+        self.connections = []
+        self._idle = queue.Queue()
+
+    def __enter__(self) -> "SftpConnectionPool":
+        # Handshakes are mostly waiting on the network, so open all connections at the same time
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            futures = [
+                executor.submit(PooledSftpConnection, connection_id, self.ega_inbox, self.password, self.settings)
+                for connection_id in range(self.size)
+            ]
+            for future in futures:
+                try:
+                    self.connections.append(future.result())
+                except Exception as e:
+                    logging.error(f"Unable to open SFTP connection to EGA inbox {self.ega_inbox}: {str(e)}")
+        if not self.connections:
+            raise Exception(f"Unable to open any SFTP connections to EGA inbox {self.ega_inbox}")
+
+        for connection in self.connections:
+            self._idle.put(connection)
+        logging.info(f"Opened {len(self.connections)} SFTP connections to EGA inbox {self.ega_inbox}")
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        for connection in self.connections:
+            connection.close()
+
+    @contextmanager
+    def connection(self) -> Iterator[PooledSftpConnection]:
+        connection = self._idle.get()
+        try:
+            yield connection
+        except Exception:
+            try:
+                connection.reconnect()
+            except Exception as e:
+                logging.error(f"Unable to reconnect SFTP connection {connection.connection_id}: {str(e)}")
+            raise
+        finally:
+            self._idle.put(connection)
+
+    def log_throughput(self, wall_clock_seconds: float) -> Dict:
+        """Logs the total throughput of the pool and the throughput of each connection while it was busy"""
+        total_bytes = sum(connection.bytes_transferred for connection in self.connections)
+        total_mib_per_second = total_bytes / (1024 * 1024) / wall_clock_seconds if wall_clock_seconds else 0.0
+        logging.info(
+            f"Transferred {total_bytes / (1024 * 1024):.1f} MiB in {wall_clock_seconds:.1f}s "
+            f"({total_mib_per_second:.1f} MiB/s) over {len(self.connections)} connections"
+        )
+        per_connection = []
+        for connection in self.connections:
+            mib = connection.bytes_transferred / (1024 * 1024)
+            mib_per_second = mib / connection.busy_seconds if connection.busy_seconds else 0.0
+            logging.info(
+                f"Connection {connection.connection_id}: {connection.files_transferred} files, {mib:.1f} MiB, "
+                f"{mib_per_second:.1f} MiB/s"
+            )
+            per_connection.append(
+                {
+                    "connection_id": connection.connection_id,
+                    "files": connection.files_transferred,
+                    "bytes": connection.bytes_transferred,
+                    "mib_per_second": mib_per_second,
+                }
+            )
+        return {
+            "bytes": total_bytes,
+            "seconds": wall_clock_seconds,
+            "mib_per_second": total_mib_per_second,
+            "connections": per_connection,
+        }
+
+
+def _remote_path(encrypted_data_file: str) -> str:
+    return os.path.join(REMOTE_PATH, os.path.basename(encrypted_data_file))
+
+
+def _transfer_file_with_pool(pool: SftpConnectionPool, encrypted_data_file: str) -> None:
+    with pool.connection() as connection:
+        start = time.perf_counter()
+        bytes_transferred = pipelined_put(
+            connection.sftp, encrypted_data_file, _remote_path(encrypted_data_file), connection.settings
+        )
+        connection.record_transfer(bytes_transferred, time.perf_counter() - start)
+    logging.info(f"Successfully transferred {encrypted_data_file} over connection {connection.connection_id}")
+
+
+def transfer_files(
+        encrypted_data_files: List[str],
+        ega_inbox: str,
+        password: str,
+        connections: int = DEFAULT_CONNECTIONS,
+        settings: Optional[SftpConnectionSettings] = None,
+) -> Dict:
+    """
+    Transfers many encrypted data files to the EGA inbox over a pool of SFTP connections. Files are handed to
+    whichever connection is free next. Returns the total and per-connection throughput.
+    """
+    start = time.perf_counter()
+    failed_files = []
+    with SftpConnectionPool(ega_inbox, password, size=connections, settings=settings) as pool:
+        with ThreadPoolExecutor(max_workers=len(pool.connections)) as executor:
+            futures = {
+                executor.submit(_transfer_file_with_pool, pool, encrypted_data_file): encrypted_data_file
+                for encrypted_data_file in encrypted_data_files
+            }
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"Error transferring file {futures[future]}: {str(e)}")
+                    failed_files.append(futures[future])
+
+        throughput = pool.log_throughput(time.perf_counter() - start)
+
+    if failed_files:
+        raise Exception(f"Error transferring {len(failed_files)} files: {', '.join(failed_files)}")
+    return throughput
+
+
+class UploadRanges:
+    """
+    Splits a file into byte ranges and tracks which of them have been uploaded. Ranges can complete in any order;
+    `contiguous_bytes` is how much of the start of the file is known to be complete. With `record_file`, completed
+    ranges are saved to it as they complete and loaded from it on creation, as long as it was written for the same
+    version of the local file and the same range size.
+    """
+
+    def __init__(
+            self, file_size: int, range_size: int = RANGE_SIZE, record_file: Optional[str] = None,
+            file_mtime_ns: Optional[int] = None,
+    ) -> None:
+        self.file_size = file_size
+        self.range_size = range_size
+        self.ranges = [(offset, min(range_size, file_size - offset)) for offset in range(0, file_size, range_size)]
+        self.record_file = record_file
+        self.file_mtime_ns = file_mtime_ns
+        self.completed = set()
+        self.contiguous_bytes = 0
+        self._next_range = 0
+        self._lock = threading.Lock()
+        if record_file:
+            self._load()
+
+    @classmethod
+    def for_file(cls, encrypted_data_file: str, range_size: int = RANGE_SIZE) -> "UploadRanges":
+        stat = os.stat(encrypted_data_file)
+        return cls(stat.st_size, range_size, range_record_path(encrypted_data_file), stat.st_mtime_ns)
+
+    def _load(self) -> None:
+        try:
+            with open(self.record_file) as record:
+                saved = json.load(record)
+        except FileNotFoundError:
+            return
+        if (saved.get("file_size"), saved.get("range_size"), saved.get("file_mtime_ns")) != (
+                self.file_size, self.range_size, self.file_mtime_ns
+        ):
+            logging.warning(f"{self.record_file} was written for a different file or range size, ignoring it")
+            return
+        for offset in saved["completed"]:
+            self._mark_complete(offset)
+
+    def _save(self) -> None:
+        # Written to a temporary file first, so that a run that dies mid-write doesn't leave a truncated record
+        temporary_file = f"{self.record_file}.tmp"
+        with open(temporary_file, "w") as record:
+            json.dump(
+                {
+                    "file_size": self.file_size,
+                    "range_size": self.range_size,
+                    "file_mtime_ns": self.file_mtime_ns,
+                    "completed": sorted(self.completed),
+                },
+                record,
+            )
+        os.replace(temporary_file, self.record_file)
+
+    def _mark_complete(self, offset: int) -> None:
+        self.completed.add(offset)
+        while self._next_range < len(self.ranges) and self.ranges[self._next_range][0] in self.completed:
+            self.contiguous_bytes += self.ranges[self._next_range][1]
+            self._next_range += 1
+
+    def mark_complete(self, offset: int) -> None:
+        with self._lock:
+            self._mark_complete(offset)
+            if self.record_file:
+                self._save()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.completed = set()
+            self.contiguous_bytes = 0
+            self._next_range = 0
+            self.discard_record()
+
+    def discard_record(self) -> None:
+        """Removes the record once the upload is complete"""
+        if self.record_file and os.path.exists(self.record_file):
+            os.remove(self.record_file)
+
+    def missing(self) -> List[Tuple[int, int]]:
+        return [(offset, length) for offset, length in self.ranges if offset not in self.completed]
+
+
+def _transfer_range_with_pool(
+        pool: SftpConnectionPool, encrypted_data_file: str, offset: int, length: int
+) -> None:
+    with pool.connection() as connection:
+        start = time.perf_counter()
+        settings = connection.settings
+        with open(encrypted_data_file, "rb") as infile:
+            infile.seek(offset)
+            with PipelinedSftpWriter(
+                    connection.sftp, _remote_path(encrypted_data_file), settings, offset=offset, truncate=False
+            ) as writer:
+                remaining = length
+                while remaining:
+                    data = infile.read(min(settings.write_request_size, remaining))
+                    if not data:
+                        raise IOError(f"{encrypted_data_file} ended before the range at offset {offset} was read")
+                    writer.write(data)
+                    remaining -= len(data)
+        connection.record_transfer(length, time.perf_counter() - start, files=0)
+
+
+def transfer_file_in_ranges(
+        encrypted_data_file: str,
+        ega_inbox: str,
+        password: str,
+        streams: int = DEFAULT_CONNECTIONS,
+        range_size: int = RANGE_SIZE,
+        max_attempts: int = MAX_RANGE_ATTEMPTS,
+        settings: Optional[SftpConnectionSettings] = None,
+) -> Dict:
+    """
+    Transfers a single large file to the EGA inbox over several SFTP connections at once. The file is split into byte
+    ranges, and each range is written at its own offset of the same remote file. Ranges that fail are retried, up to
+    `max_attempts` times in total, without uploading the ranges that already made it again. Completed ranges are
+    recorded next to the local file (see RANGE_RECORD_SUFFIX), so a later run on the same machine only uploads the
+    ranges that are still missing. Returns the throughput.
+    """
+    file_size = os.path.getsize(encrypted_data_file)
+    remote_file = _remote_path(encrypted_data_file)
+    upload_ranges = UploadRanges.for_file(encrypted_data_file, range_size)
+    start = time.perf_counter()
+
+    with SftpConnectionPool(ega_inbox, password, size=streams, settings=settings) as pool:
+        with pool.connection() as connection:
+            if upload_ranges.completed:
+                try:
+                    connection.sftp.stat(remote_file)
+                except IOError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    logging.warning(f"{remote_file} no longer exists, uploading every range of it again")
+                    upload_ranges.reset()
+            if upload_ranges.completed:
+                logging.info(
+                    f"Resuming upload of {encrypted_data_file}: {len(upload_ranges.completed)} of "
+                    f"{len(upload_ranges.ranges)} ranges were uploaded by an earlier run"
+                )
+            else:
+                # Create (or truncate) the remote file once, before any range is written into it
+                connection.sftp.open(remote_file, "wb").close()
+
+        for attempt in range(1, max_attempts + 1):
+            missing_ranges = upload_ranges.missing()
+            if not missing_ranges:
+                break
+            logging.info(
+                f"Transferring {len(missing_ranges)} of {len(upload_ranges.ranges)} ranges of {encrypted_data_file} "
+                f"(attempt {attempt} of {max_attempts})"
+            )
+            with ThreadPoolExecutor(max_workers=len(pool.connections)) as executor:
+                futures = {
+                    executor.submit(_transfer_range_with_pool, pool, encrypted_data_file, offset, length): offset
+                    for offset, length in missing_ranges
+                }
+                for future in as_completed(futures):
+                    try:
+                        future.result()
+                        upload_ranges.mark_complete(futures[future])
+                        logging.info(
+                            f"Transferred range at offset {futures[future]} of {encrypted_data_file}; the first "
+                            f"{upload_ranges.contiguous_bytes} of {file_size} bytes are complete"
+                        )
+                    except Exception as e:
+                        logging.warning(f"Error transferring range at offset {futures[future]}: {str(e)}")
+
+        missing_ranges = upload_ranges.missing()
+        if missing_ranges:
+            raise Exception(
+                f"Error transferring file: {len(missing_ranges)} ranges of {encrypted_data_file} failed after "
+                f"{max_attempts} attempts"
+            )
+
+        with pool.connection() as connection:
+            remote_size = connection.sftp.stat(remote_file).st_size
+        if remote_size != file_size:
+            raise Exception(f"Error transferring file: size mismatch in put! {remote_size} != {file_size}")
+        upload_ranges.discard_record()
+
+        throughput = pool.log_throughput(time.perf_counter() - start)
+
+    logging.info(f"Successfully transferred {encrypted_data_file} to EGA inbox {ega_inbox} over {streams} streams")
+    return throughput
+
+
+_END_OF_FILE = object()
+
+
+class _FileReadAhead(threading.Thread):
+    """
+    Reads a list of files in order on a background thread and puts their blocks on a bounded queue. The reader runs
+    ahead of the upload, into the next file once the current one has been read, until the queue is full. Each file's
+    blocks are followed by _END_OF_FILE, or by the exception that stopped it from being read.
+    """
+
+    def __init__(self, file_paths: List[str], block_size: int, max_queued_blocks: int) -> None:
+        super().__init__(daemon=True)
+        self.file_paths = file_paths
+        self.block_size = block_size
+        self.blocks = queue.Queue(maxsize=max_queued_blocks)
+        self.stopped = threading.Event()
+
+    def _put(self, item) -> bool:
+        # Keep checking whether the consumer has gone away so that we never block forever on a full queue
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_file(self, file_path: str) -> bool:
+        try:
+            with open(file_path, "rb") as infile:
+                if hasattr(os, "posix_fadvise"):
+                    # Let the kernel read further ahead on the disk as well
+                    os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                while data := infile.read(self.block_size):
+                    if not self._put(data):
+                        return False
+        except Exception as e:
+            return self._put(e)
+        return self._put(_END_OF_FILE)
+
+    def run(self) -> None:
+        for file_path in self.file_paths:
+            if not self._read_file(file_path):
+                return
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+
+def _upload_blocks(
+        connection: PooledSftpConnection, encrypted_data_file: str, first_block, blocks: queue.Queue
+) -> None:
+    """Uploads one file's blocks from the read-ahead queue. All of its blocks are consumed, even if the upload fails."""
+    start = time.perf_counter()
+    bytes_transferred = 0
+    block = first_block
+    try:
+        with PipelinedSftpWriter(connection.sftp, _remote_path(encrypted_data_file), connection.settings) as writer:
+            while block is not _END_OF_FILE:
+                if isinstance(block, Exception):
+                    raise block
+                writer.write(block)
+                bytes_transferred += len(block)
+                block = blocks.get()
+    except Exception:
+        # Skip the rest of this file so that the next file starts at its first block
+        while block is not _END_OF_FILE and not isinstance(block, Exception):
+            block = blocks.get()
+        raise
+    connection.record_transfer(bytes_transferred, time.perf_counter() - start)
+
+
+def transfer_files_with_read_ahead(
+        encrypted_data_files: List[str],
+        ega_inbox: str,
+        password: str,
+        settings: Optional[SftpConnectionSettings] = None,
+        read_ahead_bytes: int = READ_AHEAD_BYTES,
+        block_size: int = READ_BLOCK_SIZE,
+) -> Dict:
+    """
+    Transfers many encrypted data files to the EGA inbox one after the other over a single SFTP connection, while a
+    background thread reads ahead, into the next file once the current one has been read. This keeps both the disk
+    and the link busy, and never buffers more than `read_ahead_bytes`. Returns the throughput.
+    """
+    start = time.perf_counter()
+    failed_files = []
+    read_ahead = _FileReadAhead(encrypted_data_files, block_size, max(1, read_ahead_bytes // block_size))
     try:
-        # Establish an SFTP connection
-        with paramiko.Transport((SFTP_HOSTNAME, SFTP_PORT)) as transport:
-            transport.connect(username=ega_inbox, password=password)
-            sftp = paramiko.SFTPClient.from_transport(transport)
+        with SftpConnectionPool(ega_inbox, password, size=1, settings=settings) as pool:
+            read_ahead.start()
+            for encrypted_data_file in encrypted_data_files:
+                try:
+                    # A file that can't be read at all fails before anything is created in the inbox
+                    first_block = read_ahead.blocks.get()
+                    if isinstance(first_block, Exception):
+                        raise first_block
+                    with pool.connection() as connection:
+                        _upload_blocks(connection, encrypted_data_file, first_block, read_ahead.blocks)
+                    logging.info(f"Successfully transferred {encrypted_data_file} to EGA inbox {ega_inbox}")
+                except Exception as e:
+                    logging.error(f"Error transferring file {encrypted_data_file}: {str(e)}")
+                    failed_files.append(encrypted_data_file)
 
-            # Upload the encrypted data file
-            remote_file = os.path.join(REMOTE_PATH, os.path.basename(encrypted_data_file))
-            sftp.put(encrypted_data_file, remote_file)
+            throughput = pool.log_throughput(time.perf_counter() - start)
+    finally:
+        read_ahead.stop()
 
-        logging.info(f"Successfully transferred {encrypted_data_file} to EGA inbox {ega_inbox}")
+    if failed_files:
+        raise Exception(f"Error transferring {len(failed_files)} files: {', '.join(failed_files)}")
+    return throughput
+
+
+def read_encrypted_data_files(encrypted_data_files_file: str) -> List[str]:
+    """Reads a manifest with one encrypted file to transfer per line"""
+    with open(encrypted_data_files_file) as manifest:
+        return [line.strip() for line in manifest if line.strip()]
+
+
+def transfer_file(
+        encrypted_data_file: str,
+        ega_inbox: str,
+        password: str,
+        settings: Optional[SftpConnectionSettings] = None,
+        resume: bool = False,
+        verify_prefix_bytes: int = VERIFY_PREFIX_BYTES,
+        stall_timeout_seconds: float = STALL_TIMEOUT_SECONDS,
+        max_reconnects: int = MAX_RECONNECTS,
+        metrics_file: Optional[str] = None,
+) -> None:
+    """
+    Transfer encrypted data file to EGA inbox via SFTP. With `resume`, a partial upload left in the inbox by an
+    earlier attempt is continued from where it stopped, and a file that's already fully uploaded is skipped.
+    If the upload stalls for `stall_timeout_seconds` or the connection drops, it's resumed over a new connection.
+    Progress is logged as the upload runs, and if `metrics_file` is provided, the throughput metrics are written to it.
+    """
+    remote_file = _remote_path(encrypted_data_file)
+    file_size = os.path.getsize(encrypted_data_file)
+    monitor = TransferMonitor(os.path.basename(encrypted_data_file), file_size)
+    try:
+        for attempt in range(max_reconnects + 1):
+            try:
+                # Establish an SFTP connection
+                with open_sftp_client(ega_inbox, password, settings) as sftp:
+                    # Blocked reads and writes on the channel give up once nothing has moved for this long
+                    sftp.get_channel().settimeout(stall_timeout_seconds)
+
+                    offset = 0
+                    # After a reconnect the partial upload is always continued
+                    if resume or attempt > 0:
+                        offset = resume_offset(sftp, encrypted_data_file, remote_file, verify_prefix_bytes)
+                    if offset and offset == file_size:
+                        logging.info(
+                            f"{encrypted_data_file} is already fully uploaded to EGA inbox {ega_inbox}, skipping it"
+                        )
+                    else:
+                        if offset:
+                            logging.info(f"Resuming upload of {encrypted_data_file} from byte {offset}")
+
+                        # Upload the encrypted data file
+                        monitor.begin_attempt(offset)
+                        pipelined_put(
+                            sftp, encrypted_data_file, remote_file, settings, callback=monitor, offset=offset
+                        )
+                        logging.info(f"Successfully transferred {encrypted_data_file} to EGA inbox {ega_inbox}")
+                # The whole file was written in order, so an earlier upload in ranges no longer needs resuming
+                if os.path.exists(range_record_path(encrypted_data_file)):
+                    os.remove(range_record_path(encrypted_data_file))
+                break
+            except (paramiko.AuthenticationException, FileNotFoundError, PermissionError):
+                # A new connection won't fix a rejected password or a missing file
+                raise
+            except (OSError, EOFError, paramiko.SSHException) as e:
+                # A dropped connection can surface as any OSError, e.g. "Socket is closed" or a connection reset
+                stalled = isinstance(e, socket.timeout)
+                if attempt == max_reconnects:
+                    raise
+                monitor.record_reconnect(stalled)
+                logging.warning(
+                    f"Upload of {encrypted_data_file} {'stalled' if stalled else 'lost its connection'} at byte "
+                    f"{monitor.position}, reconnecting ({attempt + 1} of {max_reconnects})"
+                )
     except Exception as e:
         raise Exception(f"Error transferring file: {str(e)}")
+    finally:
+        monitor.finish()
+        if metrics_file:
+            monitor.write_metrics(metrics_file)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description="Transfer a file to EGA using an FTP server"
     )
-    parser.add_argument(
+    data_files = parser.add_mutually_exclusive_group(required=True)
+    data_files.add_argument(
         "--encrypted_data_file",
-        required=True,
         help="Data file that is already encrypted"
     )
+    data_files.add_argument(
+        "--encrypted_data_files_file",
+        help="A manifest with one encrypted data file per line. The files are transferred over a pool of connections."
+    )
     parser.add_argument(
         "--ega_inbox",
         required=True,
         help="Inbox assigned to the current PM"
     )
+    parser.add_argument(
+        "--connections",
+        required=False,
+        type=int,
+        default=DEFAULT_CONNECTIONS,
+        help="The number of SFTP connections used when transferring many files"
+    )
+    parser.add_argument(
+        "--read_ahead",
+        action="store_true",
+        help="With --encrypted_data_files_file, upload the files one at a time over a single connection while the "
+             "next file is read ahead, instead of over a pool of connections"
+    )
+    parser.add_argument(
+        "--streams",
+        required=False,
+        type=int,
+        default=1,
+        help="If greater than 1, --encrypted_data_file is split into byte ranges and uploaded over this many "
+             "connections at once. The completed ranges are recorded next to the local file, so a run on the same "
+             "machine only uploads the missing ranges; the record doesn't survive a Cromwell task retry or preemption."
+    )
+    parser.add_argument(
+        "--range_size",
+        required=False,
+        type=int,
+        default=RANGE_SIZE,
+        help="The size in bytes of each range when uploading over several streams"
+    )
+    parser.add_argument(
+        "--max_outstanding_writes",
+        required=False,
+        type=int,
+        default=MAX_OUTSTANDING_WRITES,
+        help="The number of SFTP write requests allowed in flight per connection"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue a partial upload of --encrypted_data_file left by an earlier attempt, or skip the file if it's "
+             "already fully uploaded"
+    )
+    parser.add_argument(
+        "--verify_prefix_bytes",
+        required=False,
+        type=int,
+        default=VERIFY_PREFIX_BYTES,
+        help="When resuming, how many bytes at the start and end of the partial upload are compared with the local "
+             "file. Set to 0 to trust the size of the partial upload."
+    )
+    parser.add_argument(
+        "--stall_timeout_seconds",
+        required=False,
+        type=float,
+        default=STALL_TIMEOUT_SECONDS,
+        help="Reconnect and resume if an upload makes no progress for this many seconds"
+    )
+    parser.add_argument(
+        "--max_reconnects",
+        required=False,
+        type=int,
+        default=MAX_RECONNECTS,
+        help="The number of times a stalled or dropped upload is resumed over a new connection"
+    )
+    parser.add_argument(
+        "--metrics_file",
+        required=False,
+        default=None,
+        help="If provided, write the throughput metrics of the upload to this JSON file"
+    )
+    parser.add_argument(
+        "--ciphers",
+        required=False,
+        default=",".join(PREFERRED_CIPHERS),
+        help="The SSH ciphers to offer, in order of preference (separated by commas)"
+    )
+    parser.add_argument(
+        "--macs",
+        required=False,
+        default=",".join(PREFERRED_MACS),
+        help="The SSH MACs to offer, in order of preference (separated by commas)"
+    )
+    parser.add_argument(
+        "--compression",
+        action="store_true",
+        help="Enable SSH compression. Encrypted files don't compress, so this is off by default."
+    )
     args = parser.parse_args()
+    if (args.resume or args.metrics_file) and (args.encrypted_data_files_file or args.streams > 1):
+        parser.error(
+            "--resume and --metrics_file only apply to a single --encrypted_data_file uploaded over one stream"
+        )
+    settings = SftpConnectionSettings(
+        max_outstanding_writes=args.max_outstanding_writes,
+        ciphers=tuple(args.ciphers.split(",")),
+        macs=tuple(args.macs.split(",")),
+        compression=args.compression,
+    )
 
     # Retrieve the secret value from Google Secret Manager
     password = SecretManager(ega_inbox=args.ega_inbox).get_ega_password_secret()
-    access_token = LoginAndGetToken(username=args.ega_inbox, password=password).login_and_get_token()
 
     logging.info("Starting script to transfer file to EGA")
-    transfer_file(args.encrypted_data_file, args.ega_inbox, password)
+    if args.encrypted_data_files_file and args.read_ahead:
+        transfer_files_with_read_ahead(
+            read_encrypted_data_files(args.encrypted_data_files_file),
+            args.ega_inbox,
+            password,
+            settings=settings,
+        )
+    elif args.encrypted_data_files_file:
+        transfer_files(
+            read_encrypted_data_files(args.encrypted_data_files_file),
+            args.ega_inbox,
+            password,
+            connections=args.connections,
+            settings=settings,
+        )
+    elif args.streams > 1:
+        transfer_file_in_ranges(
+            args.encrypted_data_file,
+            args.ega_inbox,
+            password,
+            streams=args.streams,
+            range_size=args.range_size,
+            settings=settings,
+        )
+    else:
+        transfer_file(
+            args.encrypted_data_file,
+            args.ega_inbox,
+            password,
+            settings,
+            resume=args.resume,
+            verify_prefix_bytes=args.verify_prefix_bytes,
+            stall_timeout_seconds=args.stall_timeout_seconds,
+            max_reconnects=args.max_reconnects,
+            metrics_file=args.metrics_file,
+        )
 
     logging.info("Script finished")
@@ -0,0 +1,166 @@
+"""
+    Progress and throughput metrics for uploads to the EGA inbox. A TransferMonitor is passed as the callback of an
+    SFTP transfer: it logs the throughput over a sliding window and an ETA while the upload runs, and at the end
+    writes a JSON summary with throughput percentiles, so that a slow link can be told apart from a hung transfer.
+    The percentiles are of one-second samples, and are only reported for a transfer long enough to have a
+    meaningful number of them.
+"""
+import json
+import time
+import logging
+from collections import deque
+from typing import Dict, List, Optional
+
+# Throughput is sampled once per second for the percentiles, and averaged over this window for progress logs
+SLIDING_WINDOW_SECONDS = 10
+LOG_INTERVAL_SECONDS = 30
+# Percentiles of fewer one-second samples than this say more about the sample count than about the link
+MIN_PERCENTILE_SAMPLES = 20
+THROUGHPUT_PERCENTILES = (5, 25, 50, 75, 95, 99)
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, round(percentile / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class TransferMonitor:
+    """
+    Tracks the progress of a single file upload. Call it with the position reached in the file and the file size,
+    which is the signature of paramiko's transfer callbacks. When an upload is resumed after a reconnect, call
+    `begin_attempt` with the offset it resumes from so the skipped bytes aren't counted as throughput.
+    """
+
+    def __init__(
+            self,
+            file_name: str,
+            total_bytes: int,
+            window_seconds: float = SLIDING_WINDOW_SECONDS,
+            log_interval_seconds: float = LOG_INTERVAL_SECONDS,
+    ) -> None:
+        self.file_name = file_name
+        self.total_bytes = total_bytes
+        self.window_seconds = window_seconds
+        self.log_interval_seconds = log_interval_seconds
+
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.position = 0
+        self.bytes_transferred = 0
+        self.resumed_from = 0
+        self.reconnects = 0
+        self.stalls = 0
+        self.longest_gap_seconds = 0.0
+
+        self._last_update_time = self.start_time
+        self._last_log_time = self.start_time
+        self._window = deque([(self.start_time, 0)])
+        self._second_start = self.start_time
+        self._second_bytes = 0
+        self._per_second_mib = []
+
+    def begin_attempt(self, offset: int) -> None:
+        if self.position == 0 and offset:
+            self.resumed_from = offset
+        self.position = offset
+
+    def record_reconnect(self, stalled: bool) -> None:
+        self.reconnects += 1
+        if stalled:
+            self.stalls += 1
+
+    def __call__(self, position: int, total_bytes: int) -> None:
+        now = time.monotonic()
+        new_bytes = max(position - self.position, 0)
+        self.position = position
+        self.bytes_transferred += new_bytes
+        self.longest_gap_seconds = max(self.longest_gap_seconds, now - self._last_update_time)
+        self._last_update_time = now
+
+        self._close_full_seconds(now)
+        self._second_bytes += new_bytes
+
+        self._window.append((now, self.bytes_transferred))
+        while len(self._window) > 2 and now - self._window[1][0] >= self.window_seconds:
+            self._window.popleft()
+
+        if now - self._last_log_time >= self.log_interval_seconds:
+            self._last_log_time = now
+            self.log_progress()
+
+    def _close_full_seconds(self, now: float) -> None:
+        # Sample every full second since the last update. Seconds without any progress count as zero throughput.
+        while now - self._second_start >= 1:
+            self._per_second_mib.append(self._second_bytes / (1024 * 1024))
+            self._second_bytes = 0
+            self._second_start += 1
+
+    def current_mib_per_second(self) -> float:
+        (first_time, first_bytes), (last_time, last_bytes) = self._window[0], self._window[-1]
+        if last_time <= first_time:
+            return 0.0
+        return (last_bytes - first_bytes) / (1024 * 1024) / (last_time - first_time)
+
+    def eta_seconds(self) -> Optional[float]:
+        mib_per_second = self.current_mib_per_second()
+        if not mib_per_second:
+            return None
+        return (self.total_bytes - self.position) / (1024 * 1024) / mib_per_second
+
+    def log_progress(self) -> None:
+        percent = 100 * self.position / self.total_bytes if self.total_bytes else 100.0
+        eta = self.eta_seconds()
+        logging.info(
+            f"Transferred {self.position / (1024 * 1024):.0f} of {self.total_bytes / (1024 * 1024):.0f} MiB of "
+            f"{self.file_name} ({percent:.1f}%) at {self.current_mib_per_second():.1f} MiB/s over the last "
+            f"{self.window_seconds:.0f}s, ETA {_format_duration(eta) if eta is not None else 'unknown'}"
+        )
+
+    def finish(self) -> None:
+        self.end_time = time.monotonic()
+        # The last, partial second isn't sampled, since its bytes would count as a whole second of throughput
+        self._close_full_seconds(self.end_time)
+
+    def throughput_percentiles(self) -> Optional[Dict[str, float]]:
+        """
+        Returns percentiles of the throughput in each full second of the transfer, or None for a transfer too short
+        to have `MIN_PERCENTILE_SAMPLES` of them
+        """
+        if len(self._per_second_mib) < MIN_PERCENTILE_SAMPLES:
+            return None
+        per_second_mib = sorted(self._per_second_mib)
+        return {f"p{percentile}": _percentile(per_second_mib, percentile) for percentile in THROUGHPUT_PERCENTILES}
+
+    def to_dict(self) -> Dict:
+        seconds = (self.end_time or time.monotonic()) - self.start_time
+        percentiles = self.throughput_percentiles()
+        return {
+            "file_name": self.file_name,
+            "total_bytes": self.total_bytes,
+            "bytes_transferred": self.bytes_transferred,
+            "resumed_from": self.resumed_from,
+            "seconds": seconds,
+            "mib_per_second": self.bytes_transferred / (1024 * 1024) / seconds if seconds else 0.0,
+            "throughput_samples": len(self._per_second_mib),
+            "throughput_percentiles_mib_per_second": percentiles,
+            "throughput_percentiles_note": (
+                "Percentiles of the throughput in each full second of the transfer" if percentiles else
+                f"Not reported for fewer than {MIN_PERCENTILE_SAMPLES} full seconds of transfer"
+            ),
+            "longest_gap_seconds": self.longest_gap_seconds,
+            "stalls": self.stalls,
+            "reconnects": self.reconnects,
+        }
+
+    def write_metrics(self, metrics_path: str) -> None:
+        with open(metrics_path, "w") as metrics_file:
+            json.dump(self.to_dict(), metrics_file, indent=2)
+        logging.info(f"Wrote transfer metrics for {self.file_name} to {metrics_path}")
@@ -1,15 +1,72 @@
 import requests
+import codecs
+import fcntl
+import hashlib
+import json
 import logging
+import os
+import random
 import re
 import sys
+import tempfile
+import threading
+import time
 import google_crc32c
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from pathlib import Path
 from google.cloud import secretmanager
-from typing import Dict, List, Optional
+from requests.adapters import HTTPAdapter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
 
 LOGIN_URL = "https://idp.ega-archive.org/realms/EGA/protocol/openid-connect/token"
 SUBMISSION_PROTOCOL_API_URL = "https://submission.ega-archive.org/api"
 VALID_STATUS_CODES = [200, 201]
 
+# Every request to the EGA APIs gives up after these (connect, read) timeouts instead of hanging the task
+REQUEST_TIMEOUT_SECONDS = (10, 120)
+# GETs are retried on these status codes and on connection errors, waiting up to BACKOFF_FACTOR * 2 ** retry
+# seconds (with jitter) between attempts. POSTs are only retried if the connection failed before they were sent.
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+MAX_BACKOFF_SECONDS = 60
+RETRY_STATUS_CODES = [500, 502, 504]
+RETRY_METHODS = ["GET", "HEAD", "OPTIONS"]
+CONNECTION_POOL_SIZE = 10
+
+# Responses that mean the API is throttling us. They slow down every request to the same host, and the request is
+# retried after the Retry-After delay if there is one. A 429 means the request wasn't processed, so POSTs are retried
+# too, while a 503 is only retried for the methods above.
+THROTTLE_STATUS_CODES = [429, 503]
+MAX_THROTTLE_RETRIES = 8
+# The starting (and highest) request rate and concurrency per host. After a throttled response both are halved, and
+# they grow back by about one request per second, and one concurrent request, per second of successful requests.
+MAX_REQUESTS_PER_SECOND = 10
+MIN_REQUESTS_PER_SECOND = 0.5
+MAX_CONCURRENT_REQUESTS = 16
+
+# List responses are parsed as they're downloaded, in chunks of this many bytes
+JSON_STREAM_CHUNK_SIZE = 64 * 1024
+# How much of a streamed response we'll read past the point where we stopped, so its connection can be reused
+STREAM_DRAIN_LIMIT_BYTES = 1024 * 1024
+
+# Access and refresh tokens are shared between processes on the same machine through this file. Every Cromwell task
+# runs on its own VM, so this only saves logins within a task, e.g. in the batch scripts; scattered shards still log
+# in once each. Tokens are renewed this many seconds before they expire, so that a token isn't handed out just before
+# it stops working.
+TOKEN_CACHE_PATH = os.environ.get("EGA_TOKEN_CACHE", os.path.join(tempfile.gettempdir(), "ega_token_cache.json"))
+TOKEN_EXPIRY_MARGIN_SECONDS = 60
+
+# Secret payloads are cached in memory for this long. Setting EGA_SECRET_CACHE_DIR (which should be a tmpfs such as
+# /dev/shm, so the secrets never reach a disk) also shares them with other processes on the same machine.
+SECRET_CACHE_TTL_SECONDS = 15 * 60
+SECRET_CACHE_DIRECTORY = os.environ.get("EGA_SECRET_CACHE_DIR")
+
 
 class LoggingConfigurator:
     def __init__(self):
@@ -42,32 +99,291 @@ class LoggingConfigurator:
 logging_configurator = LoggingConfigurator()
 
 
-class LoginAndGetToken:
-    def __init__(self, username: str, password: str) -> None:
-        self.username = username
-        self.password = password
+class _JitteredRetry(Retry):
+    """Exponential backoff with full jitter, so that tasks failing at the same time don't retry in lockstep"""
 
-    def login_and_get_token(self) -> Optional[str]:
-        """Logs in and retrieves access token"""
-        response = requests.post(
-            url=LOGIN_URL,
-            data={
-                "grant_type": "password",
-                "client_id": "sp-api",
-                "username": self.username,
-                "password": self.password,
+    def get_backoff_time(self) -> float:
+        return random.uniform(0, min(super().get_backoff_time(), MAX_BACKOFF_SECONDS))
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """Reads the Retry-After header, which is either a number of seconds or an HTTP date"""
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(float(retry_after), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits the requests sent to one host with a token bucket, which sets the request rate, and a cap on the requests
+    in flight. Both adapt to the API's responses AIMD-style: they're halved when the API throttles us and grow back
+    additively while requests succeed. A Retry-After header pauses every request until it has passed. The number of
+    requests and throttle events is kept in `counters`.
+    """
+
+    def __init__(
+            self,
+            max_requests_per_second: float = MAX_REQUESTS_PER_SECOND,
+            min_requests_per_second: float = MIN_REQUESTS_PER_SECOND,
+            max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS,
+    ) -> None:
+        self.max_requests_per_second = max_requests_per_second
+        self.min_requests_per_second = min_requests_per_second
+        self.max_concurrent_requests = max_concurrent_requests
+        self.requests_per_second = max_requests_per_second
+        self.concurrent_requests = float(max_concurrent_requests)
+        self.counters = Counter()
+
+        self._condition = threading.Condition()
+        self._tokens = max_requests_per_second
+        self._last_refill = time.monotonic()
+        self._in_flight = 0
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        # The bucket holds at most one second's worth of requests, which bounds the size of a burst
+        self._tokens = min(
+            self.requests_per_second, self._tokens + (now - self._last_refill) * self.requests_per_second
+        )
+        self._last_refill = now
+
+    def acquire(self) -> None:
+        """Blocks until a request may be sent"""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    self._condition.wait(self._paused_until - now)
+                elif self._in_flight >= int(self.concurrent_requests):
+                    self._condition.wait()
+                elif self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self.requests_per_second)
+                else:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self.counters["requests"] += 1
+                    return
+
+    def release(self, throttled: bool = False, retry_after: Optional[float] = None, completed: bool = True) -> None:
+        """
+        Records the outcome of a request sent after `acquire`. A request that didn't complete (because the connection
+        failed or timed out) says nothing about the API's limits, so it frees its slot without changing them.
+        """
+        with self._condition:
+            self._in_flight -= 1
+            if not completed:
+                self.counters["failed"] += 1
+            elif throttled:
+                self.counters["throttled"] += 1
+                self.requests_per_second = max(self.min_requests_per_second, self.requests_per_second / 2)
+                self.concurrent_requests = max(1.0, self.concurrent_requests / 2)
+                self._tokens = min(self._tokens, 0.0)
+                if retry_after is not None:
+                    self.counters["retry_after_pauses"] += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            else:
+                self.requests_per_second = min(
+                    self.max_requests_per_second, self.requests_per_second + 1 / self.requests_per_second
+                )
+                self.concurrent_requests = min(
+                    self.max_concurrent_requests, self.concurrent_requests + 1 / self.concurrent_requests
+                )
+            self._condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self._condition:
+            return {
+                **self.counters,
+                "requests_per_second": self.requests_per_second,
+                "concurrent_requests": int(self.concurrent_requests),
             }
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter(host: str) -> AdaptiveRateLimiter:
+    """Returns the rate limiter shared by every request to `host` in this process"""
+    return AdaptiveRateLimiter()
+
+
+class EgaApiClient:
+    """
+    A session for the EGA APIs that keeps connections alive between requests, so that each call doesn't open a new
+    TLS connection. Idempotent requests are retried with exponential backoff on transient errors, and every request
+    gets a timeout unless the caller passes its own. Requests also go through the rate limiter for their host, which
+    backs off when the API throttles us. When retries run out, the last response is returned so that callers can
+    report its status code as usual.
+    """
+
+    def __init__(
+            self,
+            max_retries: int = MAX_RETRIES,
+            backoff_factor: float = BACKOFF_FACTOR,
+            timeout: Tuple[float, float] = REQUEST_TIMEOUT_SECONDS,
+            pool_size: int = CONNECTION_POOL_SIZE,
+            max_throttle_retries: int = MAX_THROTTLE_RETRIES,
+    ) -> None:
+        self.timeout = timeout
+        self.backoff_factor = backoff_factor
+        self.max_throttle_retries = max_throttle_retries
+        retry = _JitteredRetry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=RETRY_METHODS,
+            raise_on_status=False,
+            # Throttled responses are retried in `request`, so that the rate limiter sees them
+            respect_retry_after_header=False,
         )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        rate_limiter = get_rate_limiter(urlparse(url).netloc)
+        for attempt in range(self.max_throttle_retries + 1):
+            rate_limiter.acquire()
+            throttled = False
+            retry_after = None
+            completed = False
+            try:
+                response = self.session.request(method, url, **kwargs)
+                completed = True
+                throttled = response.status_code in THROTTLE_STATUS_CODES
+                retry_after = _retry_after_seconds(response) if throttled else None
+            finally:
+                rate_limiter.release(throttled=throttled, retry_after=retry_after, completed=completed)
+
+            retryable = response.status_code == 429 or method.upper() in RETRY_METHODS
+            if not throttled or not retryable or attempt == self.max_throttle_retries:
+                return response
+            # Without a Retry-After, only this request waits; the limiter has already slowed down the others
+            if retry_after is None:
+                time.sleep(random.uniform(0, min(self.backoff_factor * 2 ** attempt, MAX_BACKOFF_SECONDS)))
+            logging.warning(
+                f"Throttled with status code {response.status_code} on {method} {urlparse(url).path}. Retrying "
+                f"(attempt {attempt + 1} of {self.max_throttle_retries}). Rate limiter: {rate_limiter.stats()}"
+            )
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+
+@lru_cache(maxsize=None)
+def get_ega_api_client() -> EgaApiClient:
+    """Returns the client shared by everything in this process, so that all requests draw on one connection pool"""
+    return EgaApiClient()
+
+
+class LoginAndGetToken:
+    """
+    Gets an access token for the EGA APIs. Tokens are cached in `token_cache_path`, keyed by username, along with the
+    refresh token and their expiry times. A cached access token is reused until shortly before it expires, then
+    renewed with the refresh token, and we only log in with the password when there's no usable refresh token either.
+    The cache is locked while it's read and updated, so when many processes on the same machine start at once only one
+    of them talks to the identity provider and the others pick up the token it stored. Pass `token_cache_path=None` to always log in.
+    """
+
+    def __init__(self, username: str, password: str, token_cache_path: Optional[str] = TOKEN_CACHE_PATH) -> None:
+        self.username = username
+        self.password = password
+        self.token_cache_path = token_cache_path
+
+    def _request_token(self, grant: dict) -> Optional[dict]:
+        """
+        Requests tokens from the identity provider and returns them with their expiry times. Returns None if a
+        refresh token was rejected, so that we can fall back to logging in with the password.
+        """
+        requested_at = time.time()
+        response = get_ega_api_client().post(url=LOGIN_URL, data={"client_id": "sp-api", **grant})
         if response.status_code in VALID_STATUS_CODES:
-            token = response.json()["access_token"]
-            print("Successfully created access token!")
-            return token
+            token_response = response.json()
+            return {
+                "access_token": token_response["access_token"],
+                "expires_at": requested_at + token_response.get("expires_in", 0),
+                "refresh_token": token_response.get("refresh_token"),
+                "refresh_expires_at": requested_at + token_response.get("refresh_expires_in", 0),
+            }
+        elif grant["grant_type"] == "refresh_token" and response.status_code in (400, 401):
+            logging.info("Refresh token was rejected. Will log in with the password instead.")
+            return None
         else:
-            error_message = f"""Received status code {response.status_code} with error {response.json()} while 
+            error_message = f"""Received status code {response.status_code} with error {response.text} while 
             attempting to get access token"""
             print(error_message)
             raise Exception(error_message)
 
+    def _login(self) -> dict:
+        return self._request_token(
+            {"grant_type": "password", "username": self.username, "password": self.password}
+        )
+
+    def _refresh(self, refresh_token: str) -> Optional[dict]:
+        return self._request_token({"grant_type": "refresh_token", "refresh_token": refresh_token})
+
+    @contextmanager
+    def _locked_cache(self) -> Iterator[dict]:
+        """Holds an exclusive lock on the cache and yields its contents. Changes are saved on exit."""
+        with open(f"{self.token_cache_path}.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                cache = {}
+                if os.path.exists(self.token_cache_path):
+                    try:
+                        with open(self.token_cache_path) as cache_file:
+                            cache = json.load(cache_file)
+                    except ValueError:
+                        logging.warning(f"Ignoring unreadable token cache {self.token_cache_path}")
+                cached_contents = json.dumps(cache, sort_keys=True)
+                yield cache
+                if json.dumps(cache, sort_keys=True) == cached_contents:
+                    return
+                # Write to a private temporary file first, so the tokens are never readable by others or half written
+                cache_directory = os.path.dirname(os.path.abspath(self.token_cache_path))
+                file_descriptor, temporary_path = tempfile.mkstemp(dir=cache_directory)
+                with os.fdopen(file_descriptor, "w") as cache_file:
+                    json.dump(cache, cache_file)
+                os.replace(temporary_path, self.token_cache_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _get_cached_or_new_tokens(self) -> dict:
+        with self._locked_cache() as cache:
+            tokens = cache.get(self.username)
+            valid_until = time.time() + TOKEN_EXPIRY_MARGIN_SECONDS
+            if tokens and tokens["expires_at"] > valid_until:
+                logging.info("Using cached access token")
+                return tokens
+
+            new_tokens = None
+            if tokens and tokens.get("refresh_token") and tokens["refresh_expires_at"] > valid_until:
+                logging.info("Cached access token is about to expire. Refreshing it.")
+                new_tokens = self._refresh(tokens["refresh_token"])
+            cache[self.username] = new_tokens or self._login()
+            return cache[self.username]
+
+    def login_and_get_token(self) -> Optional[str]:
+        """Logs in and retrieves access token"""
+        if self.token_cache_path:
+            token = self._get_cached_or_new_tokens()["access_token"]
+        else:
+            token = self._login()["access_token"]
+        print("Successfully created access token!")
+        return token
+
 
 def format_request_header(token: str) -> dict:
     return {
@@ -76,8 +392,95 @@ def format_request_header(token: str) -> dict:
     }
 
 
+def iter_json_array(response: requests.Response, chunk_size: int = JSON_STREAM_CHUNK_SIZE) -> Iterator[Any]:
+    """
+    Yields the elements of a JSON array response as they're downloaded, so a caller looking for one element can stop
+    reading as soon as it's found, and the whole array is never held in memory. Make the request with `stream=True`.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")()
+    chunks = response.iter_content(chunk_size=chunk_size)
+    buffer = ""
+    position = 0
+    in_array = False
+    exhausted = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in " \t\r\n" + ("," if in_array else ""):
+            position += 1
+
+        if position < len(buffer):
+            if not in_array:
+                if buffer[position] != "[":
+                    raise ValueError(f"Expected a JSON array but the response starts with {buffer[position:position + 20]}")
+                in_array = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                end = None
+            # A number cut off at the end of a chunk still decodes, so only trust an element followed by a delimiter
+            if end is not None and (exhausted or (end < len(buffer) and buffer[end] in " \t\r\n,]")):
+                yield element
+                position = end
+                continue
+
+        if exhausted:
+            raise ValueError("The JSON array in the response is truncated or malformed")
+        chunk = next(chunks, None)
+        exhausted = chunk is None
+        buffer = buffer[position:] + text_decoder.decode(chunk or b"", final=exhausted)
+        position = 0
+
+
+def drain_response(response: requests.Response, limit_bytes: int = STREAM_DRAIN_LIMIT_BYTES) -> None:
+    """
+    Reads what's left of a streamed response we stopped reading early. A response that was read to the end goes back
+    to the connection pool when it's closed, but one that wasn't has its connection closed with it. If more than
+    `limit_bytes` are left, it's cheaper to drop the connection than to download the rest.
+    """
+    drained = 0
+    try:
+        for chunk in response.iter_content(chunk_size=JSON_STREAM_CHUNK_SIZE):
+            drained += len(chunk)
+            if drained > limit_bytes:
+                logging.info(f"Closing the connection rather than reading more than {limit_bytes} unused bytes")
+                return
+    except (requests.exceptions.RequestException, OSError) as e:
+        logging.info(f"Couldn't read the rest of the response, so its connection will be closed: {e}")
+
+
+def iter_api_list(
+        url: str,
+        headers: dict,
+        description: str,
+        client: Optional[EgaApiClient] = None,
+        params: Optional[Dict] = None,
+) -> Iterator[Dict]:
+    """
+    Yields the objects returned by one of the EGA API's list endpoints while the response is still downloading, so a
+    caller looking for one object can stop as soon as it's found
+    """
+    client = client or get_ega_api_client()
+    with client.get(url=url, headers=headers, params=params, stream=True) as response:
+        if response.status_code not in VALID_STATUS_CODES:
+            error_message = f"""Received status code {response.status_code} with error: {response.text} while
+             attempting to query {description}"""
+            logging.error(error_message)
+            raise Exception(error_message)
+
+        try:
+            yield from iter_json_array(response)
+        finally:
+            # Runs when the caller stops early too, so the connection is returned to the pool rather than closed
+            drain_response(response)
+
+
 def get_file_metadata_for_one_sample_in_inbox(
-    normalized_sample_alias: str, headers: dict
+    normalized_sample_alias: str, headers: dict, client: Optional[EgaApiClient] = None
 ) -> Optional[List[Dict]]:
     """
     Retrieves file metadata for file matching normalized sample alias in the inbox
@@ -85,7 +488,7 @@ def get_file_metadata_for_one_sample_in_inbox(
     https://submission.ega-archive.org/api/spec/#/paths/files/get
     """
 
-    response = requests.get(
+    response = (client or get_ega_api_client()).get(
         url=f"{SUBMISSION_PROTOCOL_API_URL}/files?prefix=/{normalized_sample_alias}.cram",
         headers=headers,
     )
@@ -111,11 +514,128 @@ def normalize_sample_alias(sample_alias):
     return re.sub(r"[!\"#$%&''()*/:;<=>?@\[\]\^`{|}~ ]", "_", sample_alias)
 
 
+def cram_sample_alias(file: Dict) -> Optional[str]:
+    """Returns the normalized sample alias an inbox file was named after (/{alias}.cram), or None if it's not a cram"""
+    file_name = Path(file["relative_path"]).name
+    if Path(file_name).suffix == ".cram":
+        return Path(file_name).stem
+    return None
+
+
+def files_for_sample(file_metadata: List[Dict], sample_alias: str) -> List[Dict]:
+    """Filters inbox file metadata down to the crams of one sample"""
+    normalized_alias = normalize_sample_alias(sample_alias)
+    return [file for file in file_metadata if cram_sample_alias(file) == normalized_alias]
+
+
+class InboxFileIndex:
+    """
+    The cram files in an inbox, keyed by the normalized sample alias they were named after (/{alias}.cram), so that
+    the files for any number of samples can be looked up after listing the inbox once
+    """
+
+    def __init__(self, file_metadata: List[Dict]) -> None:
+        self.files_by_alias: Dict[str, List[Dict]] = defaultdict(list)
+        for file in file_metadata:
+            if sample_alias := cram_sample_alias(file):
+                self.files_by_alias[sample_alias].append(file)
+
+    @classmethod
+    def from_inbox(cls, headers: dict, client: Optional[EgaApiClient] = None) -> "InboxFileIndex":
+        """
+        Lists every file in the inbox
+        Endpoint documentation located here:
+        https://submission.ega-archive.org/api/spec/#/paths/files/get
+        """
+        file_metadata = list(
+            iter_api_list(f"{SUBMISSION_PROTOCOL_API_URL}/files", headers, "files in the inbox", client=client)
+        )
+        logging.info(f"Indexed {len(file_metadata)} files in the inbox")
+        return cls(file_metadata)
+
+    def files_for_sample(self, sample_alias: str) -> List[Dict]:
+        return self.files_by_alias.get(normalize_sample_alias(sample_alias), [])
+
+
+class StreamChecksums:
+    """Keeps running MD5 and SHA-256 checksums and the size of a byte stream that is read chunk by chunk"""
+
+    def __init__(self) -> None:
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data: bytes) -> None:
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def to_dict(self) -> Dict:
+        return {"md5": self.md5.hexdigest(), "sha256": self.sha256.hexdigest(), "size": self.size}
+
+
+def build_checksum_manifest(
+        file_name: str, unencrypted_checksums: StreamChecksums, encrypted_checksums: StreamChecksums
+) -> Dict:
+    return {
+        "file_name": file_name,
+        "unencrypted": unencrypted_checksums.to_dict(),
+        "encrypted": encrypted_checksums.to_dict(),
+    }
+
+
+def write_checksum_manifest(manifest_path: str, manifest: Dict) -> None:
+    """Writes the checksums of a data file and its encrypted copy to a json sidecar manifest"""
+    with open(manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    logging.info(f"Wrote checksum manifest for {manifest['file_name']} to {manifest_path}")
+
+
+def read_checksum_manifest(manifest_path: str) -> Dict:
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def checksum_matches(reported_checksum: Optional[str], recorded_checksums: Dict) -> bool:
+    """
+    Checks whether a checksum reported by EGA matches one recorded in a checksum manifest. EGA doesn't tell us which
+    algorithm was used, so either the MD5 or the SHA-256 is accepted. A checksum EGA hasn't reported yet doesn't match.
+    """
+    if not reported_checksum:
+        return False
+    return reported_checksum.lower() in (recorded_checksums["md5"], recorded_checksums["sha256"])
+
+
+@lru_cache(maxsize=None)
+def get_secret_manager_client() -> secretmanager.SecretManagerServiceClient:
+    """Returns a Secret Manager client shared by everything in this process"""
+    return secretmanager.SecretManagerServiceClient()
+
+
 class SecretManager:
-    def __init__(self, ega_inbox: str, project_id: str = "sc-ega-submissions", version_id: int = 1):
+    """
+    Reads the EGA inbox password from Secret Manager. Payloads are cached for `cache_ttl_seconds`, in memory and, if
+    `cache_directory` is set, in files there, so repeated lookups for the same inbox don't go back to Secret Manager.
+    The payload checksum is only checked when it's fetched.
+    """
+    _cached_payloads: Dict[str, Tuple[float, str]] = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(
+            self,
+            ega_inbox: str,
+            project_id: str = "sc-ega-submissions",
+            version_id: int = 1,
+            cache_ttl_seconds: float = SECRET_CACHE_TTL_SECONDS,
+            cache_directory: Optional[str] = SECRET_CACHE_DIRECTORY,
+            client: Optional[secretmanager.SecretManagerServiceClient] = None,
+    ):
         self.project_id = project_id
         self.version_id = version_id
         self.ega_inbox = ega_inbox
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache_directory = cache_directory
+        self.client = client
 
     def _get_secret_version_name(self) -> str:
         secret_id = f"{self.ega_inbox}_password"
@@ -128,16 +648,49 @@ class SecretManager:
 
         return response.payload.data_crc32c == int(crc32c.hexdigest(), 16)
 
+    def _cache_file_path(self, name: str) -> str:
+        return os.path.join(self.cache_directory, f"secret_{hashlib.sha256(name.encode()).hexdigest()}.json")
+
+    def _get_cached_payload(self, name: str) -> Optional[str]:
+        with self._cache_lock:
+            fetched_at, payload = self._cached_payloads.get(name, (0, None))
+        if payload is None and self.cache_directory:
+            try:
+                with open(self._cache_file_path(name)) as cache_file:
+                    cached_secret = json.load(cache_file)
+                fetched_at, payload = cached_secret["fetched_at"], cached_secret["payload"]
+            except (OSError, ValueError, KeyError):
+                return None
+        if time.time() - fetched_at < self.cache_ttl_seconds:
+            return payload
+        return None
+
+    def _cache_payload(self, name: str, payload: str) -> None:
+        fetched_at = time.time()
+        with self._cache_lock:
+            self._cached_payloads[name] = (fetched_at, payload)
+        if self.cache_directory:
+            # mkstemp creates the file readable by us only, and the rename means readers never see it half written
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.cache_directory)
+            with os.fdopen(file_descriptor, "w") as cache_file:
+                json.dump({"fetched_at": fetched_at, "payload": payload}, cache_file)
+            os.replace(temporary_path, self._cache_file_path(name))
+
     def _access_secret_version(self):
-        client = secretmanager.SecretManagerServiceClient()
         name = self._get_secret_version_name()
-        
+        if (cached_payload := self._get_cached_payload(name)) is not None:
+            logging.info("Using cached secret")
+            return cached_payload
+
+        client = self.client or get_secret_manager_client()
         try:
             response = client.access_secret_version(request={"name": name})
             if self._validate_payload_checksum(response):
                 logging.info("Successfully accessed secret")
 
-                return response.payload.data.decode("UTF-8")
+                payload = response.payload.data.decode("UTF-8")
+                self._cache_payload(name, payload)
+                return payload
             else:
                 logging.error("Data corruption detected.")
         except Exception as e:
@@ -152,3 +705,16 @@ class SecretManager:
             raise ValueError("Unable to retrieve secret. Application will now exit.")
 
         return secret_payload
+
+
+def get_ega_password_secrets(ega_inboxes: List[str], max_workers: int = 8, **kwargs) -> Dict[str, str]:
+    """
+    Fetches the passwords for several inboxes concurrently, for tools that work across inboxes. Keyword arguments are
+    passed on to SecretManager.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        passwords = executor.map(
+            lambda ega_inbox: SecretManager(ega_inbox=ega_inbox, **kwargs).get_ega_password_secret(),
+            ega_inboxes,
+        )
+        return dict(zip(ega_inboxes, passwords))